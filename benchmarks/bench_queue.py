@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+CommandQueue 性能基准
+测量 enqueue / dequeue / update_status / get_stats 在不同历史数据量与并发 worker 数下的
+吞吐（ops/s）与延迟（p50/p99）
+
+用法:
+    python benchmarks/bench_queue.py
+    python benchmarks/bench_queue.py --rows 1000,100000 --workers 1,4 --ops 5000
+    python benchmarks/bench_queue.py --json baseline.json
+"""
+
+import argparse
+import json
+import logging
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# 添加项目根目录到路径（项目内的 queue 包需要优先于标准库）
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from queue.manager import CommandQueue
+
+# 预置历史数据时每次提交的行数
+SEED_CHUNK = 20000
+
+# 参与调度的发件人数量
+SENDER_COUNT = 50
+
+# 模拟的命令结果（超过压缩阈值，覆盖压缩路径）
+RESULT_TEXT = "ok\n" * 400
+
+
+def _percentile(sorted_values, q):
+    """已排序序列的分位数（最近秩）"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def seed(db_path, rows):
+    """
+    直接写入历史数据：rows 条已完成命令（触发器同步维护 command_stats）
+
+    Args:
+        db_path: 队列数据库路径
+        rows: 历史命令数量
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous = OFF")
+    for start in range(0, rows, SEED_CHUNK):
+        conn.executemany(
+            """
+            INSERT INTO commands
+                (sender, command, message_id, subject, status, fair_tag,
+                 completed_at, content_hash)
+            VALUES (?, ?, ?, ?, 'completed', ?, CURRENT_TIMESTAMP, ?)
+            """,
+            (
+                (
+                    f"user{i % SENDER_COUNT}@example.com", f"echo history {i}",
+                    f"<seed-{i}@bench>", "bench", i / SENDER_COUNT, f"seed{i}"
+                )
+                for i in range(start, min(rows, start + SEED_CHUNK))
+            )
+        )
+        conn.commit()
+    conn.close()
+
+
+def run_phase(workers, total_ops, operation):
+    """
+    用 workers 个线程并发执行 total_ops 次操作
+
+    Args:
+        workers: 并发线程数
+        total_ops: 总操作次数（平均分给各线程）
+        operation: operation(worker_index, op_index) -> bool，返回False 表示该线程提前结束
+
+    Returns:
+        {'ops', 'seconds', 'ops_per_sec', 'p50_ms', 'p99_ms'}
+    """
+    per_worker = [total_ops // workers + (1 if i < total_ops % workers else 0) for i in range(workers)]
+    latencies = [[] for _ in range(workers)]
+    barrier = threading.Barrier(workers + 1)
+
+    def worker(index):
+        samples = latencies[index]
+        barrier.wait()
+        for op_index in range(per_worker[index]):
+            started = time.perf_counter()
+            done = operation(index, op_index)
+            samples.append(time.perf_counter() - started)
+            if done is False:
+                break
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    merged = sorted(sample for samples in latencies for sample in samples)
+    return {
+        "ops": len(merged),
+        "seconds": round(elapsed, 4),
+        "ops_per_sec": round(len(merged) / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(_percentile(merged, 0.50) * 1000, 3),
+        "p99_ms": round(_percentile(merged, 0.99) * 1000, 3),
+    }
+
+
+def bench_round(queue, workers, ops, round_no):
+    """
+    一轮完整的命令生命周期：入队 ops 条 → 并发认领 → 完成 → 查询统计
+
+    Returns:
+        {操作名: 测量结果}
+    """
+    claimed = [[] for _ in range(workers)]
+
+    def enqueue(index, op_index):
+        return queue.enqueue(
+            sender=f"user{(index * 7 + op_index) % SENDER_COUNT}@example.com",
+            command=f"echo {round_no}-{index}-{op_index}",
+            message_id=f"<bench-{round_no}-{index}-{op_index}@bench>",
+            subject="bench"
+        ) is not None
+
+    def dequeue(index, _):
+        cmd = queue.dequeue(worker_id=f"bench-{index}")
+        if cmd is None:
+            return False
+        claimed[index].append(cmd["id"])
+        return True
+
+    def update_status(index, op_index):
+        ids = claimed[index]
+        if op_index >= len(ids):
+            return False
+        return queue.update_status(
+            ids[op_index], CommandQueue.STATUS_COMPLETED,
+            result=RESULT_TEXT, worker_id=f"bench-{index}"
+        )
+
+    def get_stats(_, __):
+        return bool(queue.get_stats())
+
+    results = {"enqueue": run_phase(workers, ops, enqueue)}
+    results["dequeue"] = run_phase(workers, ops, dequeue)
+    # 各线程完成自己认领的命令（worker 持有租约）
+    per_worker = max(len(ids) for ids in claimed)
+    results["update_status"] = run_phase(workers, per_worker * workers, update_status)
+    results["get_stats"] = run_phase(workers, ops, get_stats)
+    return results
+
+
+def main():
+    """解析参数并运行基准"""
+    parser = argparse.ArgumentParser(description="CommandQueue 性能基准")
+    parser.add_argument("--rows", default="1000,100000,1000000",
+                        help="预置的历史命令数量，逗号分隔（默认 1000,100000,1000000）")
+    parser.add_argument("--workers", default="1,4,16",
+                        help="并发 worker 数，逗号分隔（默认 1,4,16）")
+    parser.add_argument("--ops", type=int, default=2000,
+                        help="每个操作每轮的总次数（默认 2000）")
+    parser.add_argument("--json", dest="json_path", help="把结果另存为 JSON，便于前后对比")
+    args = parser.parse_args()
+
+    row_counts = [int(value) for value in args.rows.split(",") if value.strip()]
+    worker_counts = [int(value) for value in args.workers.split(",") if value.strip()]
+
+    # 逐条入队会记录 INFO 日志，基准只关心队列本身的开销
+    logging.basicConfig(level=logging.WARNING)
+
+    print(f"SQLite {sqlite3.sqlite_version}, Python {sys.version.split()[0]}")
+    print(f"{'rows':>9} {'workers':>7} {'operation':<14} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    print("-" * 62)
+
+    report = []
+    for rows in row_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = str(Path(tmp) / "bench.db")
+            queue = CommandQueue(db_path)
+            started = time.perf_counter()
+            seed(db_path, rows)
+            print(f"# 预置 {rows} 条历史命令，用时 {time.perf_counter() - started:.1f} 秒")
+
+            for round_no, workers in enumerate(worker_counts):
+                results = bench_round(queue, workers, args.ops, round_no)
+                for operation, result in results.items():
+                    print(
+                        f"{rows:>9} {workers:>7} {operation:<14} {result['ops_per_sec']:>10.1f} "
+                        f"{result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f}"
+                    )
+                    report.append({"rows": rows, "workers": workers, "operation": operation, **result})
+            queue.close()
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"结果已写入 {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
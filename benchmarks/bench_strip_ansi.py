@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+strip_ansi 性能基准
+在多 MB 的模拟 PTY 输出上对比当前实现与旧实现（逐字符过滤）的吞吐（MB/s）
+
+用法:
+    python benchmarks/bench_strip_ansi.py
+    python benchmarks/bench_strip_ansi.py --repeat 5
+"""
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+# 添加项目根目录到路径（项目内的 queue 包需要优先于标准库）
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from core.executor import strip_ansi
+
+# 带光标控制、256 色与窗口标题序列的 claude 界面输出
+PTY_LINE = "\x1b[2K\x1b[1G\x1b[38;5;246m│\x1b[39m 处理文件 src/module_{:05d}.py … \x1b]0;claude\x07ok\r\n"
+
+# 不含转义序列的普通日志
+PLAIN_LINE = "plain log line {:05d} 普通输出\r\n"
+
+
+def legacy_strip_ansi(text: str) -> str:
+    """旧实现（逐字符过滤），作为性能基线"""
+    text = re.sub(r'\x1b\[[0-?]*[ -/]*[@-~]', '', text)
+    text = re.sub(r'\x1b\][^\x07\x1b]*[\x07\x1b\\]', '', text)
+    cleaned = []
+    for char in text:
+        code = ord(char)
+        if code >= 32 or code in (9, 10):
+            cleaned.append(char)
+    return ''.join(cleaned)
+
+
+def build_samples():
+    """
+    生成各类模拟输出
+
+    Returns:
+        {样本名: 文本}
+    """
+    return {
+        "pty": "".join(PTY_LINE.format(i) for i in range(60000)),
+        "plain": "".join(PLAIN_LINE.format(i) for i in range(150000)),
+        "ascii": "".join(f"\x1b[32mok\x1b[0m line {i:05d}\r\n" for i in range(200000)),
+    }
+
+
+def best_time(func, arg, repeat):
+    """多次运行取最短耗时（秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    """解析参数并运行基准"""
+    parser = argparse.ArgumentParser(description="strip_ansi 性能基准")
+    parser.add_argument("--repeat", type=int, default=3, help="每个样本的运行次数，取最快一次（默认 3）")
+    args = parser.parse_args()
+
+    print(f"Python {sys.version.split()[0]}")
+    print(f"{'sample':<8} {'MB':>6} {'legacy MB/s':>12} {'current MB/s':>13} {'speedup':>8}")
+    print("-" * 51)
+
+    for name, text in build_samples().items():
+        if strip_ansi(text) != legacy_strip_ansi(text):
+            print(f"{name:<8} 输出与旧实现不一致，跳过")
+            continue
+        size_mb = len(text.encode("utf-8")) / 1e6
+        legacy = best_time(legacy_strip_ansi, text, args.repeat)
+        current = best_time(strip_ansi, text, args.repeat)
+        print(
+            f"{name:<8} {size_mb:>6.1f} {size_mb / legacy:>12.1f} "
+            f"{size_mb / current:>13.1f} {legacy / current:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,18 @@ class Settings:
     DEFAULT_MAX_RETRIES = 3
     DEFAULT_DB_PATH = "commands.db"
     DEFAULT_CLAUDE_TIMEOUT = 3600
+    DEFAULT_WORKER_COUNT = 2
+    DEFAULT_LEASE_SECONDS = 30
+    DEFAULT_PTY_IDLE_TIMEOUT = 5.0
+    DEFAULT_MAX_EMAIL_SIZE = 10 * 1024 * 1024
+    DEFAULT_IDLE_TIMEOUT = 29 * 60
+    DEFAULT_DEDUP_WINDOW = 0
+    DEFAULT_RETENTION_DAYS = 7
+    DEFAULT_SHUTDOWN_TIMEOUT = 60
+    DEFAULT_MAINTENANCE_INTERVAL = 3600
+    DEFAULT_ATTACHMENT_COMPRESSION = "gzip"
+    DEFAULT_ATTACHMENT_COMPRESS_THRESHOLD = 64 * 1024
+    ATTACHMENT_COMPRESSIONS = ("gzip", "zip", "none")
 
     def __init__(self):
         """初始化配置"""
@@ -100,6 +112,27 @@ class Settings:
         whitelist = os.getenv("EMAIL_WHITELIST", "")
         return [email.strip() for email in whitelist.split(",") if email.strip()]
 
+    def get_sender_weights(self) -> dict:
+        """
+        获取发件人调度权重（SENDER_WEIGHTS="a@x.com=2,b@y.com=0.5"）
+
+        Returns:
+            {发件人: 权重}，格式错误或非正数的条目被忽略
+        """
+        weights = {}
+        for item in os.getenv("SENDER_WEIGHTS", "").split(","):
+            sender, sep, value = item.partition("=")
+            if not sep or not sender.strip():
+                continue
+            try:
+                weight = float(value)
+            except ValueError:
+                logger.warning(f"SENDER_WEIGHTS 条目无效: {item}")
+                continue
+            if weight > 0:
+                weights[sender.strip()] = weight
+        return weights
+
     def get(self, key: str, default: Any = None) -> Any:
         """
         获取环境变量的通用方法
@@ -131,9 +164,59 @@ class Settings:
         """获取Claude执行超时（秒）"""
         return int(os.getenv("CLAUDE_TIMEOUT", str(self.DEFAULT_CLAUDE_TIMEOUT)))
 
+    def get_pty_idle_timeout(self) -> float:
+        """获取PTY模式空闲判定时间（秒），无输出超过该时间视为命令完成"""
+        return float(os.getenv("PTY_IDLE_TIMEOUT", str(self.DEFAULT_PTY_IDLE_TIMEOUT)))
+
+    def get_worker_count(self) -> int:
+        """获取并发执行的 worker 数量（至少为1）"""
+        return max(1, int(os.getenv("WORKER_COUNT", str(self.DEFAULT_WORKER_COUNT))))
+
+    def get_lease_seconds(self) -> int:
+        """获取命令租约时长（秒），worker 每 1/3 租约续约一次"""
+        return max(3, int(os.getenv("LEASE_SECONDS", str(self.DEFAULT_LEASE_SECONDS))))
+
+    def get_max_email_size(self) -> int:
+        """获取可接受的邮件大小上限（字节），超出的邮件不下载正文直接跳过"""
+        return int(os.getenv("MAX_EMAIL_SIZE", str(self.DEFAULT_MAX_EMAIL_SIZE)))
+
+    def get_dedup_window(self) -> int:
+        """获取重复命令判定窗口（秒），同一发件人窗口内的相同命令只执行一次，0 表示关闭"""
+        return max(0, int(os.getenv("DEDUP_WINDOW", str(self.DEFAULT_DEDUP_WINDOW))))
+
+    def get_shutdown_timeout(self) -> int:
+        """获取停机时等待执行中命令完成的最长时间（秒），超时后终止 claude 子进程并把命令放回队列"""
+        return max(0, int(os.getenv("SHUTDOWN_TIMEOUT", str(self.DEFAULT_SHUTDOWN_TIMEOUT))))
+
+    def get_retention_days(self) -> int:
+        """获取已完成/失败命令的保留天数"""
+        return max(1, int(os.getenv("RETENTION_DAYS", str(self.DEFAULT_RETENTION_DAYS))))
+
+    def get_archive_enabled(self) -> bool:
+        """是否把过期命令移入归档（否则直接删除）"""
+        return os.getenv("ARCHIVE_ENABLED", "false").strip().lower() in ("1", "true", "yes", "on")
+
+    def get_maintenance_interval(self) -> int:
+        """获取数据库维护（保留期清理与空间回收）的执行间隔（秒）"""
+        return max(60, int(os.getenv("MAINTENANCE_INTERVAL", str(self.DEFAULT_MAINTENANCE_INTERVAL))))
+
+    def get_attachment_compression(self) -> str:
+        """获取结果附件压缩格式（gzip / zip / none），无效值回退到默认"""
+        value = os.getenv("ATTACHMENT_COMPRESSION", self.DEFAULT_ATTACHMENT_COMPRESSION).strip().lower()
+        if value not in self.ATTACHMENT_COMPRESSIONS:
+            logger.warning(f"ATTACHMENT_COMPRESSION 无效: {value}，使用 {self.DEFAULT_ATTACHMENT_COMPRESSION}")
+            return self.DEFAULT_ATTACHMENT_COMPRESSION
+        return value
+
+    def get_attachment_compress_threshold(self) -> int:
+        """获取附件压缩阈值（字节），小于该大小的附件不压缩"""
+        return int(os.getenv(
+            "ATTACHMENT_COMPRESS_THRESHOLD", str(self.DEFAULT_ATTACHMENT_COMPRESS_THRESHOLD)
+        ))
+
     def get_idle_timeout(self) -> int:
-        """获取IDLE超时时间（秒）"""
-        return int(os.getenv("IDLE_TIMEOUT", "5"))
+        """获取单次IDLE最长保持时间（秒），有新邮件时会提前唤醒"""
+        return int(os.getenv("IDLE_TIMEOUT", str(self.DEFAULT_IDLE_TIMEOUT)))
 
     def get_project_dir(self) -> str:
         """
@@ -4,18 +4,179 @@ Claude Code执行器
 复用现有claude_executor.py逻辑
 """
 
+import codecs
 import json
 import logging
 import os
 import re
+import selectors
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Callable, Set
 
 logger = logging.getLogger(__name__)
 
+# ANSI 转义序列：CSI（颜色、光标控制）与 OSC（窗口标题等）
+ANSI_CSI_RE = re.compile(r'\x1b\[[0-?]*[ -/]*[@-~]')
+ANSI_OSC_RE = re.compile(r'\x1b\][^\x07\x1b]*[\x07\x1b\\]')
+# 合并为以 ESC 开头的单个模式，一次扫描完成且可利用字面量前缀快速跳过
+ANSI_RE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*[\x07\x1b\\])')
+
+# 删除除制表符和换行外的 C0 控制字符
+CONTROL_CHARS_TABLE = {code: None for code in range(32) if code not in (9, 10)}
+# 非 ASCII 文本在 UTF-8 字节上删除（多字节序列不含 0x00-0x1f，str.translate 对非 ASCII 较慢）
+_CONTROL_BYTES = bytes(CONTROL_CHARS_TABLE)
+
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+_PRINT_FLAG_RE = re.compile(r"(^|[\s,])-p\b")
+
+
+def strip_ansi(text: str) -> str:
+    """移除 ANSI 转义序列和控制字符（正则与 translate 均在 C 层完成）"""
+    if '\x1b' in text:
+        text = ANSI_RE.sub('', text)
+    if text.isascii():
+        return text.translate(CONTROL_CHARS_TABLE)
+    return (
+        text.encode('utf-8', 'surrogatepass')
+        .translate(None, _CONTROL_BYTES)
+        .decode('utf-8', 'surrogatepass')
+    )
+
+
+class PrintModeUnavailable(RuntimeError):
+    """print 模式未能启动（命令尚未执行），可安全回退到 PTY 模式"""
+
+
+class StreamCapture:
+    """
+    流式输出捕获
+
+    增量解码 UTF-8 并移除 ANSI 序列；内容超过阈值后整体转存到临时文件，
+    内存中只保留有界的尾部用于提取总结，内存占用与输出大小无关。
+    """
+
+    DEFAULT_SPILL_THRESHOLD = 1024 * 1024  # 超过该字符数后落盘
+    DEFAULT_TAIL_SIZE = 64 * 1024          # 内存中保留的尾部字符数
+    # 跨块的不完整转义序列最多保留的长度
+    MAX_PENDING_ESCAPE = 256
+
+    def __init__(
+        self,
+        strip: Callable[[str], str],
+        spill_threshold: int = DEFAULT_SPILL_THRESHOLD,
+        tail_size: int = DEFAULT_TAIL_SIZE
+    ):
+        """
+        初始化捕获器
+
+        Args:
+            strip: ANSI 清理函数（需对完整的转义序列生效）
+            spill_threshold: 落盘阈值（字符数）
+            tail_size: 内存中保留的尾部字符数
+        """
+        self._strip = strip
+        self.spill_threshold = spill_threshold
+        self.tail_size = tail_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._pending = ""
+        self._chunks: List[str] = []
+        self._spill = None
+        self.spill_path: Optional[Path] = None
+        self.size = 0
+        self.tail = ""
+
+    @property
+    def spilled(self) -> bool:
+        """是否已转存到临时文件"""
+        return self.spill_path is not None
+
+    def feed(self, data: bytes) -> None:
+        """写入一块原始字节"""
+        self._write(self._decoder.decode(data))
+
+    def close(self) -> None:
+        """结束写入，刷新解码器和未完成的转义序列"""
+        self._write(self._decoder.decode(b'', final=True), final=True)
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def text(self) -> str:
+        """
+        获取捕获的文本
+
+        Returns:
+            未落盘时为完整输出；已落盘时为省略提示 + 尾部（完整内容见 spill_path）
+        """
+        if not self.spilled:
+            return ''.join(self._chunks)
+        omitted = self.size - len(self.tail)
+        return f"...[输出过长，已省略前 {omitted} 字符，完整内容见附件]\n{self.tail}"
+
+    def discard(self) -> None:
+        """删除临时文件"""
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        if self.spill_path is not None:
+            try:
+                self.spill_path.unlink()
+            except OSError as e:
+                logger.debug(f"删除临时输出文件失败: {e}")
+            self.spill_path = None
+
+    def _write(self, text: str, final: bool = False) -> None:
+        text = self._pending + text
+        self._pending = ""
+        if not final:
+            text, self._pending = self._split_incomplete_escape(text)
+
+        clean = self._strip(text)
+        if not clean:
+            return
+
+        self.size += len(clean)
+        self.tail = (self.tail + clean)[-self.tail_size:]
+
+        if self._spill is None and not self.spilled and self.size > self.spill_threshold:
+            self._start_spill()
+
+        if self._spill is not None:
+            self._spill.write(clean)
+        else:
+            self._chunks.append(clean)
+
+    def _start_spill(self) -> None:
+        """创建临时文件并写入已缓存的内容"""
+        self._spill = tempfile.NamedTemporaryFile(
+            mode='w', encoding='utf-8', prefix='claude_output_', suffix='.txt', delete=False
+        )
+        self.spill_path = Path(self._spill.name)
+        self._spill.writelines(self._chunks)
+        self._chunks = []
+        logger.info(f"输出超过 {self.spill_threshold} 字符，转存到: {self.spill_path}")
+
+    def _split_incomplete_escape(self, text: str):
+        """拆出末尾尚未结束的转义序列，留到下一块再处理"""
+        idx = text.rfind('\x1b')
+        if idx == -1 or len(text) - idx > self.MAX_PENDING_ESCAPE:
+            return text, ""
+
+        rest = text[idx:]
+        if len(rest) == 1:
+            return text[:idx], rest
+        if rest[1] == '[' and not ANSI_CSI_RE.match(rest):
+            return text[:idx], rest
+        if rest[1] == ']' and not ANSI_OSC_RE.match(rest):
+            return text[:idx], rest
+        return text, ""
+
 
 class ClaudeExecutor:
     """Claude Code命令执行器"""
@@ -23,18 +184,59 @@ class ClaudeExecutor:
     DEFAULT_TIMEOUT = 300
     OUTPUT_FILE = Path("claude_output.txt")
 
-    def __init__(self, output_file: Optional[Path] = None, timeout: int = DEFAULT_TIMEOUT):
+    # PTY 模式参数
+    DEFAULT_PTY_IDLE_TIMEOUT = 5.0  # 无输出多久视为完成（秒）
+    PTY_STARTUP_TIMEOUT = 10.0      # 等待提示符就绪的最长时间（秒）
+    PTY_DRAIN_TIMEOUT = 3.0         # 发送 EOF 后收尾读取的最长时间（秒）
+    PTY_READ_SIZE = 65536
+    # Claude 交互界面就绪时出现的提示符特征
+    PTY_READY_MARKERS = ("? for shortcuts", "╭", "> ")
+
+    # 输出捕获：超过阈值落盘，内存只保留尾部
+    OUTPUT_SPILL_THRESHOLD = StreamCapture.DEFAULT_SPILL_THRESHOLD
+    OUTPUT_TAIL_SIZE = StreamCapture.DEFAULT_TAIL_SIZE
+    STREAM_READ_SIZE = 65536
+
+    # 能力探测超时（秒）
+    PROBE_TIMEOUT = 15
+    # terminate_all() 发送 SIGTERM 后等待子进程退出的时间（秒），超时后强制结束
+    TERMINATE_TIMEOUT = 5.0
+    # print 模式参数错误的特征：说明命令未真正执行
+    USAGE_ERROR_PATTERN = re.compile(
+        r"unknown option|unrecognized (option|argument)|invalid option|^usage:",
+        re.IGNORECASE | re.MULTILINE
+    )
+
+    def __init__(
+        self,
+        output_file: Optional[Path] = None,
+        timeout: int = DEFAULT_TIMEOUT,
+        pty_idle_timeout: float = DEFAULT_PTY_IDLE_TIMEOUT
+    ):
         """
         初始化执行器
 
         Args:
             output_file: 输出文件路径
             timeout: 执行超时时间（秒）
+            pty_idle_timeout: PTY 模式下无输出多久视为命令完成（秒）
         """
         self.output_file = output_file or self.OUTPUT_FILE
         self.timeout = timeout
+        self.pty_idle_timeout = pty_idle_timeout
+        self._capabilities: Optional[Dict[str, bool]] = None
+        self._probe_lock = threading.Lock()
         self.project_dir = self._get_valid_project_dir()
 
+        # 多个 worker 并发执行：跟踪运行中的子进程，停机时统一终止
+        self._processes: Set[subprocess.Popen] = set()
+        self._terminated: Set[subprocess.Popen] = set()
+        self._processes_lock = threading.Lock()
+        self._stopping = False
+        self._local = threading.local()
+        # 总结文件由所有 worker 共享，串行写入
+        self._summary_lock = threading.Lock()
+
     def _get_valid_project_dir(self) -> Path:
         """
         获取有效的项目目录
@@ -96,10 +298,63 @@ class ClaudeExecutor:
 
         return str(path)
 
+    def probe_capabilities(self, refresh: bool = False) -> Dict[str, bool]:
+        """
+        探测 claude CLI 能力（结果缓存，应在启动时调用一次）
+
+        Args:
+            refresh: 是否忽略缓存重新探测
+
+        Returns:
+            能力字典:
+            {
+                'available': bool,               # claude 命令可执行
+                'print_mode': bool,              # 支持 -p/--print
+                'no_session_persistence': bool   # 支持 --no-session-persistence
+            }
+        """
+        with self._probe_lock:
+            if self._capabilities is not None and not refresh:
+                return self._capabilities
+
+            caps = {"available": False, "print_mode": False, "no_session_persistence": False}
+            try:
+                result = subprocess.run(
+                    ['claude', '--help'],
+                    capture_output=True,
+                    text=True,
+                    encoding='utf-8',
+                    errors='replace',
+                    timeout=self.PROBE_TIMEOUT,
+                    env=self._claude_env()
+                )
+                help_text = (result.stdout or "") + (result.stderr or "")
+                caps["available"] = True
+                # 无法解析帮助文本时按支持处理，由失败分类器兜底
+                caps["print_mode"] = (
+                    not help_text.strip()
+                    or "--print" in help_text
+                    or _PRINT_FLAG_RE.search(help_text) is not None
+                )
+                caps["no_session_persistence"] = "--no-session-persistence" in help_text
+            except FileNotFoundError:
+                logger.warning("claude 命令未找到")
+            except (subprocess.TimeoutExpired, OSError) as e:
+                # 命令存在但探测失败：保守地允许 print 模式，失败时由分类器决定是否回退
+                logger.warning(f"claude 能力探测失败: {e}")
+                caps.update(available=True, print_mode=True)
+
+            logger.info(f"Claude 能力探测: {caps}")
+            self._capabilities = caps
+            return caps
+
     def execute(self, command: str) -> Dict:
         """
         执行Claude Code命令
 
+        仅当 print 模式不可用或未能启动时才回退到 PTY 模式，
+        print 模式已开始执行后的失败直接返回，避免同一命令被执行两次。
+
         Args:
             command: 要执行的命令
 
@@ -107,18 +362,123 @@ class ClaudeExecutor:
             执行结果字典:
             {
                 'success': bool,
-                'output': str,
+                'output': str,           # 已移除 ANSI；过长时只含尾部
                 'summary': str,
-                'error': Optional[str]
+                'error': Optional[str],
+                'output_file': Optional[str],  # 过长输出的完整内容临时文件，由调用方删除
+                'terminated': bool       # 被 terminate_all() 中止（停机），命令未完成
             }
         """
+        self._local.killed = False
+        result = self._execute(command) if not self._stopping else None
+        if result is None or self._local.killed:
+            if result and result.get("output_file"):
+                try:
+                    Path(result["output_file"]).unlink()
+                except OSError as e:
+                    logger.debug(f"删除临时输出文件失败: {e}")
+            logger.warning(f"命令因停机被中止: {command[:50]}...")
+            return {
+                "success": False,
+                "output": "",
+                "summary": "",
+                "error": "执行被中止（停机）",
+                "terminated": True
+            }
+        result.setdefault("terminated", False)
+        return result
+
+    def terminate_all(self, timeout: float = TERMINATE_TIMEOUT) -> int:
+        """
+        终止所有运行中的 claude 子进程（连同其进程组），之后不再启动新进程
+
+        被终止命令的 execute() 返回 terminated=True，由调用方放回队列。
+
+        Args:
+            timeout: 等待子进程响应 SIGTERM 的时间（秒），超时后强制结束
+
+        Returns:
+            终止的子进程数量
+        """
+        with self._processes_lock:
+            self._stopping = True
+            running = [process for process in self._processes if process.poll() is None]
+            self._terminated.update(running)
+
+        for process in running:
+            logger.warning(f"终止 claude 子进程: PID {process.pid}")
+            self._signal_process(process, signal.SIGTERM)
+
+        deadline = time.monotonic() + timeout
+        for process in running:
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                self._signal_process(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+        return len(running)
+
+    @staticmethod
+    def _signal_process(process: subprocess.Popen, sig: int) -> None:
+        """向子进程所在的进程组发送信号（Windows 上直接结束进程）"""
+        if process.poll() is not None:
+            return
+        try:
+            if os.name == "posix":
+                # 子进程以新会话启动，进程组ID即其PID，claude 派生的进程一并结束
+                os.killpg(process.pid, sig)
+            elif sig == signal.SIGTERM:
+                process.terminate()
+            else:
+                process.kill()
+        except (ProcessLookupError, PermissionError) as e:
+            logger.debug(f"结束子进程失败: {e}")
+
+    def _spawn(self, args: List[str], **kwargs) -> subprocess.Popen:
+        """
+        以新会话启动子进程并登记，停机后拒绝启动
+
+        Raises:
+            OSError: 启动失败
+        """
+        with self._processes_lock:
+            if self._stopping:
+                # 命令未执行，与被终止的命令一样交还调用方放回队列
+                self._local.killed = True
+                raise OSError("执行器正在停机，拒绝启动新进程")
+            process = subprocess.Popen(args, start_new_session=True, **kwargs)
+            self._processes.add(process)
+        return process
+
+    def _forget(self, process: Optional[subprocess.Popen]) -> None:
+        """注销已结束的子进程，并记录本线程的命令是否被 terminate_all() 终止"""
+        if process is None:
+            return
+        with self._processes_lock:
+            self._processes.discard(process)
+            if process in self._terminated:
+                self._terminated.discard(process)
+                self._local.killed = True
+
+    def _execute(self, command: str) -> Dict:
+        """按 print 模式 → PTY 模式的顺序执行命令"""
         logger.info(f"执行Claude命令: {command[:100]}...")
+        caps = self.probe_capabilities()
 
         try:
-            # 方法1: 尝试使用 claude -p 非交互模式
-            result = self._run_with_print_mode(command)
-            if result["success"]:
-                return result
+            if not caps["available"]:
+                return {
+                    "success": False,
+                    "output": "",
+                    "summary": "",
+                    "error": "claude 命令未找到"
+                }
+
+            # 方法1: 使用 claude -p 非交互模式
+            if caps["print_mode"]:
+                try:
+                    return self._run_with_print_mode(command)
+                except PrintModeUnavailable as e:
+                    logger.info(f"print 模式未能启动: {e}")
 
             # 方法2: 回退到 PTY 交互模式
             logger.info("回退到 PTY 交互模式")
@@ -141,73 +501,179 @@ class ClaudeExecutor:
                 "error": str(e)
             }
 
+    @staticmethod
+    def _claude_env() -> Dict[str, str]:
+        """子进程环境（清除 CLAUDECODE 以允许嵌套调用）"""
+        env = os.environ.copy()
+        env['CLAUDECODE'] = ''
+        return env
+
+    def _new_capture(self) -> StreamCapture:
+        """创建输出捕获器"""
+        return StreamCapture(
+            self._strip_ansi,
+            spill_threshold=self.OUTPUT_SPILL_THRESHOLD,
+            tail_size=self.OUTPUT_TAIL_SIZE
+        )
+
+    def _stream_process(
+        self,
+        process: subprocess.Popen,
+        stdout: StreamCapture,
+        stderr: StreamCapture,
+        stdin_data: Optional[bytes] = None
+    ) -> int:
+        """
+        并发读取子进程的 stdout/stderr 到捕获器，等待结束
+
+        Args:
+            process: 以 PIPE 启动的子进程
+            stdout: stdout 捕获器
+            stderr: stderr 捕获器
+            stdin_data: 写入 stdin 的数据（写完后关闭）
+
+        Returns:
+            进程退出码
+
+        Raises:
+            subprocess.TimeoutExpired: 超时（进程已被结束）
+        """
+        def pump(stream, capture: StreamCapture) -> None:
+            try:
+                while True:
+                    data = stream.read1(self.STREAM_READ_SIZE)
+                    if not data:
+                        break
+                    capture.feed(data)
+            except (OSError, ValueError) as e:
+                logger.debug(f"读取子进程输出结束: {e}")
+
+        readers = [
+            threading.Thread(target=pump, args=(process.stdout, stdout), daemon=True),
+            threading.Thread(target=pump, args=(process.stderr, stderr), daemon=True),
+        ]
+        for reader in readers:
+            reader.start()
+
+        if stdin_data is not None and process.stdin:
+            try:
+                process.stdin.write(stdin_data)
+                process.stdin.close()
+            except OSError as e:
+                logger.debug(f"写入 stdin 失败: {e}")
+
+        try:
+            process.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            # 结束整个进程组：claude 派生的进程会继承输出管道，只结束 claude 本身读取线程无法退出
+            self._signal_process(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+            process.wait()
+            raise
+        finally:
+            for reader in readers:
+                reader.join(timeout=5)
+            stdout.close()
+            stderr.close()
+
+        return process.returncode
+
+    def _capture_result(
+        self,
+        command: str,
+        returncode: int,
+        stdout: StreamCapture,
+        stderr: StreamCapture
+    ) -> Dict:
+        """由捕获结果构造执行结果字典（stdout 为空时使用 stderr）"""
+        used, unused = (stdout, stderr) if stdout.size else (stderr, stdout)
+        unused.discard()
+
+        output = used.text()
+        summary = self._extract_summary(used.tail if used.spilled else output)
+        self._save_summary(summary, command)
+
+        success = returncode == 0 or bool(output)
+        return {
+            "success": success,
+            "output": output,
+            "summary": summary,
+            "error": None if success else f"claude 异常退出 (退出码: {returncode})",
+            "output_file": str(used.spill_path) if used.spilled else None
+        }
+
     def _run_with_print_mode(self, command: str) -> Dict:
         """
-        使用 claude -p 非交互模式执行
+        使用 claude -p 非交互模式执行（流式捕获输出）
 
         Args:
             command: 要执行的命令
 
         Returns:
             执行结果字典
-        """
-        try:
-            cmd = [
-                'claude',
-                '-p',
-                '--no-session-persistence',
-                command
-            ]
 
-            env = os.environ.copy()
-            env['CLAUDECODE'] = ''
+        Raises:
+            PrintModeUnavailable: 进程未能启动或参数不被接受（命令未执行）
+            subprocess.TimeoutExpired: 执行超时
+        """
+        caps = self._capabilities or {}
+        cmd = ['claude', '-p']
+        if caps.get("no_session_persistence", True):
+            cmd.append('--no-session-persistence')
+        cmd.append(command)
 
-            result = subprocess.run(
+        try:
+            process = self._spawn(
                 cmd,
-                capture_output=True,
-                text=True,
-                encoding='utf-8',
-                errors='replace',
-                timeout=self.timeout,
-                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=self._claude_env(),
                 cwd=str(self.project_dir)
             )
-
-            output = result.stdout
-            if not output:
-                output = result.stderr
-
-            summary = self._extract_summary(output)
-            self._save_summary(summary, command)
-
-            return {
-                "success": result.returncode == 0 or bool(output),
-                "output": output,
-                "summary": summary,
-                "error": None
-            }
-
-        except FileNotFoundError:
-            logger.warning("claude 命令未找到")
-            return {
-                "success": False,
-                "output": "",
-                "summary": "",
-                "error": "claude 命令未找到"
-            }
-        except Exception as e:
+        except OSError as e:
+            # 启动失败（未找到、无权限、工作目录无效），命令尚未执行
             logger.warning(
-                f"print mode 失败: {type(e).__name__}: {e}\n"
+                f"print mode 启动失败: {type(e).__name__}: {e}\n"
                 f"  项目目录: {self.project_dir}\n"
                 f"  目录存在: {self.project_dir.exists()}\n"
                 f"  是否目录: {self.project_dir.is_dir() if self.project_dir.exists() else 'N/A'}"
             )
-            return {
-                "success": False,
-                "output": "",
-                "summary": "",
-                "error": str(e)
-            }
+            raise PrintModeUnavailable(str(e)) from e
+
+        stdout = self._new_capture()
+        stderr = self._new_capture()
+        try:
+            returncode = self._stream_process(process, stdout, stderr)
+            self._classify_print_failure(returncode, stdout, stderr)
+        except BaseException:
+            stdout.discard()
+            stderr.discard()
+            raise
+        finally:
+            self._forget(process)
+
+        return self._capture_result(command, returncode, stdout, stderr)
+
+    def _classify_print_failure(
+        self,
+        returncode: int,
+        stdout: StreamCapture,
+        stderr: StreamCapture
+    ) -> None:
+        """
+        失败分类：仅当 print 模式因参数/用法错误而未执行命令时抛出 PrintModeUnavailable
+
+        Args:
+            returncode: 进程退出码
+            stdout: stdout 捕获器
+            stderr: stderr 捕获器
+
+        Raises:
+            PrintModeUnavailable: 命令未被执行，可安全回退
+        """
+        if returncode == 0 or stdout.size:
+            return
+        if self.USAGE_ERROR_PATTERN.search(stderr.tail):
+            raise PrintModeUnavailable(stderr.tail.strip()[:200])
 
     def _run_with_pty_mode(self, command: str) -> Dict:
         """
@@ -248,76 +714,73 @@ class ClaudeExecutor:
             }
 
         process = None
-        output_buffer = []
+        stdout = self._new_capture()
+        stderr = self._new_capture()
 
         try:
             # 使用绝对路径并规范化
             cwd_path = str(self.project_dir.resolve())
 
-            process = subprocess.Popen(
+            process = self._spawn(
                 ['claude'],
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                text=True,
-                cwd=cwd_path,
-                encoding='utf-8',
-                errors='replace'
+                cwd=cwd_path
             )
 
             logger.info(f"Claude 已启动 (PID: {process.pid})")
 
-            # 发送命令
-            stdout, stderr = process.communicate(
-                input=(command + '\n'),
-                timeout=self.timeout
+            # 发送命令并流式读取输出
+            returncode = self._stream_process(
+                process, stdout, stderr,
+                stdin_data=(command + '\n').encode('utf-8')
             )
-
-            output = stdout or stderr
-            summary = self._extract_summary(output)
-            self._save_summary(summary, command)
-
-            return {
-                "success": process.returncode == 0 or bool(output),
-                "output": output,
-                "summary": summary,
-                "error": None
-            }
+            return self._capture_result(command, returncode, stdout, stderr)
 
         except subprocess.TimeoutExpired:
-            if process:
-                process.kill()
             logger.error(f"执行超时 ({self.timeout}s)")
+            output = stdout.tail
+            stdout.discard()
+            stderr.discard()
             return {
                 "success": False,
-                "output": ''.join(output_buffer),
+                "output": output,
                 "summary": "",
                 "error": f"执行超时 ({self.timeout}s)"
             }
         except Exception as e:
             logger.error(f"Windows模式执行失败: {e}")
+            output = stdout.tail
+            stdout.discard()
+            stderr.discard()
             return {
                 "success": False,
-                "output": ''.join(output_buffer),
+                "output": output,
                 "summary": "",
                 "error": str(e)
             }
+        finally:
+            self._forget(process)
 
     def _run_unix_pty_mode(self, command: str) -> Dict:
         """
         Unix/Linux: 使用 PTY 伪终端模式执行
+
+        基于 selectors 事件驱动读取：检测到提示符后立即发送命令，
+        仅在有输出或空闲超时时唤醒；输出经 StreamCapture 增量解码、清理并按需落盘。
         """
         import pty
-        import select
 
         master_fd = slave_fd = None
         process = None
-        output_buffer = []
+        sel = None
+        capture = self._new_capture()
 
         try:
             master_fd, slave_fd = pty.openpty()
 
-            process = subprocess.Popen(
+            process = self._spawn(
                 ['claude'],
                 stdin=slave_fd,
                 stdout=slave_fd,
@@ -330,74 +793,76 @@ class ClaudeExecutor:
             slave_fd = None
 
             logger.info(f"Claude 已启动 (PID: {process.pid})")
-            time.sleep(1)
+
+            sel = selectors.DefaultSelector()
+            sel.register(master_fd, selectors.EVENT_READ)
+            deadline = time.monotonic() + self.timeout
+
+            # 等待提示符就绪（代替固定 sleep）
+            state = self._pty_pump(
+                sel, master_fd, capture, process,
+                deadline=min(deadline, time.monotonic() + self.PTY_STARTUP_TIMEOUT),
+                until=self._pty_prompt_ready
+            )
+            if state != "ready":
+                logger.info(f"未检测到提示符 ({state})，直接发送命令")
 
             os.write(master_fd, (command + '\n').encode('utf-8'))
             logger.info("命令已发送")
 
-            idle_count = 0
-            MAX_IDLE_ITERATIONS = 50  # PTY模式最大空闲迭代次数
-            start_time = time.time()
+            state = self._pty_pump(
+                sel, master_fd, capture, process,
+                deadline=deadline,
+                idle_timeout=self.pty_idle_timeout
+            )
 
-            while (time.time() - start_time) < self.timeout:
-                if process.poll() is not None:
-                    logger.info(f"进程已退出 (退出码: {process.returncode})")
-                    break
-
-                if select.select([master_fd], [], [], 0.1)[0]:
-                    try:
-                        data = os.read(master_fd, 4096)
-                        if data:
-                            output_buffer.append(data.decode('utf-8', errors='replace'))
-                            idle_count = 0
-                    except OSError:
-                        break
-                else:
-                    idle_count += 1
-
-                if idle_count >= MAX_IDLE_ITERATIONS:
-                    logger.info("检测到空闲，发送 EOF 退出")
-                    os.write(master_fd, b'\x04')
-                    time.sleep(0.5)
-                    try:
-                        while select.select([master_fd], [], [], 0.5)[0]:
-                            data = os.read(master_fd, 4096)
-                            if not data:
-                                break
-                            output_buffer.append(data.decode('utf-8', errors='replace'))
-                    except OSError:
-                        pass
-                    break
-
-            full_output = ''.join(output_buffer)
-            summary = self._extract_summary(full_output)
+            if state == "idle":
+                logger.info("检测到空闲，发送 EOF 退出")
+                os.write(master_fd, b'\x04')
+                self._pty_pump(
+                    sel, master_fd, capture, process,
+                    deadline=time.monotonic() + self.PTY_DRAIN_TIMEOUT,
+                    idle_timeout=0.5
+                )
+            elif state in ("exit", "eof"):
+                logger.info(f"进程已退出 (退出码: {process.poll()})")
+
+            capture.close()
+            full_output = capture.text()
+            summary = self._extract_summary(capture.tail if capture.spilled else full_output)
             self._save_summary(summary, command)
 
             return {
                 "success": True,
                 "output": full_output,
                 "summary": summary,
-                "error": None
+                "error": None,
+                "output_file": str(capture.spill_path) if capture.spilled else None
             }
 
         except Exception as e:
             logger.error(f"PTY模式执行失败: {e}")
+            output = capture.tail
+            capture.discard()
             return {
                 "success": False,
-                "output": ''.join(output_buffer),
+                "output": output,
                 "summary": "",
                 "error": str(e)
             }
         finally:
+            if sel is not None:
+                sel.close()
             if process and process.poll() is None:
-                process.terminate()
+                self._signal_process(process, signal.SIGTERM)
                 try:
                     process.wait(timeout=3)
                 except subprocess.TimeoutExpired:
                     logger.debug("进程终止超时,强制结束")
-                    process.kill()
+                    self._signal_process(process, getattr(signal, "SIGKILL", signal.SIGTERM))
                 except ProcessLookupError:
                     logger.debug("进程已结束")
+            self._forget(process)
             if master_fd is not None:
                 try:
                     os.close(master_fd)
@@ -409,20 +874,72 @@ class ClaudeExecutor:
                 except OSError as e:
                     logger.debug(f"关闭 slave_fd 时出错: {e}")
 
-    def _strip_ansi(self, text: str) -> str:
-        """移除 ANSI 转义序列"""
-        ansi_csi = re.compile(r'\x1b\[[0-?]*[ -/]*[@-~]')
-        ansi_osc = re.compile(r'\x1b\][^\x07\x1b]*[\x07\x1b\\]')
+    def _pty_pump(
+        self,
+        sel: selectors.BaseSelector,
+        master_fd: int,
+        capture: StreamCapture,
+        process: subprocess.Popen,
+        deadline: float,
+        idle_timeout: Optional[float] = None,
+        until: Optional[Callable[[StreamCapture], bool]] = None
+    ) -> str:
+        """
+        读取 PTY 输出直到满足停止条件
+
+        Args:
+            sel: 已注册 master_fd 的选择器
+            master_fd: PTY 主端文件描述符
+            capture: 输出捕获器
+            process: Claude 进程
+            deadline: 绝对截止时间（time.monotonic）
+            idle_timeout: 无输出多久返回 "idle"，None 表示不限制
+            until: 每次读到数据后调用，返回True时以 "ready" 结束
+
+        Returns:
+            结束原因: "ready" / "idle" / "exit" / "eof" / "timeout"
+        """
+        last_data = time.monotonic()
+
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                return "timeout"
 
-        text = ansi_csi.sub('', text)
-        text = ansi_osc.sub('', text)
+            wait = deadline - now
+            if idle_timeout is not None:
+                idle_left = last_data + idle_timeout - now
+                if idle_left <= 0:
+                    return "idle"
+                wait = min(wait, idle_left)
 
-        cleaned = []
-        for char in text:
-            code = ord(char)
-            if code >= 32 or code in (9, 10):
-                cleaned.append(char)
-        return ''.join(cleaned)
+            if not sel.select(timeout=wait):
+                if process.poll() is not None:
+                    return "exit"
+                continue
+
+            try:
+                data = os.read(master_fd, self.PTY_READ_SIZE)
+            except OSError:
+                # Linux 上子进程关闭 PTY 后读取主端会返回 EIO
+                return "eof"
+            if not data:
+                return "eof"
+
+            capture.feed(data)
+            last_data = time.monotonic()
+
+            if until and until(capture):
+                return "ready"
+
+    def _pty_prompt_ready(self, capture: StreamCapture) -> bool:
+        """检查最近的输出中是否出现 Claude 提示符"""
+        tail = capture.tail[-4096:]
+        return any(marker in tail for marker in self.PTY_READY_MARKERS)
+
+    def _strip_ansi(self, text: str) -> str:
+        """移除 ANSI 转义序列"""
+        return strip_ansi(text)
 
     def _extract_summary(self, output: str) -> str:
         """
@@ -450,7 +967,7 @@ class ClaudeExecutor:
             return clean_output.strip()
 
         summary = clean_output[summary_start:].strip()
-        summary = re.sub(r'\n{3,}', '\n\n', summary)
+        summary = _BLANK_LINES_RE.sub('\n\n', summary)
 
         return summary
 
@@ -469,8 +986,12 @@ Claude Code 任务总结
 {'=' * 60}
 """
 
-        with open(self.output_file, 'w', encoding='utf-8') as f:
-            f.write(content)
+        # 多个 worker 共享同一文件：加锁后写临时文件再原子替换，读者不会看到半截内容
+        with self._summary_lock:
+            tmp_path = self.output_file.with_name(self.output_file.name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, self.output_file)
 
         logger.info(f"总结已保存到: {self.output_file}")
 
@@ -80,6 +80,14 @@ class RateLimiter:
 class EmailParser:
     """邮件解析器"""
 
+    # 主题中的优先级标记：[urgent] [high] [low] 或 [P2] / [priority:-1]，数值越大越先执行
+    PRIORITY_TAGS = {"urgent": 2, "high": 1, "low": -1}
+    PRIORITY_TAG_RE = re.compile(
+        r"\[\s*(?:(urgent|high|low)|(?:p|priority)\s*[:=]?\s*([+-]?\d+))\s*\]",
+        re.IGNORECASE
+    )
+    MAX_PRIORITY = 9
+
     def __init__(self, whitelist: Optional[Sequence[str]] = None):
         """
         初始化解析器
@@ -175,6 +183,46 @@ class EmailParser:
         subject = msg.get("Subject", "")
         return self._decode_header(subject)
 
+    def extract_priority(self, subject: str) -> int:
+        """
+        从主题中提取优先级标记
+
+        Args:
+            subject: 解码后的主题
+
+        Returns:
+            优先级（默认0，范围 ±MAX_PRIORITY）
+        """
+        match = self.PRIORITY_TAG_RE.search(subject or "")
+        if not match:
+            return 0
+
+        if match.group(1):
+            priority = self.PRIORITY_TAGS[match.group(1).lower()]
+        else:
+            priority = int(match.group(2))
+        return max(-self.MAX_PRIORITY, min(self.MAX_PRIORITY, priority))
+
+    def parse_headers(self, raw_headers: bytes) -> Dict[str, Any]:
+        """
+        仅解析邮件头（用于下载正文前的白名单筛选）
+
+        Args:
+            raw_headers: 原始邮件头字节
+
+        Returns:
+            包含发件人、Message-ID、主题与白名单判定的字典
+        """
+        msg = email.message_from_bytes(raw_headers)
+        sender = self.extract_sender(msg)
+
+        return {
+            "sender": sender,
+            "message_id": self.extract_message_id(msg),
+            "subject": self.extract_subject(msg),
+            "is_whitelisted": self.is_sender_whitelisted(sender),
+        }
+
     def parse_email(self, raw_email: bytes) -> Dict[str, Any]:
         """
         解析原始邮件字节
@@ -197,6 +245,7 @@ class EmailParser:
             "message_id": message_id,
             "subject": subject,
             "command": command,
+            "priority": self.extract_priority(subject),
             "is_whitelisted": self.is_sender_whitelisted(sender),
         }
 
@@ -7,17 +7,100 @@ IMAP邮件接收器
 import imaplib
 import email
 import logging
+import re
 import select
+import ssl
 import time
-from typing import List, Optional
+from typing import Dict, List, Optional, Sequence
 from email.message import Message
 
 logger = logging.getLogger(__name__)
 
+_FETCH_UID_RE = re.compile(rb"UID (\d+)")
+_FETCH_SIZE_RE = re.compile(rb"RFC822\.SIZE (\d+)")
+_IDLE_NEW_MAIL_RE = re.compile(rb"^\* (?:\d+ EXISTS|[1-9]\d* RECENT)", re.IGNORECASE)
+
+
+def parse_fetch_response(data: list) -> List[Dict]:
+    """
+    解析 UID FETCH 响应
+
+    imaplib 将每封邮件返回为 (前缀, 字面量) 元组，其后跟随包含剩余数据项的字节串；
+    UID 与 RFC822.SIZE 可能出现在前缀或尾部，两处都需要检查。
+
+    Args:
+        data: imaplib 返回的数据列表
+
+    Returns:
+        [{'uid': bytes, 'size': Optional[int], 'literal': bytes}, ...]
+    """
+    records: List[Dict] = []
+    current: Optional[Dict] = None
+
+    for item in data:
+        if isinstance(item, tuple):
+            current = {"uid": None, "size": None, "literal": item[1]}
+            records.append(current)
+            meta = item[0]
+        elif isinstance(item, bytes) and current is not None:
+            meta = item
+        else:
+            continue
+
+        uid_match = _FETCH_UID_RE.search(meta)
+        if uid_match and current["uid"] is None:
+            current["uid"] = uid_match.group(1)
+        size_match = _FETCH_SIZE_RE.search(meta)
+        if size_match and current["size"] is None:
+            current["size"] = int(size_match.group(1))
+
+    return [record for record in records if record["uid"] is not None]
+
+
+def build_uid_set(uids: Sequence[bytes]) -> str:
+    """
+    将UID列表压缩为IMAP序列集（如 "3:5,9"）
+
+    Args:
+        uids: UID列表
+
+    Returns:
+        序列集字符串
+    """
+    numbers = sorted({int(uid) for uid in uids})
+    ranges = []
+    start = prev = None
+    for n in numbers:
+        if start is None:
+            start = prev = n
+        elif n == prev + 1:
+            prev = n
+        else:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+            start = prev = n
+    if start is not None:
+        ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(ranges)
+
 
 class EmailReceiver:
     """IMAP邮件接收器"""
 
+    # 单条 FETCH/STORE 命令包含的最大邮件数
+    BATCH_SIZE = 100
+
+    # 第一阶段只获取判定所需的头部（含解析正文所需的 MIME 头）
+    HEADER_FIELDS = "FROM MESSAGE-ID SUBJECT CONTENT-TYPE CONTENT-TRANSFER-ENCODING MIME-VERSION"
+    # 第二阶段正文获取上限（字节），命令正文位于最前，附件不会被下载
+    BODY_FETCH_LIMIT = 256 * 1024
+
+    # RFC 2177 建议客户端至少每 29 分钟重新发起一次 IDLE
+    IDLE_MAX_DURATION = 29 * 60
+    # IDLE 期间检查停止信号的间隔（只是本地 select 超时，不产生网络流量）
+    IDLE_CHECK_INTERVAL = 1.0
+    # 等待服务器应答 IDLE / DONE 的超时（秒）
+    IDLE_RESPONSE_TIMEOUT = 30
+
     def __init__(self, server: str, port: int, username: str, password: str):
         """
         初始化接收器
@@ -35,6 +118,13 @@ class EmailReceiver:
         self.client: Optional[imaplib.IMAP4_SSL] = None
         self._idle_supported = False
         self._connected = False
+        # 当前选中邮箱的 UIDVALIDITY，变化时已保存的 UID 水位失效
+        self.uidvalidity: Optional[int] = None
+
+    @property
+    def mailbox_key(self) -> str:
+        """当前邮箱的唯一标识（用于持久化 UID 水位）"""
+        return f"{self.username}@{self.server}/INBOX"
 
     def connect(self) -> bool:
         """
@@ -84,6 +174,8 @@ class EmailReceiver:
 
         try:
             self.client.select("INBOX")
+            _, data = self.client.response("UIDVALIDITY")
+            self.uidvalidity = int(data[0]) if data and data[0] else None
             return True
         except imaplib.IMAP4.error as e:
             logger.error(f"选择收件箱失败: {e}")
@@ -99,28 +191,37 @@ class EmailReceiver:
         if not self.client:
             return False
 
-        # 同时检查服务器能力和客户端（imaplib）是否支持IDLE
-        server_supports = "IDLE" in self.client.capabilities
-        client_supports = hasattr(self.client, 'idle')
-        self._idle_supported = server_supports and client_supports
-        logger.info(f"IDLE支持: {self._idle_supported} (服务器={server_supports}, 客户端={client_supports})")
+        # IDLE 由本模块直接在协议层实现，只需服务器支持
+        self._idle_supported = "IDLE" in self.client.capabilities
+        logger.info(f"IDLE支持: {self._idle_supported}")
         return self._idle_supported
 
-    def search_unread(self) -> List[bytes]:
+    def search_unread(self, since_uid: Optional[int] = None) -> List[bytes]:
         """
-        搜索未读邮件
+        搜索未读邮件（基于UID）
+
+        Args:
+            since_uid: 已处理的最大UID水位，提供时只搜索 UID > since_uid 的邮件
 
         Returns:
-            未读邮件UID列表
+            未读邮件UID列表（升序）
         """
         if not self.client:
             return []
 
         try:
-            status, messages = self.client.search(None, "UNSEEN")
+            if since_uid is None:
+                status, messages = self.client.uid("SEARCH", None, "UNSEEN")
+            else:
+                status, messages = self.client.uid("SEARCH", None, f"UID {since_uid + 1}:*", "UNSEEN")
             if status != "OK" or not messages[0]:
                 return []
-            return messages[0].split()
+
+            uids = messages[0].split()
+            # "n:*" 在没有更大UID时仍会返回当前最大UID，需要过滤
+            if since_uid is not None:
+                uids = [uid for uid in uids if int(uid) > since_uid]
+            return sorted(uids, key=int)
         except imaplib.IMAP4.error as e:
             logger.error(f"搜索邮件失败: {e}")
             return []
@@ -139,7 +240,7 @@ class EmailReceiver:
             return None
 
         try:
-            status, data = self.client.fetch(uid, "(RFC822)")
+            status, data = self.client.uid("FETCH", uid, "(RFC822)")
             if status != "OK":
                 return None
 
@@ -151,6 +252,107 @@ class EmailReceiver:
             logger.error(f"获取邮件失败: {e}")
             return None
 
+    def fetch_many(self, uids: Sequence[bytes]) -> Dict[bytes, bytes]:
+        """
+        批量获取邮件内容（每 BATCH_SIZE 封一条 UID FETCH）
+
+        Args:
+            uids: 邮件UID列表
+
+        Returns:
+            {UID: 邮件原始字节}，获取失败的邮件不在结果中
+        """
+        return {
+            record["uid"]: record["literal"]
+            for record in self._fetch_batched(uids, "(RFC822)")
+        }
+
+    def fetch_headers_many(self, uids: Sequence[bytes]) -> Dict[bytes, Dict]:
+        """
+        第一阶段：批量获取邮件头部与大小（不下载正文，不标记已读）
+
+        Args:
+            uids: 邮件UID列表
+
+        Returns:
+            {UID: {'size': Optional[int], 'header': bytes}}
+        """
+        query = f"(RFC822.SIZE BODY.PEEK[HEADER.FIELDS ({self.HEADER_FIELDS})])"
+        return {
+            record["uid"]: {"size": record["size"], "header": record["literal"]}
+            for record in self._fetch_batched(uids, query)
+        }
+
+    def fetch_bodies_many(self, uids: Sequence[bytes]) -> Dict[bytes, bytes]:
+        """
+        第二阶段：批量获取正文（最多 BODY_FETCH_LIMIT 字节，不标记已读）
+
+        Args:
+            uids: 已通过筛选的邮件UID列表
+
+        Returns:
+            {UID: 正文字节}
+        """
+        query = f"(BODY.PEEK[TEXT]<0.{self.BODY_FETCH_LIMIT}>)"
+        return {
+            record["uid"]: record["literal"]
+            for record in self._fetch_batched(uids, query)
+        }
+
+    def _fetch_batched(self, uids: Sequence[bytes], query: str) -> List[Dict]:
+        """
+        按 BATCH_SIZE 分批执行 UID FETCH
+
+        Args:
+            uids: 邮件UID列表
+            query: FETCH 数据项
+
+        Returns:
+            parse_fetch_response 的合并结果
+        """
+        if not self.client or not uids:
+            return []
+
+        records: List[Dict] = []
+        for i in range(0, len(uids), self.BATCH_SIZE):
+            batch = uids[i:i + self.BATCH_SIZE]
+            try:
+                status, data = self.client.uid("FETCH", build_uid_set(batch), query)
+                if status != "OK":
+                    logger.error(f"批量获取邮件失败: {status}")
+                    continue
+                records.extend(parse_fetch_response(data))
+            except imaplib.IMAP4.error as e:
+                logger.error(f"批量获取邮件失败: {e}")
+
+        return records
+
+    def mark_many_as_read(self, uids: Sequence[bytes]) -> bool:
+        """
+        批量标记邮件为已读（每 BATCH_SIZE 封一条 UID STORE）
+
+        Args:
+            uids: 邮件UID列表
+
+        Returns:
+            是否全部成功
+        """
+        if not self.client:
+            return False
+        if not uids:
+            return True
+
+        ok = True
+        for i in range(0, len(uids), self.BATCH_SIZE):
+            batch = uids[i:i + self.BATCH_SIZE]
+            try:
+                status, _ = self.client.uid("STORE", build_uid_set(batch), "+FLAGS.SILENT", "(\\Seen)")
+                ok = ok and status == "OK"
+            except imaplib.IMAP4.error as e:
+                logger.error(f"批量标记已读失败: {e}")
+                ok = False
+        return ok
+
     def mark_as_read(self, uid: bytes) -> bool:
         """
         标记邮件为已读
@@ -165,43 +367,157 @@ class EmailReceiver:
             return False
 
         try:
-            self.client.store(uid, "+FLAGS", "\\Seen")
+            self.client.uid("STORE", uid, "+FLAGS", "\\Seen")
             return True
         except imaplib.IMAP4.error as e:
             logger.error(f"标记已读失败: {e}")
             return False
 
-    def idle_wait(self, timeout: int = 5, shutdown_check=None) -> bool:
+    def idle_wait(self, timeout: int = IDLE_MAX_DURATION, shutdown_check=None) -> bool:
         """
-        IDLE模式等待新邮件（使用上下文管理器）
+        IDLE模式等待新邮件
+
+        保持同一个 IDLE 会话，直到服务器推送 EXISTS、达到超时或收到停止信号；
+        期间没有任何轮询流量。
 
         Args:
-            timeout: 单次等待超时时间（秒）
+            timeout: 最长等待时间（秒），不超过 IDLE_MAX_DURATION
             shutdown_check: 停止检查回调函数，返回True时中断等待
 
         Returns:
-            是否成功完成等待
+            True 表示正常结束（有新邮件或到时），False 表示连接异常或被中断
         """
         if not self.client or not self._idle_supported:
             return False
 
-        try:
-            # 使用 imaplib 的上下文管理器方式
-            with self.client.idle(duration=timeout) as idler:
-                for typ, data in idler:
-                    # 收到服务器推送或超时
-                    if shutdown_check and shutdown_check():
-                        logger.debug("IDLE 被中断（收到停止信号）")
-                        break
-            logger.debug("IDLE 等待完成")
+        client = self.client
+        timeout = min(timeout, self.IDLE_MAX_DURATION)
+
+        # 前一轮 SEARCH/FETCH/STORE 期间服务器推送的 EXISTS 已被 imaplib 收下，
+        # 不会再出现在 IDLE 期间，必须先检查，否则新邮件要等到 IDLE 超时才被处理
+        if self._take_new_mail(client):
+            logger.debug("IDLE 前已有新邮件通知，跳过等待")
             return True
-        except imaplib.IMAP4.abort:
-            logger.warning("IDLE连接中断")
+
+        try:
+            tag = client._new_tag()
+            client.send(tag + b" IDLE\r\n")
+
+            # 继续应答之前可能先收到未读取的 untagged 响应
+            new_mail = False
+            while True:
+                line = self._idle_readline(client, self.IDLE_RESPONSE_TIMEOUT)
+                if line is None or line.startswith(tag):
+                    logger.warning(f"服务器拒绝IDLE，改用轮询: {line!r}")
+                    self._idle_supported = False
+                    return False
+                if line.startswith(b"+"):
+                    break
+                if line.startswith(b"* BYE"):
+                    raise imaplib.IMAP4.abort(line.decode(errors="replace"))
+                new_mail = new_mail or bool(_IDLE_NEW_MAIL_RE.match(line))
+
+            reason = "新邮件" if new_mail else "超时"
+            deadline = time.monotonic() + timeout
+            while not new_mail:
+                if shutdown_check and shutdown_check():
+                    reason = "收到停止信号"
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                line = self._idle_readline(client, min(self.IDLE_CHECK_INTERVAL, remaining))
+                if line is None:
+                    continue
+                if line.startswith(b"* BYE"):
+                    raise imaplib.IMAP4.abort(line.decode(errors="replace"))
+                if _IDLE_NEW_MAIL_RE.match(line):
+                    reason = "新邮件"
+                    break
+
+            # 结束 IDLE，读取到本次 IDLE 的标记响应为止
+            client.send(b"DONE\r\n")
+            while True:
+                line = self._idle_readline(client, self.IDLE_RESPONSE_TIMEOUT)
+                if line is None:
+                    raise imaplib.IMAP4.abort("等待IDLE结束响应超时")
+                if line.startswith(tag):
+                    break
+
+            logger.debug(f"IDLE 等待结束: {reason}")
+            return reason != "收到停止信号"
+        except (imaplib.IMAP4.abort, OSError) as e:
+            logger.warning(f"IDLE连接中断: {e}")
+            self._connected = False
             return False
         except Exception as e:
             logger.warning(f"IDLE等待失败: {e}")
             return False
 
+    @staticmethod
+    def _take_new_mail(client) -> bool:
+        """
+        取出并清除 imaplib 已收下的 EXISTS/RECENT 通知
+
+        Returns:
+            是否有新邮件通知
+        """
+        responses = client.untagged_responses
+        exists = responses.pop("EXISTS", None)
+        recent = responses.pop("RECENT", None)
+        return bool(exists) or any(count not in (None, b"0") for count in recent or ())
+
+    @classmethod
+    def _idle_readline(cls, client, wait: float) -> Optional[bytes]:
+        """
+        通过 imaplib 的缓冲读取器读取一行IDLE响应
+
+        缓冲中已有数据时直接读取；否则等待套接字可读，最多等待 wait 秒。
+
+        Args:
+            client: imaplib 客户端
+            wait: 最长等待时间（秒）
+
+        Returns:
+            不含 CRLF 的一行；超时返回 None
+        """
+        end = time.monotonic() + max(wait, 0)
+        readable = False
+        while True:
+            data = cls._peek_buffered(client)
+            if data:
+                line = client.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("服务器关闭了连接")
+                return line.rstrip(b"\r\n")
+            if data == b"" and readable:
+                # 套接字可读但读不到数据：对端已关闭
+                raise imaplib.IMAP4.abort("服务器关闭了连接")
+
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return None
+            readable = bool(select.select([client.sock], [], [], remaining)[0])
+
+    @staticmethod
+    def _peek_buffered(client) -> Optional[bytes]:
+        """
+        非阻塞地查看 imaplib 读缓冲（必要时从套接字补充一次）
+
+        Returns:
+            缓冲中的数据；b"" 表示暂无数据（或连接已关闭），None 表示 SSL 记录尚未完整
+        """
+        sock = client.sock
+        previous = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return client.file.peek(1)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return None
+        finally:
+            sock.settimeout(previous)
+
     def poll_wait(self, interval: int = 30, shutdown_check=None) -> bool:
         """
         轮询等待（降级方案，支持中断）
@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 """
 SMTP邮件发送器
-支持SSL/TLS加密、长内容截断、附件
+支持SSL/TLS加密、长内容截断、压缩附件、会话池
 """
 
 import smtplib
 import email
+import base64
+import gzip
+import io
 import logging
+import os
+import shutil
+import tempfile
+import threading
 import time
+import zipfile
+from collections import deque
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
+from email import encoders
 from typing import Optional
 from datetime import datetime
 
@@ -23,7 +33,33 @@ class EmailSender:
     # 长内容截断阈值
     MAX_BODY_LENGTH = 50000
 
-    def __init__(self, server: str, port: int, username: str, password: str):
+    # 附件压缩：超过阈值（字节）的完整输出按流压缩后再附加
+    DEFAULT_COMPRESSION = "gzip"
+    DEFAULT_COMPRESS_THRESHOLD = 64 * 1024
+    COMPRESS_CHUNK_SIZE = 64 * 1024
+    # 压缩结果超过该字节数时临时文件落盘
+    SPOOL_MAX_SIZE = 1024 * 1024
+    # base64 每行编码的原始字节数（76 字符一行，RFC 2045）
+    BASE64_LINE_BYTES = 57
+
+    # 会话池：最多保留的空闲会话数
+    POOL_SIZE = 2
+    # 空闲超过该秒数的会话在复用前先发 NOOP 检查
+    NOOP_INTERVAL = 15
+    # 空闲超过该秒数的会话直接关闭（服务器通常在几分钟后断开空闲连接）
+    SESSION_IDLE_TIMEOUT = 120
+    # 连接断开时换新会话重试的次数
+    SEND_RETRIES = 1
+
+    def __init__(
+        self,
+        server: str,
+        port: int,
+        username: str,
+        password: str,
+        compression: str = DEFAULT_COMPRESSION,
+        compress_threshold: int = DEFAULT_COMPRESS_THRESHOLD
+    ):
         """
         初始化发送器
 
@@ -32,13 +68,20 @@ class EmailSender:
             port: SMTP端口
             username: 用户名
             password: 密码/授权码
+            compression: 附件压缩格式（gzip / zip / none）
+            compress_threshold: 附件超过该字节数才压缩
         """
         self.server = server
         self.port = port
         self.username = username
         self.password = password
+        self.compression = compression
+        self.compress_threshold = compress_threshold
         self.client: Optional[smtplib.SMTP_SSL] = None
         self._connected = False
+        # 已登录的空闲会话 (client, 上次使用时间)，新的在右侧
+        self._pool: deque = deque()
+        self._pool_lock = threading.Lock()
 
     def connect(self) -> bool:
         """
@@ -71,6 +114,9 @@ class EmailSender:
         try:
             self.client.login(self.username, self.password)
             logger.info(f"SMTP登录成功: {self.username}")
+            # 已验证的会话交给会话池复用
+            self._release(self.client)
+            self.client = None
             return True
         except smtplib.SMTPAuthenticationError as e:
             logger.error(f"SMTP认证失败: {e}")
@@ -82,10 +128,11 @@ class EmailSender:
         subject: str,
         body: str,
         html: bool = False,
-        original_message_id: Optional[str] = None
+        original_message_id: Optional[str] = None,
+        attachment_path: Optional[str] = None
     ) -> bool:
         """
-        发送邮件
+        发送邮件（从会话池取会话，连接断开时换新会话重试一次）
 
         Args:
             to: 收件人邮箱
@@ -93,14 +140,11 @@ class EmailSender:
             body: 邮件正文
             html: 是否为HTML格式
             original_message_id: 原始邮件ID（用于回复）
+            attachment_path: 完整输出文件，提供时代替正文作为附件
 
         Returns:
             发送是否成功
         """
-        if not self.client or not self._connected:
-            logger.error("未连接到服务器")
-            return False
-
         try:
             # 处理长内容
             content, is_truncated = self._prepare_content(body)
@@ -121,29 +165,210 @@ class EmailSender:
             subtype = "html" if html else "plain"
             msg.attach(MIMEText(content, subtype, "utf-8"))
 
-            # 如果内容被截断，添加完整附件
-            if is_truncated:
-                attachment = MIMEApplication(body.encode("utf-8"))
-                filename = f"claude_output_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-                attachment.add_header("Content-Disposition", "attachment", filename=filename)
-                msg.attach(attachment)
+            # 如果内容被截断或提供了完整输出文件，添加完整附件
+            if attachment_path or is_truncated:
+                msg.attach(self._build_attachment(body, attachment_path))
 
-            # 发送
-            self.client.send_message(msg)
+        except OSError as e:
+            logger.error(f"构建邮件失败: {e}")
+            return False
+
+        # 发送：连接层面的失败换新会话重试
+        for attempt in range(self.SEND_RETRIES + 1):
+            try:
+                client = self._acquire()
+            except (smtplib.SMTPException, OSError) as e:
+                logger.error(f"SMTP连接失败: {e}")
+                return False
+
+            try:
+                client.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, OSError) as e:
+                self._close_session(client)
+                if attempt < self.SEND_RETRIES:
+                    logger.warning(f"SMTP会话已断开，重连后重试: {e}")
+                    continue
+                logger.error(f"邮件发送失败: {e}")
+                return False
+            except smtplib.SMTPException as e:
+                # 协议层错误（如收件人被拒），会话本身仍可用
+                self._release(client)
+                logger.error(f"邮件发送失败: {e}")
+                return False
+
+            self._release(client)
             logger.info(f"邮件发送成功: to={to}, subject={subject[:30]}...")
             return True
 
-        except smtplib.SMTPException as e:
-            logger.error(f"邮件发送失败: {e}")
+        return False
+
+    def _build_attachment(self, body: str, attachment_path: Optional[str] = None) -> MIMEApplication:
+        """
+        构建完整输出附件，超过阈值时按配置压缩
+
+        文件按块压缩进 SpooledTemporaryFile（超过 SPOOL_MAX_SIZE 落盘），再按块 base64 编码；
+        内存中只保留编码后的载荷，不会同时持有原始内容、压缩结果与编码结果。
+
+        Args:
+            body: 邮件正文（未提供文件时作为附件内容）
+            attachment_path: 完整输出文件
+
+        Returns:
+            MIME 附件
+        """
+        basename = f"claude_output_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+
+        if attachment_path:
+            size = os.path.getsize(attachment_path)
+            source = open(attachment_path, "rb")
+        else:
+            data = body.encode("utf-8")
+            size = len(data)
+            source = io.BytesIO(data)
+
+        with source:
+            if self.compression == "gzip" and size >= self.compress_threshold:
+                compressed = self._gzip_stream(source)
+                filename, subtype = basename + ".gz", "gzip"
+            elif self.compression == "zip" and size >= self.compress_threshold:
+                compressed = self._zip_stream(source, basename)
+                filename, subtype = basename[:-len(".txt")] + ".zip", "zip"
+            else:
+                compressed = None
+                filename, subtype = basename, "octet-stream"
+
+            if compressed is None:
+                encoded = self._base64_stream(source)
+            else:
+                with compressed:
+                    logger.info(f"附件已压缩: {size} → {compressed.tell()} 字节 ({self.compression})")
+                    compressed.seek(0)
+                    encoded = self._base64_stream(compressed)
+
+        attachment = MIMEApplication(b"", _subtype=subtype, _encoder=encoders.encode_noop)
+        attachment.set_payload(encoded)
+        attachment["Content-Transfer-Encoding"] = "base64"
+        attachment.add_header("Content-Disposition", "attachment", filename=filename)
+        return attachment
+
+    def _base64_stream(self, source) -> str:
+        """按块 base64 编码（块大小为整行，拼接结果与一次性编码相同）"""
+        chunk_size = self.COMPRESS_CHUNK_SIZE // self.BASE64_LINE_BYTES * self.BASE64_LINE_BYTES
+        lines = []
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            lines.append(base64.encodebytes(chunk).decode("ascii"))
+        return "".join(lines)
+
+    def _gzip_stream(self, source) -> tempfile.SpooledTemporaryFile:
+        """按块 gzip 压缩到临时文件，返回的文件位于末尾（tell() 即压缩后大小）"""
+        buffer = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_MAX_SIZE)
+        try:
+            with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as gz:
+                shutil.copyfileobj(source, gz, self.COMPRESS_CHUNK_SIZE)
+        except Exception:
+            buffer.close()
+            raise
+        return buffer
+
+    def _zip_stream(self, source, member_name: str) -> tempfile.SpooledTemporaryFile:
+        """按块写入 zip 归档（单个成员）到临时文件，返回的文件位于末尾"""
+        buffer = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_MAX_SIZE)
+        try:
+            with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                with archive.open(member_name, "w") as member:
+                    shutil.copyfileobj(source, member, self.COMPRESS_CHUNK_SIZE)
+        except Exception:
+            buffer.close()
+            raise
+        return buffer
+
+    def _open_session(self) -> smtplib.SMTP_SSL:
+        """
+        建立并登录一个新会话
+
+        Returns:
+            已登录的 SMTP 客户端
+        """
+        client = smtplib.SMTP_SSL(self.server, self.port, timeout=30)
+        try:
+            client.login(self.username, self.password)
+        except Exception:
+            self._close_session(client)
+            raise
+        self._connected = True
+        logger.debug(f"新建SMTP会话: {self.server}:{self.port}")
+        return client
+
+    def _acquire(self) -> smtplib.SMTP_SSL:
+        """
+        从会话池取出可用会话，池中没有健康会话时新建
+
+        Returns:
+            已登录的 SMTP 客户端
+        """
+        while True:
+            with self._pool_lock:
+                if not self._pool:
+                    break
+                client, last_used = self._pool.pop()
+
+            idle = time.monotonic() - last_used
+            if idle > self.SESSION_IDLE_TIMEOUT:
+                logger.debug(f"SMTP会话空闲 {idle:.0f} 秒，关闭")
+                self._close_session(client)
+                continue
+            if idle > self.NOOP_INTERVAL and not self._is_alive(client):
+                logger.debug("SMTP会话 NOOP 检查失败，丢弃")
+                self._close_session(client)
+                continue
+            return client
+
+        return self._open_session()
+
+    def _release(self, client: smtplib.SMTP_SSL) -> None:
+        """
+        归还会话，池已满时关闭
+
+        Args:
+            client: 使用完毕的 SMTP 客户端
+        """
+        with self._pool_lock:
+            if len(self._pool) < self.POOL_SIZE:
+                self._pool.append((client, time.monotonic()))
+                return
+        self._close_session(client)
+
+    @staticmethod
+    def _is_alive(client: smtplib.SMTP_SSL) -> bool:
+        """通过 NOOP 检查会话是否仍可用"""
+        try:
+            code, _ = client.noop()
+            return code == 250
+        except (smtplib.SMTPException, OSError):
             return False
 
+    @staticmethod
+    def _close_session(client: smtplib.SMTP_SSL) -> None:
+        """关闭会话，忽略已断开连接上的错误"""
+        try:
+            client.quit()
+        except (smtplib.SMTPException, OSError):
+            try:
+                client.close()
+            except OSError:
+                pass
+
     def send_reply(
         self,
         to: str,
         subject: str,
         body: str,
         original_message_id: str,
-        html: bool = False
+        html: bool = False,
+        attachment_path: Optional[str] = None
     ) -> bool:
         """
         回复邮件
@@ -154,6 +379,7 @@ class EmailSender:
             body: 回复正文
             original_message_id: 原始邮件ID
             html: 是否为HTML格式
+            attachment_path: 完整输出文件
 
         Returns:
             发送是否成功
@@ -162,7 +388,7 @@ class EmailSender:
         if not subject.startswith("Re:") and not subject.startswith("RE:"):
             subject = f"Re: {subject}"
 
-        return self.send_email(to, subject, body, html, original_message_id)
+        return self.send_email(to, subject, body, html, original_message_id, attachment_path)
 
     def _prepare_content(self, content: str) -> tuple:
         """
@@ -200,7 +426,13 @@ class EmailSender:
                 logger.warning(f"断开SMTP连接时出错: {e}")
             finally:
                 self.client = None
-                self._connected = False
+
+        with self._pool_lock:
+            sessions, self._pool = list(self._pool), deque()
+        for client, _ in sessions:
+            self._close_session(client)
+
+        self._connected = False
         return True
 
     def reconnect(self) -> bool:
@@ -5,8 +5,10 @@
 """
 
 import signal
+import sqlite3
 import sys
 import logging
+import threading
 import time
 import os
 from pathlib import Path
@@ -19,6 +21,7 @@ from mail.parser import EmailParser
 from mail.receiver import EmailReceiver
 from mail.sender import EmailSender
 from queue.manager import CommandQueue
+from queue.archive import CommandArchive
 from core.executor import ClaudeExecutor
 
 # 配置日志
@@ -36,17 +39,51 @@ logger = logging.getLogger(__name__)
 class EmailCommandApp:
     """邮件命令应用"""
 
+    # worker 在队列为空时的最长等待（秒）；同进程入队会立即唤醒，超时只用于兜底
+    WORKER_IDLE_WAIT = 5
+
+    # 发送线程每批处理的发件箱邮件数与空闲时的最长等待（秒）
+    OUTBOX_BATCH_SIZE = 10
+    SENDER_IDLE_WAIT = 30
+
+    # 执行结果写入数据库失败时的最长重试间隔（秒）
+    PERSIST_RETRY_MAX = 30
+
     def __init__(self):
         """初始化应用"""
         self.settings = get_settings()
         self.running = False
         self.shutdown_requested = False
 
+        # 后台线程：IMAP接收、N个执行worker、SMTP发送、租约维护
+        self._threads = []
+        self._workers = []
+        self._outbox_cond = threading.Condition()
+        self._outbox_pending = False
+
+        # 执行中的命令 {cmd_id: worker_id}，由租约线程定期续约
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._lease_seconds = self.settings.get_lease_seconds()
+
+        # IMAP UID 水位 (UIDVALIDITY, last_uid)，持久化在队列数据库中
+        self._watermark = None
+
         # 初始化组件
-        self.queue = CommandQueue(self.settings.get_db_path())
+        self.queue = CommandQueue(
+            self.settings.get_db_path(),
+            dedup_window=self.settings.get_dedup_window()
+        )
+        # 过期命令的冷存储归档，未启用时保留期清理直接删除
+        self.archive = None
+        if self.settings.get_archive_enabled():
+            self.archive = CommandArchive(CommandArchive.path_for(self.queue.db_path))
+        for sender, weight in self.settings.get_sender_weights().items():
+            self.queue.set_sender_weight(sender, weight)
         self.executor = ClaudeExecutor(
             output_file=Path(self.settings.get_output_file()),
-            timeout=self.settings.get_claude_timeout()
+            timeout=self.settings.get_claude_timeout(),
+            pty_idle_timeout=self.settings.get_pty_idle_timeout()
         )
         self.executor.set_project_dir(self.settings.get_project_dir())
 
@@ -66,7 +103,9 @@ class EmailCommandApp:
             server=smtp_config["server"],
             port=smtp_config["port"],
             username=smtp_config["username"],
-            password=smtp_config["password"]
+            password=smtp_config["password"],
+            compression=self.settings.get_attachment_compression(),
+            compress_threshold=self.settings.get_attachment_compress_threshold()
         )
 
         self.parser = EmailParser(whitelist=self.settings.get_whitelist())
@@ -91,23 +130,123 @@ class EmailCommandApp:
             logger.error("邮件服务连接失败，退出")
             return
 
-        # 重置卡住的命令
-        stuck_count = self.queue.reset_stuck_commands()
-        if stuck_count > 0:
-            logger.info(f"重置了 {stuck_count} 个卡住的命令")
+        # 启动时探测一次 claude CLI 能力，执行时复用
+        self.executor.probe_capabilities()
 
         self.running = True
+        self._start_threads()
         logger.info("系统启动完成，开始监听邮件...")
 
-        # 主循环
+        # 主线程只负责等待停机信号，实际工作在后台线程完成
         try:
             while self.running and not self.shutdown_requested:
-                self._loop_iteration()
+                time.sleep(0.5)
         except KeyboardInterrupt:
             logger.info("用户中断")
         finally:
             self._shutdown()
 
+    def _start_threads(self):
+        """启动接收线程、执行 worker 池和发送线程"""
+        worker_count = self.settings.get_worker_count()
+
+        self._threads = [
+            threading.Thread(target=self._receiver_loop, name="imap-receiver", daemon=True),
+            threading.Thread(target=self._sender_loop, name="smtp-sender", daemon=True),
+            threading.Thread(target=self._lease_loop, name="lease-keeper", daemon=True),
+            threading.Thread(target=self._maintenance_loop, name="db-maintenance", daemon=True),
+        ]
+        self._workers = [
+            threading.Thread(target=self._worker_loop, name=f"worker-{i + 1}", daemon=True)
+            for i in range(worker_count)
+        ]
+        self._threads.extend(self._workers)
+
+        for thread in self._threads:
+            thread.start()
+
+        logger.info(f"已启动 {worker_count} 个执行 worker")
+
+    def _should_stop(self) -> bool:
+        """后台线程是否应退出"""
+        return self.shutdown_requested or not self.running
+
+    def _receiver_loop(self):
+        """IMAP接收线程主循环"""
+        while not self._should_stop():
+            self._loop_iteration()
+
+    def _lease_loop(self):
+        """
+        租约线程：为执行中的命令续约，并回收过期租约
+
+        续约间隔为租约时长的1/3，崩溃 worker 的命令在一个租约周期内被重新调度。
+        """
+        interval = max(1, self._lease_seconds // 3)
+        while not self._lease_done():
+            try:
+                with self._inflight_lock:
+                    inflight = list(self._inflight.items())
+                for cmd_id, worker_id in inflight:
+                    if not self.queue.heartbeat(cmd_id, worker_id, self._lease_seconds):
+                        logger.warning(f"命令租约续约失败: id={cmd_id}, worker={worker_id}")
+
+                if self.queue.reclaim_expired_leases(self.settings.get_max_retries()):
+                    # 多次过期而放弃的命令已写入失败通知
+                    self._wake_sender()
+            except Exception as e:
+                logger.error(f"租约维护异常: {e}", exc_info=True)
+
+            # 分段休眠以支持快速停机
+            for _ in range(interval):
+                if self._lease_done():
+                    return
+                time.sleep(1)
+
+    def _lease_done(self) -> bool:
+        """停机且没有执行中的命令时租约线程才退出（停机等待期间继续续约）"""
+        if not self._should_stop():
+            return False
+        with self._inflight_lock:
+            return not self._inflight
+
+    def _maintenance_loop(self):
+        """
+        维护线程：按固定间隔执行数据库保留期清理与空间回收
+
+        与接收线程解耦，IDLE 长时间阻塞或轮询间隔变化都不影响执行频率；启动后立即执行一次。
+        """
+        interval = self.settings.get_maintenance_interval()
+        days = self.settings.get_retention_days()
+        while not self._should_stop():
+            try:
+                self.queue.run_maintenance(days=days, archive=self.archive)
+            except Exception as e:
+                logger.error(f"数据库维护异常: {e}", exc_info=True)
+
+            # 分段休眠以支持快速停机
+            for _ in range(interval):
+                if self._should_stop():
+                    return
+                time.sleep(1)
+
+    def _worker_loop(self):
+        """执行 worker 主循环：独立从队列领取命令并执行"""
+        while not self._should_stop():
+            # 先读取序号再认领，认领落空后等待期间的入队通知不会丢失
+            seq = self.queue.work_seq
+            try:
+                processed = self._process_queue()
+            except Exception as e:
+                logger.error(f"worker 异常: {e}", exc_info=True)
+                processed = False
+
+            if not processed and not self._should_stop():
+                # 有延迟重试的命令时，最迟在其到期时醒来
+                due = self.queue.next_due_delay()
+                timeout = self.WORKER_IDLE_WAIT if due is None else min(due, self.WORKER_IDLE_WAIT)
+                self.queue.wait_for_work(seq, timeout)
+
     def _connect_email_services(self) -> bool:
         """连接邮件服务"""
         # IMAP连接
@@ -135,39 +274,29 @@ class EmailCommandApp:
         return True
 
     def _loop_iteration(self):
-        """单次循环迭代"""
+        """接收线程的单次循环迭代（命令执行由 worker 线程负责）"""
         try:
             # 1. 接收新邮件
             self._receive_emails()
 
-            # 2. 处理队列
-            self._process_queue()
-
-            # 3. 等待（IDLE或轮询），支持中断
-            if self.receiver._idle_supported and not self.shutdown_requested:
+            # 2. 等待（IDLE或轮询），支持中断
+            if self.receiver._idle_supported and not self._should_stop():
                 self.receiver.idle_wait(
                     timeout=self.settings.get_idle_timeout(),
-                    shutdown_check=lambda: self.shutdown_requested
+                    shutdown_check=self._should_stop
                 )
-            elif not self.shutdown_requested:
+            elif not self._should_stop():
                 self.receiver.poll_wait(
                     interval=self.settings.get_polling_interval(),
-                    shutdown_check=lambda: self.shutdown_requested
+                    shutdown_check=self._should_stop
                 )
 
-            # 4. 定期清理（每小时）
-            CLEANUP_INTERVAL_SECONDS = 3600  # 每小时清理一次
-            CLEANUP_WINDOW_SECONDS = 30  # 清理检查窗口
-
-            if int(time.time()) % CLEANUP_INTERVAL_SECONDS < CLEANUP_WINDOW_SECONDS:
-                self.queue.delete_old_completed(days=7)
-
         except Exception as e:
             logger.error(f"循环迭代异常: {e}", exc_info=True)
             time.sleep(10)
 
     def _receive_emails(self):
-        """接收邮件并加入队列"""
+        """接收邮件并加入队列（只搜索 UID 水位之后的新邮件）"""
         try:
             # 检查连接状态，必要时重连
             if not self.receiver._connected:
@@ -176,138 +305,450 @@ class EmailCommandApp:
                     return
 
             # 搜索未读邮件
-            unread_uids = self.receiver.search_unread()
-            logger.debug(f"发现 {len(unread_uids)} 封未读邮件")
+            since_uid = self._current_watermark()
+            unread_uids = self.receiver.search_unread(since_uid)
+            logger.debug(f"发现 {len(unread_uids)} 封未读邮件 (UID > {since_uid})")
 
-            for uid in unread_uids:
-                try:
-                    raw_email = self.receiver.fetch_email(uid)
-                    if not raw_email:
-                        continue
-
-                    # 解析邮件
-                    parsed = self.parser.parse_email(raw_email)
-
-                    # 检查白名单
-                    if not parsed["is_whitelisted"]:
-                        logger.warning(f"发件人不在白名单: {parsed['sender']}")
-                        self.receiver.mark_as_read(uid)
-                        continue
-
-                    # 检查命令是否为空
-                    command = parsed["command"].strip()
-                    if not command:
-                        logger.info("邮件正文为空，跳过")
-                        self.receiver.mark_as_read(uid)
-                        continue
-
-                    # 加入队列
-                    cmd_id = self.queue.enqueue(
-                        sender=parsed["sender"],
-                        command=command,
-                        message_id=parsed["message_id"],
-                        subject=parsed["subject"]
-                    )
+            if not unread_uids:
+                return
 
-                    if cmd_id:
-                        logger.info(f"命令已加入队列: id={cmd_id}, from={parsed['sender']}")
+            # 第一阶段：批量获取头部与大小，按白名单和大小策略筛选
+            headers = self.receiver.fetch_headers_many(unread_uids)
 
-                    # 标记为已读
-                    self.receiver.mark_as_read(uid)
+            outcome = {}
+            accepted = []
+            for uid in unread_uids:
+                info = headers.get(uid)
+                if info is None:
+                    outcome[uid] = False
+                elif self._accept_headers(info):
+                    accepted.append(uid)
+                else:
+                    outcome[uid] = True
+
+            # 第二阶段：只下载通过筛选的邮件正文
+            bodies = self.receiver.fetch_bodies_many(accepted)
+            batch_uids = []
+            records = []
+            for uid in accepted:
+                body = bodies.get(uid)
+                if body is None:
+                    outcome[uid] = False
+                    continue
+                ok, record = self._parse_incoming(headers[uid]["header"] + body)
+                outcome[uid] = ok
+                if record is not None:
+                    batch_uids.append(uid)
+                    records.append(record)
+
+            # 整批命令在一个事务内入队；失败时整批保持未读，下次重试
+            if records:
+                cmd_ids = self.queue.enqueue_many(records)
+                for uid in batch_uids:
+                    outcome[uid] = cmd_ids is not None
+                if cmd_ids:
+                    enqueued = sum(1 for cmd_id in cmd_ids if cmd_id)
+                    logger.info(f"本批 {len(records)} 封邮件入队 {enqueued} 条命令")
+
+            handled = []
+            watermark = since_uid
+            advancing = True
+            for uid in unread_uids:
+                if outcome[uid]:
+                    handled.append(uid)
+                    # 水位只推进到连续处理成功的位置，失败的邮件下次仍会被搜索到
+                    if advancing:
+                        watermark = int(uid)
+                else:
+                    advancing = False
 
-                except Exception as e:
-                    logger.error(f"处理邮件失败: {e}")
+            if not self.receiver.mark_many_as_read(handled):
+                # 标记失败的邮件保持未读，不推进水位以便下次重新处理
+                logger.warning("批量标记已读失败，本轮不推进 UID 水位")
+                return
+
+            if watermark is not None and watermark != since_uid:
+                self._save_watermark(watermark)
 
         except Exception as e:
             logger.error(f"接收邮件失败: {e}")
 
-    def _process_queue(self):
-        """处理队列中的命令"""
-        cmd = self.queue.dequeue()
-        if not cmd:
+    def _accept_headers(self, info: dict) -> bool:
+        """
+        根据邮件头和大小判断是否需要下载正文
+
+        Args:
+            info: fetch_headers_many 返回的 {'size', 'header'}
+
+        Returns:
+            True 表示需要下载正文；False 表示跳过（仍会被标记已读）
+        """
+        headers = self.parser.parse_headers(info["header"])
+
+        if not headers["is_whitelisted"]:
+            logger.warning(f"发件人不在白名单: {headers['sender']}")
+            return False
+
+        size = info["size"]
+        max_size = self.settings.get_max_email_size()
+        if size is not None and size > max_size:
+            logger.warning(
+                f"邮件过大，跳过: {headers['sender']} {size} 字节 (上限 {max_size})"
+            )
+            return False
+
+        return True
+
+    def _parse_incoming(self, raw_email: bytes):
+        """
+        解析并校验单封新邮件，生成入队记录
+
+        Args:
+            raw_email: 邮件原始字节
+
+        Returns:
+            (是否已处理完毕, 入队记录)；被跳过的邮件记录为None，
+            处理完毕为False 表示需要下次重试
+        """
+        try:
+            # 解析邮件
+            parsed = self.parser.parse_email(raw_email)
+
+            # 检查白名单
+            if not parsed["is_whitelisted"]:
+                logger.warning(f"发件人不在白名单: {parsed['sender']}")
+                return True, None
+
+            # 检查命令是否为空
+            command = parsed["command"].strip()
+            if not command:
+                logger.info("邮件正文为空，跳过")
+                return True, None
+
+            return True, {
+                "sender": parsed["sender"],
+                "command": command,
+                "message_id": parsed["message_id"],
+                "subject": parsed["subject"],
+                "priority": parsed["priority"],
+            }
+
+        except Exception as e:
+            logger.error(f"处理邮件失败: {e}")
+            return False, None
+
+    def _current_watermark(self):
+        """
+        获取当前邮箱的 UID 水位（UIDVALIDITY 变化时重置）
+
+        Returns:
+            已处理的最大UID，None 表示需要全量搜索未读邮件
+        """
+        uidvalidity = self.receiver.uidvalidity
+        if uidvalidity is None:
+            return None
+
+        if self._watermark is None or self._watermark[0] != uidvalidity:
+            state = self.queue.get_mailbox_watermark(self.receiver.mailbox_key)
+            if state and state["uidvalidity"] == uidvalidity:
+                self._watermark = (uidvalidity, state["last_uid"])
+                logger.info(f"恢复 UID 水位: {state['last_uid']} (UIDVALIDITY={uidvalidity})")
+            else:
+                if state:
+                    logger.warning(f"UIDVALIDITY 已变化 ({state['uidvalidity']} → {uidvalidity})，重新扫描未读邮件")
+                self._watermark = (uidvalidity, None)
+
+        return self._watermark[1]
+
+    def _save_watermark(self, last_uid: int):
+        """持久化 UID 水位"""
+        uidvalidity = self.receiver.uidvalidity
+        if uidvalidity is None:
             return
+        self._watermark = (uidvalidity, last_uid)
+        self.queue.save_mailbox_watermark(self.receiver.mailbox_key, uidvalidity, last_uid)
+
+    def _stop_workers(self, timeout: float) -> None:
+        """
+        停止执行 worker：等待执行中的命令最多 timeout 秒，之后终止子进程并释放租约
+
+        释放租约后才会关闭队列，命令不会在重启后与残留的子进程同时执行。
+
+        Args:
+            timeout: 等待执行中命令完成的最长时间（秒）
+        """
+        with self._inflight_lock:
+            inflight = len(self._inflight)
+        if inflight:
+            logger.info(f"等待 {inflight} 条执行中的命令完成（最多 {timeout} 秒）...")
+
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(timeout=max(0.0, deadline - time.monotonic()))
+
+        if any(worker.is_alive() for worker in self._workers):
+            killed = self.executor.terminate_all()
+            logger.warning(f"等待超时，已终止 {killed} 个 claude 子进程")
+            for worker in self._workers:
+                worker.join(timeout=self.executor.TERMINATE_TIMEOUT + 5)
+
+        # 仍未退出的 worker 所持有的命令由主线程释放租约
+        with self._inflight_lock:
+            remaining, self._inflight = self._inflight, {}
+        for cmd_id, worker_id in remaining.items():
+            try:
+                if self.queue.update_status(cmd_id, CommandQueue.STATUS_PENDING, worker_id=worker_id):
+                    logger.warning(f"释放执行中命令的租约: id={cmd_id}, worker={worker_id}")
+            except sqlite3.Error as e:
+                logger.error(f"释放租约失败，租约到期后命令将重新执行: id={cmd_id}, {e}")
+
+    def _process_queue(self) -> bool:
+        """
+        领取并处理一个队列中的命令（在 worker 线程中运行）
 
-        logger.info(f"开始处理命令: id={cmd['id']}, command={cmd['command'][:50]}...")
+        Returns:
+            是否处理了命令
+        """
+        cmd = self.queue.dequeue(lease_seconds=self._lease_seconds)
+        if not cmd:
+            return False
+
+        with self._inflight_lock:
+            self._inflight[cmd["id"]] = cmd["worker_id"]
+        try:
+            self._handle_command(cmd)
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(cmd["id"], None)
+
+        return True
+
+    def _handle_command(self, cmd: dict):
+        """
+        执行已领取的命令并处理结果
+
+        Args:
+            cmd: 命令字典（含 worker_id 租约归属）
+        """
+        logger.info(
+            f"开始处理命令: id={cmd['id']}, worker={cmd['worker_id']}, "
+            f"command={cmd['command'][:50]}..."
+        )
+        worker_id = cmd["worker_id"]
+        output_file = None
 
         try:
             # 执行命令
             result = self.executor.execute(cmd["command"])
+            output_file = result.get("output_file")
+
+            if result.get("terminated"):
+                # 停机时被中止：放回队列（不计重试次数），重启后重新执行
+                if self.queue.update_status(cmd["id"], CommandQueue.STATUS_PENDING, worker_id=worker_id):
+                    logger.warning(f"命令已放回队列，重启后重新执行: id={cmd['id']}")
+                return
 
             if result["success"]:
-                # 成功
+                # 成功：状态与结果邮件在同一事务内写入（完整输出文件移入发件箱，发送后删除）；
+                # 租约已被回收说明命令已交给其他 worker，两者都不写入
                 output = result["summary"] or result["output"]
-                self.queue.update_status(cmd["id"], CommandQueue.STATUS_COMPLETED, result=output)
-
-                # 发送结果邮件
-                self._send_result(cmd, output, success=True)
+                mail = self._result_mail(cmd, output, success=True, attachment_path=output_file)
+                if self._persist(lambda: self.queue.update_status(
+                    cmd["id"], CommandQueue.STATUS_COMPLETED, result=output,
+                    worker_id=worker_id, outbox=mail
+                )):
+                    output_file = None
+                    self._wake_sender()
 
             else:
-                # 失败
+                # 失败：在一个事务内决定延迟重试或最终失败
                 error_msg = result.get("error", "未知错误")
-                self.queue.update_status(cmd["id"], CommandQueue.STATUS_FAILED, error=error_msg)
+                max_retries = self.settings.get_max_retries()
+                mail = self._result_mail(cmd, error_msg, success=False)
+                outcome = self._persist(lambda: self.queue.retry_or_fail(
+                    cmd["id"], error_msg, max_retries, worker_id=worker_id, outbox=mail
+                ))
+                if outcome is None:
+                    return
 
-                # 检查是否重试
-                if self.queue.should_retry(cmd["id"], self.settings.get_max_retries()):
-                    retry_count = self.queue.increment_retry(cmd["id"])
-                    logger.warning(f"命令执行失败，将重试 ({retry_count}/{self.settings.get_max_retries()}): {error_msg}")
-                    self.queue.update_status(cmd["id"], CommandQueue.STATUS_PENDING)
+                if outcome["retry"]:
+                    logger.warning(
+                        f"命令执行失败，{outcome['delay']:.0f} 秒后重试 "
+                        f"({outcome['retry_count']}/{max_retries}): {error_msg}"
+                    )
                 else:
                     logger.error(f"命令执行失败，已达最大重试次数: {error_msg}")
-                    self._send_result(cmd, error_msg, success=False)
+                    self._wake_sender()
 
+        except sqlite3.Error as e:
+            # 停机时仍无法写入：命令保持 processing，租约到期后重新执行
+            logger.error(f"命令结果未能写入数据库: id={cmd['id']}, {e}")
         except Exception as e:
             logger.error(f"处理命令异常: {e}", exc_info=True)
-            self.queue.update_status(cmd["id"], CommandQueue.STATUS_FAILED, error=str(e))
+            self._persist(lambda: self.queue.update_status(
+                cmd["id"], CommandQueue.STATUS_FAILED, error=str(e), worker_id=worker_id
+            ))
+        finally:
+            self._discard_output_file(output_file)
 
-    def _send_result(self, cmd: dict, content: str, success: bool):
+    def _persist(self, write):
         """
-        发送结果邮件
+        写入命令的执行结果；数据库暂时不可用时退避重试，直到成功或停机
+
+        期间 worker 仍在 _inflight 中由租约线程续约，命令不会被回收后重复执行。
+
+        Args:
+            write: 执行写入的无参函数
+
+        Returns:
+            write 的返回值
+
+        Raises:
+            sqlite3.Error: 停机时仍写入失败
+        """
+        delay = 1
+        while True:
+            try:
+                return write()
+            except sqlite3.Error as e:
+                if self._should_stop():
+                    raise
+                logger.error(f"写入执行结果失败，{delay} 秒后重试: {e}")
+                for _ in range(delay):
+                    if self._should_stop():
+                        break
+                    time.sleep(1)
+                delay = min(delay * 2, self.PERSIST_RETRY_MAX)
+
+    @staticmethod
+    def _discard_output_file(path):
+        """删除执行器生成的完整输出临时文件"""
+        if not path:
+            return
+        try:
+            Path(path).unlink()
+        except OSError as e:
+            logger.debug(f"删除临时输出文件失败: {e}")
+
+    def _result_mail(self, cmd: dict, content: str, success: bool, attachment_path=None) -> dict:
+        """
+        构建结果邮件，随命令状态一起写入持久化发件箱
 
         Args:
             cmd: 命令字典
             content: 结果内容
             success: 是否成功
+            attachment_path: 完整输出文件（移入发件箱目录，发送后删除）
+
+        Returns:
+            发件箱邮件字典
         """
         # 空值检查 - 防止发送空白邮件
         if not content or not content.strip():
-            logger.warning(f"结果内容为空，跳过发送邮件: cmd_id={cmd.get('id')}")
+            logger.warning(f"结果内容为空，使用默认正文: cmd_id={cmd.get('id')}")
             if success:
                 content = "命令执行成功，但未返回任何输出。\n\n命令: " + cmd.get('command', 'N/A')
             else:
                 content = f"命令执行失败，错误信息为空。\n\n命令: {cmd.get('command', 'N/A')}"
 
-        try:
-            # 确保SMTP连接正常
-            if not self.sender._connected:
-                if not self.sender.reconnect():
-                    logger.error("SMTP重连失败，无法发送结果邮件")
-                    return
+        # 构建主题
+        if success:
+            subject = f"✅ Claude执行完成 - {cmd.get('subject', '无主题')[:30]}"
+        else:
+            subject = f"❌ Claude执行失败 - {cmd.get('subject', '无主题')[:30]}"
+
+        return {
+            "recipient": cmd["sender"],
+            "subject": subject,
+            "body": content,
+            "in_reply_to": cmd.get("message_id"),
+            "attachment_path": attachment_path
+        }
+
+    def _wake_sender(self):
+        """唤醒发送线程处理新写入的发件箱记录（不阻塞 worker）"""
+        with self._outbox_cond:
+            self._outbox_pending = True
+            self._outbox_cond.notify()
+
+    def _sender_loop(self):
+        """
+        SMTP发送线程主循环：发送发件箱中到期的邮件，失败按退避重试
 
-            # 构建主题
-            if success:
-                subject = f"✅ Claude执行完成 - {cmd.get('subject', '无主题')[:30]}"
-            else:
-                subject = f"❌ Claude执行失败 - {cmd.get('subject', '无主题')[:30]}"
-
-            # 发送回复邮件
-            if cmd.get("message_id"):
-                self.sender.send_reply(
-                    to=cmd["sender"],
-                    subject=subject,
-                    body=content,
-                    original_message_id=cmd["message_id"]
+        未发送的邮件保存在数据库中，停机时直接退出，重启后继续发送。
+        """
+        while not self._should_stop():
+            with self._outbox_cond:
+                self._outbox_pending = False
+
+            due = []
+            try:
+                due = self.queue.get_due_outbox(self.OUTBOX_BATCH_SIZE)
+                for item in due:
+                    if self._should_stop():
+                        return
+                    self._deliver_result(item)
+            except Exception as e:
+                logger.error(f"发送线程异常: {e}", exc_info=True)
+
+            # 本批已满说明可能还有到期邮件，立即继续
+            if len(due) >= self.OUTBOX_BATCH_SIZE:
+                continue
+
+            delay = self.queue.next_outbox_delay()
+            timeout = self.SENDER_IDLE_WAIT if delay is None else min(delay, self.SENDER_IDLE_WAIT)
+            with self._outbox_cond:
+                self._outbox_cond.wait_for(
+                    lambda: self._outbox_pending or self._should_stop(),
+                    timeout=timeout
+                )
+
+    def _deliver_result(self, item: dict) -> bool:
+        """
+        发送一封发件箱邮件（在发送线程中运行）
+
+        Args:
+            item: 发件箱记录
+
+        Returns:
+            是否发送成功（失败时已安排重试或放弃）
+        """
+        error = None
+        try:
+            attachment_path = item["attachment_path"]
+            if attachment_path and not Path(attachment_path).exists():
+                logger.warning(f"附件文件已丢失，仅发送正文: {attachment_path}")
+                attachment_path = None
+
+            # 发送回复邮件（会话池负责健康检查与断线重连）
+            if item["in_reply_to"]:
+                sent = self.sender.send_reply(
+                    to=item["recipient"],
+                    subject=item["subject"],
+                    body=item["body"],
+                    original_message_id=item["in_reply_to"],
+                    attachment_path=attachment_path
                 )
             else:
-                self.sender.send_email(
-                    to=cmd["sender"],
-                    subject=subject,
-                    body=content
+                sent = self.sender.send_email(
+                    to=item["recipient"],
+                    subject=item["subject"],
+                    body=item["body"],
+                    attachment_path=attachment_path
                 )
-
-            logger.info(f"结果邮件已发送: to={cmd['sender']}")
+            if not sent:
+                error = "SMTP发送失败"
 
         except Exception as e:
-            logger.error(f"发送结果邮件失败: {e}")
+            error = str(e)
+
+        if error is None:
+            self.queue.mark_outbox_sent(item["id"])
+            logger.info(f"结果邮件已发送: to={item['recipient']}")
+            return True
+
+        self.queue.mark_outbox_retry(item["id"], error)
+        return False
 
     def _shutdown(self):
         """优雅停机"""
@@ -315,20 +756,35 @@ class EmailCommandApp:
 
         self.running = False
 
+        # 唤醒等待中的线程
+        with self._outbox_cond:
+            self._outbox_cond.notify_all()
+        self.queue.notify_work()
+
+        # 先等待执行中的命令完成（有上限），超时则终止 claude 子进程并把命令放回队列
+        self._stop_workers(self.settings.get_shutdown_timeout())
+
+        for thread in self._threads:
+            thread.join(timeout=5)
+            if thread.is_alive():
+                logger.warning(f"线程未能及时退出: {thread.name}")
+
         # 断开邮件连接
         if self.receiver:
             self.receiver.disconnect()
         if self.sender:
             self.sender.disconnect()
 
-        # 释放队列资源
-        if self.queue:
-            self.queue.close()
-
         # 打印统计信息
         stats = self.queue.get_stats()
         logger.info(f"队列统计: {stats}")
 
+        # 释放队列资源
+        if self.queue:
+            self.queue.close()
+        if self.archive:
+            self.archive.close()
+
         logger.info("系统已停机")
 
 
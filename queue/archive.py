@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+命令历史归档
+把过期命令从热队列移入独立的只追加 SQLite 文件，按发件人/完成时间建立索引，
+完整记录（含执行结果）以 zlib 压缩的 JSON 存储
+"""
+
+import sqlite3
+import json
+import logging
+import threading
+import zlib
+from pathlib import Path
+from typing import Optional, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+class CommandArchive:
+    """命令归档（冷存储）"""
+
+    # 归档记录的压缩级别：写入只在维护时发生，取较高压缩率
+    COMPRESS_LEVEL = 9
+
+    # search() 默认与最大返回条数
+    DEFAULT_SEARCH_LIMIT = 100
+    MAX_SEARCH_LIMIT = 1000
+
+    def __init__(self, path: str):
+        """
+        初始化归档
+
+        Args:
+            path: 归档数据库文件路径
+        """
+        path_obj = Path(path).resolve()
+        path_obj.parent.mkdir(parents=True, exist_ok=True)
+        self.path = str(path_obj)
+
+        # 写入只来自维护线程，查询量很小，单连接加锁即可
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._init_db()
+
+    @staticmethod
+    def path_for(db_path: str) -> str:
+        """队列数据库对应的默认归档路径（同目录下的 <数据库名>_archive.db）"""
+        db_path_obj = Path(db_path)
+        return str(db_path_obj.with_name(f"{db_path_obj.stem}_archive.db"))
+
+    def _init_db(self) -> None:
+        """初始化归档表与索引"""
+        with self._lock, self._conn as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS archived_commands (
+                    id INTEGER PRIMARY KEY,
+                    sender TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at TIMESTAMP,
+                    completed_at TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    payload BLOB NOT NULL
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_archive_sender ON archived_commands(sender, completed_at)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_archive_completed ON archived_commands(completed_at)"
+            )
+
+    def append(self, records: List[Dict]) -> bool:
+        """
+        在一个事务内追加归档记录
+
+        按命令ID去重，中断后重新归档同一批命令不会产生重复记录。
+
+        Args:
+            records: 命令字典列表（需包含 id、sender、status、created_at、completed_at）
+
+        Returns:
+            是否成功
+        """
+        if not records:
+            return True
+
+        rows = [
+            (
+                record["id"], record["sender"], record["status"],
+                record.get("created_at"), record.get("completed_at"),
+                self._encode(record)
+            )
+            for record in records
+        ]
+        try:
+            with self._lock, self._conn as conn:
+                conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO archived_commands
+                        (id, sender, status, created_at, completed_at, payload)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    rows
+                )
+            return True
+        except Exception as e:
+            logger.error(f"写入归档失败: {e}")
+            return False
+
+    def get(self, cmd_id: int) -> Optional[Dict]:
+        """
+        根据ID读取归档命令
+
+        Args:
+            cmd_id: 命令ID
+
+        Returns:
+            完整命令字典（含 result），不存在返回None
+        """
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT payload FROM archived_commands WHERE id = ?", (cmd_id,)
+                ).fetchone()
+        except Exception as e:
+            logger.error(f"读取归档失败: {e}")
+            return None
+        return self._decode(row["payload"]) if row else None
+
+    def search(
+        self,
+        sender: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        limit: int = DEFAULT_SEARCH_LIMIT
+    ) -> List[Dict]:
+        """
+        按发件人与完成时间查询归档命令（新的在前）
+
+        Args:
+            sender: 发件人邮箱，None 表示不限
+            since: 完成时间下限（含），格式 'YYYY-MM-DD[ HH:MM:SS]'
+            until: 完成时间上限（不含）
+            limit: 最大数量
+
+        Returns:
+            完整命令字典列表
+        """
+        conditions = []
+        params: List = []
+        if sender is not None:
+            conditions.append("sender = ?")
+            params.append(sender)
+        if since is not None:
+            conditions.append("completed_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("completed_at < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.append(max(1, min(limit, self.MAX_SEARCH_LIMIT)))
+
+        try:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"""
+                    SELECT payload FROM archived_commands {where}
+                    ORDER BY completed_at DESC, id DESC
+                    LIMIT ?
+                    """,
+                    params
+                ).fetchall()
+        except Exception as e:
+            logger.error(f"查询归档失败: {e}")
+            return []
+        return [self._decode(row["payload"]) for row in rows]
+
+    def count(self) -> int:
+        """归档命令总数"""
+        try:
+            with self._lock:
+                return self._conn.execute("SELECT COUNT(*) FROM archived_commands").fetchone()[0]
+        except Exception as e:
+            logger.error(f"统计归档失败: {e}")
+            return 0
+
+    def _encode(self, record: Dict) -> bytes:
+        """把命令字典压缩为归档载荷"""
+        data = json.dumps(record, ensure_ascii=False, default=str).encode("utf-8")
+        return zlib.compress(data, self.COMPRESS_LEVEL)
+
+    @staticmethod
+    def _decode(payload: bytes) -> Dict:
+        """解压归档载荷"""
+        return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+    def close(self) -> None:
+        """关闭归档数据库连接"""
+        with self._lock:
+            try:
+                self._conn.close()
+            except sqlite3.Error as e:
+                logger.debug(f"关闭归档数据库时出错: {e}")
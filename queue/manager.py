@@ -1,27 +1,74 @@
 #!/usr/bin/env python3
 """
 SQLite命令队列管理器
-支持任务状态跟踪、重试机制、文件锁
+支持任务状态跟踪、重试机制、原子认领与租约、WAL 连接池
 """
 
 import sqlite3
+import hashlib
 import logging
 import os
-import sys
+import random
+import shutil
+import socket
+import threading
 import time
-from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Any
+import zlib
+from collections import OrderedDict
+from typing import Optional, Dict, List, Any, Callable
 from pathlib import Path
 
-# 跨平台文件锁
-if sys.platform == 'win32':
-    import msvcrt
-else:
-    import fcntl
+from queue.archive import CommandArchive
 
 logger = logging.getLogger(__name__)
 
 
+class _RecentKeys:
+    """
+    时间窗口内的最近键（LRU）
+
+    只要缓存包含了所有已写入的键（见 CommandQueue._sync_recent_hashes），且没有因容量
+    淘汰过窗口内的条目，未命中即可确定窗口内没有该键，无需查询数据库。
+    """
+
+    def __init__(self, window: float, capacity: int):
+        self.window = window
+        self.capacity = capacity
+        self._entries: "OrderedDict[str, float]" = OrderedDict()
+        # 因容量被淘汰的条目中最新的时间戳
+        self._evicted_until = float("-inf")
+
+    def lookup(self, key: str, now: float) -> Optional[bool]:
+        """
+        查询键是否在窗口内出现过
+
+        Returns:
+            True 为重复；False 为确定未出现；None 表示缓存不完整，需要查询数据库
+        """
+        cutoff = now - self.window
+        while self._entries:
+            oldest_key, oldest_ts = next(iter(self._entries.items()))
+            if oldest_ts >= cutoff:
+                break
+            self._entries.popitem(last=False)
+
+        # 其他写入者的条目按入库时间补入，可能不在队首而未被及时清理，命中时再核对时间
+        ts = self._entries.get(key)
+        if ts is not None and ts >= cutoff:
+            return True
+        if self._evicted_until >= cutoff:
+            return None
+        return False
+
+    def add(self, key: str, ts: float) -> None:
+        """记录键"""
+        self._entries[key] = ts
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            _, evicted_ts = self._entries.popitem(last=False)
+            self._evicted_until = max(self._evicted_until, evicted_ts)
+
+
 class CommandQueue:
     """SQLite命令队列管理器"""
 
@@ -31,29 +78,134 @@ class CommandQueue:
     STATUS_COMPLETED = "completed"
     STATUS_FAILED = "failed"
 
-    def __init__(self, db_path: str = "commands.db", use_lock: bool = True):
+    # 默认租约时长（秒），执行期间由 heartbeat() 续约
+    DEFAULT_LEASE_SECONDS = 30
+
+    # 发件箱状态
+    OUTBOX_PENDING = "pending"
+    OUTBOX_SENT = "sent"
+    OUTBOX_FAILED = "failed"
+
+    # 发件箱重试策略：第 n 次失败后等待 min(BASE * 2^(n-1), MAX) 秒
+    OUTBOX_MAX_ATTEMPTS = 8
+    OUTBOX_BACKOFF_BASE = 5
+    OUTBOX_BACKOFF_MAX = 1800
+
+    # 内容去重：同一发件人在窗口期（秒）内重复发送相同命令只执行一次，0 表示关闭
+    DEFAULT_DEDUP_WINDOW = 0
+    DEDUP_CACHE_SIZE = 10000
+
+    # 命令重试退避：第 n 次重试等待 min(BASE * 2^(n-1), MAX) 秒，并随机取其 50%~100%
+    RETRY_BASE_DELAY = 10
+    RETRY_MAX_DELAY = 600
+
+    # 命令结果单独存放在 command_results 表，超过该字节数时 zlib 压缩
+    RESULT_COMPRESS_MIN = 512
+    RESULT_COMPRESS_LEVEL = 6
+
+    # 写入遇到 database is locked/busy 时的重试次数与初始退避（秒），
+    # 每次尝试本身还会先等待 busy_timeout
+    WRITE_RETRIES = 4
+    WRITE_RETRY_DELAY = 0.1
+
+    # 保留期清理每批删除的行数与批间停顿（秒），避免长时间持有写锁阻塞 worker
+    RETENTION_BATCH_SIZE = 500
+    RETENTION_BATCH_PAUSE = 0.01
+    # 增量回收空闲页时每步释放的页数
+    VACUUM_STEP_PAGES = 256
+
+    # SQLite 3.35+ 支持 UPDATE ... RETURNING，旧版本回退到 BEGIN IMMEDIATE 认领
+    _SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+    # 每个连接的预编译语句缓存数量
+    STATEMENT_CACHE_SIZE = 256
+
+    # 连接级 PRAGMA（WAL 下 synchronous=NORMAL 只在检查点时 fsync）
+    CONNECTION_PRAGMAS = (
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA cache_size = -8000",
+        "PRAGMA mmap_size = 67108864",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA busy_timeout = 5000",
+    )
+
+    def __init__(
+        self,
+        db_path: str = "commands.db",
+        use_lock: bool = True,
+        dedup_window: int = DEFAULT_DEDUP_WINDOW
+    ):
         """
         初始化队列管理器
 
         Args:
             db_path: 数据库文件路径
-            use_lock: 是否使用文件锁（测试环境可设为False）
+            use_lock: 已废弃，出队由SQLite原子认领保证并发安全，保留以兼容旧调用
+            dedup_window: 内容去重窗口（秒），0 表示只按 Message-ID 去重
         """
         # 转换为绝对路径
         db_path_obj = Path(db_path).resolve()
         self.db_path = str(db_path_obj)
-        self.lock_file_path = str(db_path_obj.parent / f"{db_path_obj.name}.lock")
-        self.lock_fd = None
-        self._use_lock = use_lock
+
+        # 每个线程持有一个长连接，close() 时统一关闭
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+
+        # 进程内唤醒：出现可认领命令时递增序号并通知等待的 worker
+        self._work_cond = threading.Condition()
+        self._work_seq = 0
 
         # 确保目录存在
         db_path_obj.parent.mkdir(parents=True, exist_ok=True)
 
+        # 内容去重：内存中的窗口缓存挡在数据库查询之前
+        self.dedup_window = dedup_window
+        self._recent = _RecentKeys(dedup_window, self.DEDUP_CACHE_SIZE)
+        # 缓存已覆盖的最大命令ID（AUTOINCREMENT 保证ID不复用）
+        self._recent_max_id = 0
+        self._dedup_lock = threading.Lock()
+
+        # 发件箱附件目录（与数据库同目录，重启后仍可发送）
+        self.outbox_dir = db_path_obj.parent / f"{db_path_obj.stem}_outbox"
+
         self._init_db()
+        if self.dedup_window > 0:
+            self._load_recent_hashes()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        """
+        获取当前线程的持久连接（首次使用时创建）
+
+        Returns:
+            已配置 PRAGMA 与 Row 工厂的连接
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=5,
+                check_same_thread=False,
+                cached_statements=self.STATEMENT_CACHE_SIZE
+            )
+            conn.row_factory = sqlite3.Row
+            for pragma in self.CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
 
     def _init_db(self) -> None:
         """初始化数据库表"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._get_conn() as conn:
+            # 增量回收空闲页只能在建表前设置；已有数据库在此一次性转换，
+            # 此时应用尚未启动任何线程，VACUUM 不会与 worker 争抢写锁
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                self._convert_to_incremental_vacuum(conn)
+            # WAL 持久化在数据库文件中，读者不会阻塞写者
+            conn.execute("PRAGMA journal_mode = WAL")
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS commands (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -65,75 +217,344 @@ class CommandQueue:
                     result TEXT,
                     error TEXT,
                     retry_count INTEGER DEFAULT 0,
+                    worker_id TEXT,
+                    lease_expires_at TIMESTAMP,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    fair_tag REAL NOT NULL DEFAULT 0,
+                    next_attempt_at TIMESTAMP,
+                    content_hash TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     completed_at TIMESTAMP
                 )
             """)
 
+            # IMAP 同步水位（与队列同库，随命令一起持久化）
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS mailbox_state (
+                    mailbox TEXT PRIMARY KEY,
+                    uidvalidity INTEGER NOT NULL,
+                    last_uid INTEGER NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # 公平调度：每个发件人的权重与最近一条命令的虚拟完成时间
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sender_state (
+                    sender TEXT PRIMARY KEY,
+                    weight REAL NOT NULL DEFAULT 1,
+                    last_tag REAL NOT NULL DEFAULT 0
+                )
+            """)
+            # 调度器虚拟时钟：最近一次认领命令的 fair_tag
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS scheduler_state (
+                    key TEXT PRIMARY KEY,
+                    value REAL NOT NULL
+                )
+            """)
+            conn.execute("INSERT OR IGNORE INTO scheduler_state (key, value) VALUES ('vtime', 0)")
+
+            # 命令执行结果（压缩存放，列表查询不会读取）
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS command_results (
+                    command_id INTEGER PRIMARY KEY,
+                    encoding TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    body BLOB NOT NULL
+                )
+            """)
+
+            # 待发送的结果邮件（持久化，SMTP 失败后按退避重试）
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    command_id INTEGER,
+                    recipient TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    in_reply_to TEXT,
+                    attachment_path TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    last_error TEXT,
+                    next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    sent_at TIMESTAMP
+                )
+            """)
+
+            self._migrate(conn)
+
+            # 各状态计数，由触发器随命令增删和状态变化增量维护
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS command_stats (
+                    status TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._create_stats_triggers(conn)
+
             # 创建索引
             conn.execute("CREATE INDEX IF NOT EXISTS idx_status ON commands(status)")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_message_id ON commands(message_id)")
+            # Message-ID 唯一：重复投递或重新标记未读的邮件不会再次入队
+            self._create_message_id_index(conn)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_content_hash ON commands(content_hash, created_at)"
+            )
             conn.execute("CREATE INDEX IF NOT EXISTS idx_created_at ON commands(created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_status_created ON commands(status, created_at)")
+            # 保留期清理按 (状态, 完成时间) 分批查找过期命令
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_status_completed ON commands(status, completed_at)"
+            )
+            # 认领查询按 (优先级, 公平调度标记) 取第一条，索引顺序与 ORDER BY 一致
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_claim ON commands(status, priority DESC, fair_tag, id)"
+            )
+            # 查询下一条延迟重试命令的到期时间
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_status_next_attempt ON commands(status, next_attempt_at)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)")
 
             conn.commit()
 
-    def _acquire_lock(self) -> bool:
+    def _convert_to_incremental_vacuum(self, conn: sqlite3.Connection) -> None:
+        """旧数据库执行一次 VACUUM 切换到增量回收模式（只在初始化时调用）"""
+        size = self._disk_usage()
+        logger.info(f"数据库切换到增量回收模式，执行一次性 VACUUM（{size} 字节），请稍候...")
+        started = time.monotonic()
+        try:
+            conn.execute("VACUUM")
+        except sqlite3.Error as e:
+            # 转换失败不影响使用，只是维护时无法增量回收空间，下次启动再试
+            logger.error(f"切换增量回收模式失败: {e}")
+            return
+        logger.info(f"增量回收模式切换完成，耗时 {time.monotonic() - started:.1f} 秒")
+
+    @staticmethod
+    def _create_stats_triggers(conn: sqlite3.Connection) -> None:
+        """创建维护 command_stats 的触发器，并用一次 GROUP BY 校准计数"""
+        increment = """
+            INSERT OR IGNORE INTO command_stats (status, count) VALUES (NEW.status, 0);
+            UPDATE command_stats SET count = count + 1 WHERE status = NEW.status;
+        """
+        decrement = "UPDATE command_stats SET count = count - 1 WHERE status = OLD.status;"
+
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_insert AFTER INSERT ON commands
+            BEGIN {increment} END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_delete AFTER DELETE ON commands
+            BEGIN {decrement} END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_update AFTER UPDATE OF status ON commands
+            WHEN OLD.status IS NOT NEW.status
+            BEGIN {decrement} {increment} END
+        """)
+
+        # 启动时重算一次，兼容升级前的数据库
+        conn.execute("DELETE FROM command_stats")
+        conn.execute(
+            "INSERT INTO command_stats (status, count) "
+            "SELECT status, COUNT(*) FROM commands GROUP BY status"
+        )
+
+    @staticmethod
+    def _create_message_id_index(conn: sqlite3.Connection) -> None:
+        """创建 message_id 唯一索引（旧库先清除重复值，替换原普通索引）"""
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_message_id_unique'"
+        ).fetchone()
+        if not exists:
+            cleared = conn.execute(
+                """
+                UPDATE commands SET message_id = NULL
+                WHERE message_id IS NOT NULL AND id NOT IN (
+                    SELECT MIN(id) FROM commands WHERE message_id IS NOT NULL GROUP BY message_id
+                )
+                """
+            ).rowcount
+            if cleared > 0:
+                logger.warning(f"数据库迁移: 清除 {cleared} 条重复的 message_id")
+            conn.execute("DROP INDEX IF EXISTS idx_message_id")
+
+        conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_message_id_unique "
+            "ON commands(message_id) WHERE message_id IS NOT NULL"
+        )
+
+    def _load_recent_hashes(self) -> None:
+        """启动时把窗口期内的命令哈希载入内存缓存（含重启前入队的命令）"""
+        with self._get_conn() as conn:
+            rows = conn.execute(
+                """
+                SELECT content_hash, CAST(strftime('%s', created_at) AS REAL) AS ts
+                FROM commands
+                WHERE content_hash IS NOT NULL
+                AND created_at >= datetime('now', '-' || ? || ' seconds')
+                ORDER BY created_at ASC
+                """,
+                (self.dedup_window,)
+            ).fetchall()
+            self._recent_max_id = conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM commands"
+            ).fetchone()[0]
+        for row in rows:
+            self._recent.add(row["content_hash"], row["ts"])
+
+    def _sync_recent_hashes(self, conn: sqlite3.Connection) -> None:
         """
-        获取文件锁（跨平台）
+        把其他连接（例如同库的另一个进程）新入队命令的哈希补入缓存（在写事务内调用）
+
+        写事务期间没有其他写入者，补齐后缓存未命中仍可作为最终结论；
+        没有新命令时只是一次主键范围查询。
+        """
+        rows = conn.execute(
+            """
+            SELECT id, content_hash, CAST(strftime('%s', created_at) AS REAL) AS ts
+            FROM commands WHERE id > ? ORDER BY id
+            """,
+            (self._recent_max_id,)
+        ).fetchall()
+        for row in rows:
+            if row["content_hash"] is not None:
+                self._recent.add(row["content_hash"], row["ts"])
+            self._recent_max_id = row["id"]
+
+    @staticmethod
+    def content_hash(sender: str, command: str) -> str:
+        """
+        计算命令内容哈希（发件人不区分大小写，命令折叠空白）
+
+        Args:
+            sender: 发件人邮箱
+            command: 命令内容
 
         Returns:
-            是否成功获取锁
+            十六进制 SHA-256
         """
-        if not self._use_lock:
-            return True
+        normalized = " ".join(command.split())
+        key = f"{sender.strip().lower()}\0{normalized}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _is_recent_duplicate(self, conn: sqlite3.Connection, content_hash: str) -> bool:
+        """检查窗口期内是否已有相同内容的命令（缓存未命中且完整时不访问数据库）"""
+        cached = self._recent.lookup(content_hash, time.time())
+        if cached is not None:
+            return cached
+
+        row = conn.execute(
+            """
+            SELECT 1 FROM commands
+            WHERE content_hash = ? AND created_at >= datetime('now', '-' || ? || ' seconds')
+            LIMIT 1
+            """,
+            (content_hash, self.dedup_window)
+        ).fetchone()
+        return row is not None
+
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        """为旧版本数据库补充新增列"""
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(commands)")}
+        for name, ddl in (
+            ("worker_id", "TEXT"),
+            ("lease_expires_at", "TIMESTAMP"),
+            ("priority", "INTEGER NOT NULL DEFAULT 0"),
+            ("fair_tag", "REAL NOT NULL DEFAULT 0"),
+            ("next_attempt_at", "TIMESTAMP"),
+            ("content_hash", "TEXT"),
+        ):
+            if name not in columns:
+                conn.execute(f"ALTER TABLE commands ADD COLUMN {name} {ddl}")
+                logger.info(f"数据库迁移: 新增列 commands.{name}")
+
+        # 旧版本把结果直接存在 commands.result，迁移到 command_results
+        moved = conn.execute(
+            """
+            INSERT OR IGNORE INTO command_results (command_id, encoding, size, body)
+            SELECT id, 'raw', length(CAST(result AS BLOB)), CAST(result AS BLOB)
+            FROM commands WHERE result IS NOT NULL
+            """
+        ).rowcount
+        if moved > 0:
+            conn.execute("UPDATE commands SET result = NULL WHERE result IS NOT NULL")
+            logger.info(f"数据库迁移: {moved} 条命令结果移入 command_results")
+
+        # 旧版本的失败命令没有 completed_at，保留期清理永远不会删除它们
+        filled = conn.execute(
+            """
+            UPDATE commands SET completed_at = COALESCE(updated_at, created_at)
+            WHERE status = 'failed' AND completed_at IS NULL
+            """
+        ).rowcount
+        if filled > 0:
+            logger.info(f"数据库迁移: 为 {filled} 条失败命令补充 completed_at")
+
+    @property
+    def work_seq(self) -> int:
+        """可认领命令的变化序号，与 wait_for_work() 配合避免丢失通知"""
+        return self._work_seq
+
+    def notify_work(self) -> None:
+        """通知等待中的 worker 有新的可认领命令（也用于停机时唤醒）"""
+        with self._work_cond:
+            self._work_seq += 1
+            self._work_cond.notify_all()
+
+    def wait_for_work(self, since: int, timeout: float) -> bool:
+        """
+        等待新的可认领命令
 
-        try:
-            self.lock_fd = open(self.lock_file_path, 'w')
+        调用方应在认领前读取 work_seq，认领落空后再以该值调用本方法，
+        这样两次调用之间发生的通知不会丢失。
 
-            if sys.platform == 'win32':
-                # Windows: 使用 msvcrt.locking
-                try:
-                    msvcrt.locking(self.lock_fd.fileno(), msvcrt.LK_NBLCK, 1)
-                except (IOError, OSError):
-                    logger.warning("无法获取文件锁（Windows），可能有其他进程正在运行")
-                    return False
-            else:
-                # Unix: 使用 fcntl
-                try:
-                    fcntl.flock(self.lock_fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                except (IOError, OSError):
-                    logger.warning("无法获取文件锁（Unix），可能有其他进程正在运行")
-                    return False
+        Args:
+            since: 认领前读取的 work_seq
+            timeout: 最长等待时间（秒），用于兜底其他进程写入的命令
 
-            return True
-        except (IOError, OSError) as e:
-            logger.warning(f"无法获取文件锁: {e}")
+        Returns:
+            是否收到通知（False 表示超时）
+        """
+        with self._work_cond:
+            return self._work_cond.wait_for(lambda: self._work_seq != since, timeout)
+
+    def set_sender_weight(self, sender: str, weight: float) -> bool:
+        """
+        设置发件人的调度权重（权重2的发件人获得两倍份额）
+
+        Args:
+            sender: 发件人邮箱
+            weight: 权重（>0）
+
+        Returns:
+            是否成功
+        """
+        if weight <= 0:
+            raise ValueError(f"权重必须大于0: {weight}")
+        try:
+            with self._get_conn() as conn:
+                conn.execute(
+                    """
+                    INSERT INTO sender_state (sender, weight) VALUES (?, ?)
+                    ON CONFLICT(sender) DO UPDATE SET weight = excluded.weight
+                    """,
+                    (sender, weight)
+                )
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"设置发件人权重失败: {e}")
             return False
 
-    def _release_lock(self) -> None:
-        """释放文件锁（跨平台）"""
-        if self.lock_fd:
-            try:
-                if sys.platform == 'win32':
-                    # Windows: 解锁
-                    try:
-                        self.lock_fd.seek(0)
-                        msvcrt.locking(self.lock_fd.fileno(), msvcrt.LK_UNLCK, 1)
-                    except (OSError, IOError) as e:
-                        logger.debug(f"Windows 文件解锁失败: {e}")
-                else:
-                    # Unix: 解锁
-                    try:
-                        fcntl.flock(self.lock_fd.fileno(), fcntl.LOCK_UN)
-                    except (OSError, IOError) as e:
-                        logger.debug(f"Unix 文件解锁失败: {e}")
-
-                self.lock_fd.close()
-            except Exception as e:
-                logger.warning(f"释放文件锁时出错: {e}")
-            finally:
-                self.lock_fd = None
+    @staticmethod
+    def default_worker_id() -> str:
+        """生成当前线程的 worker 标识（主机:进程:线程）"""
+        return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
 
     def enqueue(
         self,
@@ -141,103 +562,279 @@ class CommandQueue:
         command: str,
         message_id: Optional[str] = None,
         subject: Optional[str] = None,
-        metadata: Optional[Dict] = None
+        metadata: Optional[Dict] = None,
+        priority: int = 0
     ) -> Optional[int]:
         """
         将命令加入队列
 
+        同一优先级内按发件人加权公平排队，大量发信的用户不会让其他用户的命令长时间等待。
+
         Args:
             sender: 发件人邮箱
             command: 命令内容
             message_id: 邮件Message-ID
             subject: 邮件主题
             metadata: 额外元数据
+            priority: 优先级，数值越大越先执行
 
         Returns:
             命令ID，失败返回None
         """
+        cmd_ids = self.enqueue_many([{
+            "sender": sender,
+            "command": command,
+            "message_id": message_id,
+            "subject": subject,
+            "priority": priority,
+        }])
+        return cmd_ids[0] if cmd_ids else None
+
+    def enqueue_many(self, records: List[Dict]) -> Optional[List[Optional[int]]]:
+        """
+        在一个事务内批量入队（一次提交、一次 fsync）
+
+        每条记录的字段与 enqueue() 参数相同（sender、command 必填）。
+        Message-ID 重复或窗口期内内容重复的记录被跳过。
+
+        Args:
+            records: 命令记录列表
+
+        Returns:
+            与 records 一一对应的命令ID列表（被跳过的为None）；数据库错误返回None
+        """
+        if not records:
+            return []
+
+        hashes = [self.content_hash(r["sender"], r["command"]) for r in records]
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute(
-                    """
-                    INSERT INTO commands (sender, command, message_id, subject)
-                    VALUES (?, ?, ?, ?)
-                    """,
-                    (sender, command, message_id, subject)
-                )
+            with self._dedup_lock, self._get_conn() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                rows, positions = self._prepare_rows(conn, records, hashes)
+
+                inserted: List[sqlite3.Row] = []
+                if rows:
+                    last_id = conn.execute(
+                        "SELECT COALESCE(MAX(id), 0) FROM commands"
+                    ).fetchone()[0]
+                    conn.executemany(
+                        """
+                        INSERT OR IGNORE INTO commands
+                            (sender, command, message_id, subject, priority, content_hash, fair_tag)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                        """,
+                        rows
+                    )
+                    inserted = conn.execute(
+                        "SELECT id, message_id, content_hash FROM commands WHERE id > ? ORDER BY id",
+                        (last_id,)
+                    ).fetchall()
+                    conn.execute(
+                        """
+                        INSERT INTO sender_state (sender, last_tag)
+                        SELECT sender, MAX(fair_tag) FROM commands WHERE id > ? GROUP BY sender
+                        ON CONFLICT(sender) DO UPDATE SET last_tag = excluded.last_tag
+                        """,
+                        (last_id,)
+                    )
                 conn.commit()
-                cmd_id = cursor.lastrowid
-                logger.info(f"命令入队: id={cmd_id}, sender={sender}, command={command[:50]}...")
-                return cmd_id
-        except sqlite3.IntegrityError:
-            logger.warning(f"命令已存在（重复邮件）: message_id={message_id}")
-            return None
+
+                now = time.time()
+                for row in inserted:
+                    self._recent.add(row["content_hash"], now)
+                    self._recent_max_id = row["id"]
         except Exception as e:
             logger.error(f"命令入队失败: {e}")
             return None
 
-    def dequeue(self) -> Optional[Dict]:
-        """
-        从队列取出一个待处理命令
+        # 写入顺序与 rows 一致，被 OR IGNORE 跳过的只会是 Message-ID 重复的行
+        cmd_ids: List[Optional[int]] = [None] * len(records)
+        pending = iter(inserted)
+        row = next(pending, None)
+        for (_, _, message_id, _, _, content_hash, _), index in zip(rows, positions):
+            if row is not None and (row["message_id"], row["content_hash"]) == (message_id, content_hash):
+                cmd_ids[index] = row["id"]
+                record = records[index]
+                logger.info(
+                    f"命令入队: id={row['id']}, sender={record['sender']}, "
+                    f"command={record['command'][:50]}..."
+                )
+                row = next(pending, None)
+            else:
+                logger.warning(f"命令已存在（重复邮件）: message_id={message_id}")
 
-        Returns:
-            命令字典，无可用命令返回None
+        if inserted:
+            self.notify_work()
+        return cmd_ids
+
+    def _prepare_rows(self, conn: sqlite3.Connection, records: List[Dict], hashes: List[str]):
         """
-        # 获取文件锁
-        if not self._acquire_lock():
-            return None
+        过滤重复内容并计算公平调度标记（在写事务内调用）
 
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+        同一优先级内按加权公平排队：命令的 fair_tag 为
+        max(调度器虚拟时钟, 该发件人上一条命令的 fair_tag) + 1/权重。
 
-                # 先获取待处理命令
-                cursor = conn.execute(
-                    """
-                    SELECT * FROM commands
-                    WHERE status = ?
-                    ORDER BY created_at ASC
-                    LIMIT 1
-                    """,
-                    (self.STATUS_PENDING,)
+        Returns:
+            (待插入的参数元组列表, 对应的 records 下标列表)
+        """
+        if self.dedup_window > 0:
+            self._sync_recent_hashes(conn)
+        vtime = conn.execute(
+            "SELECT value FROM scheduler_state WHERE key = 'vtime'"
+        ).fetchone()[0]
+        senders: Dict[str, List[float]] = {}
+        seen = set()
+        rows, positions = [], []
+
+        for index, (record, content_hash) in enumerate(zip(records, hashes)):
+            sender, command = record["sender"], record["command"]
+            if self.dedup_window > 0 and (
+                content_hash in seen or self._is_recent_duplicate(conn, content_hash)
+            ):
+                logger.warning(
+                    f"重复命令（{self.dedup_window} 秒内已入队），跳过: "
+                    f"sender={sender}, command={command[:50]}..."
                 )
-                row = cursor.fetchone()
+                continue
+            seen.add(content_hash)
+
+            state = senders.get(sender)
+            if state is None:
+                found = conn.execute(
+                    "SELECT weight, last_tag FROM sender_state WHERE sender = ?", (sender,)
+                ).fetchone()
+                state = senders[sender] = [found[0], found[1]] if found else [1.0, 0.0]
+            fair_tag = max(vtime, state[1]) + 1.0 / state[0]
+            state[1] = fair_tag
+
+            rows.append((
+                sender, command, record.get("message_id"), record.get("subject"),
+                record.get("priority", 0), content_hash, fair_tag
+            ))
+            positions.append(index)
+
+        return rows, positions
+
+    def dequeue(
+        self,
+        worker_id: Optional[str] = None,
+        lease_seconds: int = DEFAULT_LEASE_SECONDS
+    ) -> Optional[Dict]:
+        """
+        原子认领一个已到期的待处理命令（延迟重试的命令到 next_attempt_at 后才可认领）
 
-                if not row:
-                    return None
+        认领在单条语句（或单个写事务）内完成，多个 worker 线程/进程可并发调用，
+        同一命令只会被一个 worker 领取。
 
-                cmd_id = row["id"]
+        Args:
+            worker_id: 认领者标识，默认使用 主机:进程:线程
+            lease_seconds: 租约时长（秒）
 
-                # 更新状态为处理中
-                conn.execute(
-                    """
-                    UPDATE commands
-                    SET status = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                    """,
-                    (self.STATUS_PROCESSING, cmd_id)
-                )
+        Returns:
+            命令字典，无可用命令返回None
+        """
+        worker_id = worker_id or self.default_worker_id()
+
+        try:
+            with self._get_conn() as conn:
+                if self._SUPPORTS_RETURNING:
+                    cmd = self._claim_returning(conn, worker_id, lease_seconds)
+                else:
+                    cmd = self._claim_immediate(conn, worker_id, lease_seconds)
+                if cmd:
+                    # 推进虚拟时钟，之后入队的空闲发件人从当前进度开始排队
+                    conn.execute(
+                        "UPDATE scheduler_state SET value = ? WHERE key = 'vtime' AND value < ?",
+                        (cmd["fair_tag"], cmd["fair_tag"])
+                    )
                 conn.commit()
 
-                # 再次查询以获取更新后的数据
-                cursor = conn.execute("SELECT * FROM commands WHERE id = ?", (cmd_id,))
-                updated_row = cursor.fetchone()
+                if not cmd:
+                    return None
 
-                logger.info(f"命令出队: id={cmd_id}")
-                return dict(updated_row)
+                logger.info(f"命令出队: id={cmd['id']}, worker={worker_id}")
+                return cmd
 
         except Exception as e:
             logger.error(f"命令出队失败: {e}")
             return None
-        finally:
-            self._release_lock()
+
+    def _claim_returning(
+        self,
+        conn: sqlite3.Connection,
+        worker_id: str,
+        lease_seconds: int
+    ) -> Optional[Dict]:
+        """使用 UPDATE ... RETURNING 单语句认领"""
+        cursor = conn.execute(
+            """
+            UPDATE commands
+            SET status = ?, worker_id = ?,
+                lease_expires_at = datetime('now', '+' || ? || ' seconds'),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT id FROM commands
+                WHERE status = ?
+                AND (next_attempt_at IS NULL OR next_attempt_at <= CURRENT_TIMESTAMP)
+                ORDER BY priority DESC, fair_tag ASC, id ASC
+                LIMIT 1
+            )
+            RETURNING *
+            """,
+            (self.STATUS_PROCESSING, worker_id, lease_seconds, self.STATUS_PENDING)
+        )
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    def _claim_immediate(
+        self,
+        conn: sqlite3.Connection,
+        worker_id: str,
+        lease_seconds: int
+    ) -> Optional[Dict]:
+        """旧版SQLite: 在 BEGIN IMMEDIATE 写事务内认领"""
+        conn.execute("BEGIN IMMEDIATE")
+        # 租约到期时间随候选命令一起由 SQLite 计算（与 CURRENT_TIMESTAMP 同一时钟与格式），免去回读
+        row = conn.execute(
+            """
+            SELECT *, datetime('now', '+' || ? || ' seconds') AS new_lease_expires_at
+            FROM commands
+            WHERE status = ?
+            AND (next_attempt_at IS NULL OR next_attempt_at <= CURRENT_TIMESTAMP)
+            ORDER BY priority DESC, fair_tag ASC, id ASC
+            LIMIT 1
+            """,
+            (lease_seconds, self.STATUS_PENDING)
+        ).fetchone()
+        if not row:
+            return None
+
+        claimed = dict(row)
+        lease_expires_at = claimed.pop("new_lease_expires_at")
+        conn.execute(
+            """
+            UPDATE commands
+            SET status = ?, worker_id = ?, lease_expires_at = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            """,
+            (self.STATUS_PROCESSING, worker_id, lease_expires_at, row["id"])
+        )
+        claimed.update(
+            status=self.STATUS_PROCESSING,
+            worker_id=worker_id,
+            lease_expires_at=lease_expires_at
+        )
+        return claimed
 
     def update_status(
         self,
         cmd_id: int,
         status: str,
         result: Optional[str] = None,
-        error: Optional[str] = None
+        error: Optional[str] = None,
+        worker_id: Optional[str] = None,
+        outbox: Optional[Dict] = None
     ) -> bool:
         """
         更新命令状态
@@ -247,45 +844,220 @@ class CommandQueue:
             status: 新状态
             result: 执行结果
             error: 错误信息
+            worker_id: 若指定，仅当命令仍由该 worker 持有租约时才更新
+            outbox: 结果邮件（recipient、subject、body，可选 in_reply_to、attachment_path），
+                与状态变更在同一事务内写入发件箱
 
         Returns:
-            是否成功
+            是否成功；只有指定 worker_id 且租约已丢失时返回False
+
+        Raises:
+            sqlite3.Error: 数据库错误（锁冲突重试后仍失败）
+        """
+        # 离开 processing 状态时释放租约
+        release = ", worker_id = NULL, lease_expires_at = NULL"
+        stored_result = None
+        if status == self.STATUS_COMPLETED:
+            assignments = "status = ?, completed_at = CURRENT_TIMESTAMP" + release
+            params: List[Any] = [status]
+            if result is not None:
+                # 在事务外完成压缩，缩短写锁持有时间
+                stored_result = self._encode_result(result)
+        elif status == self.STATUS_FAILED:
+            assignments = "status = ?, error = ?, completed_at = CURRENT_TIMESTAMP" + release
+            params = [status, error]
+        elif status == self.STATUS_PENDING:
+            assignments = "status = ?" + release
+            params = [status]
+        else:
+            assignments = "status = ?"
+            params = [status]
+
+        where = "id = ?"
+        params.append(cmd_id)
+        if worker_id is not None:
+            where += " AND status = ? AND worker_id = ?"
+            params.extend([self.STATUS_PROCESSING, worker_id])
+
+        def write(conn: sqlite3.Connection) -> bool:
+            cursor = conn.execute(
+                f"UPDATE commands SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE {where}",
+                params
+            )
+            if worker_id is not None and cursor.rowcount == 0:
+                return False
+            if stored_result is not None and cursor.rowcount > 0:
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO command_results (command_id, encoding, size, body)
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    (cmd_id, *stored_result)
+                )
+            if mail is not None and cursor.rowcount > 0:
+                self._insert_outbox(conn, cmd_id, mail)
+            return True
+
+        mail = self._stage_outbox(outbox)
+        try:
+            updated = self._write(write)
+        except sqlite3.Error:
+            self._unstage_outbox(outbox, mail)
+            raise
+        if not updated:
+            self._unstage_outbox(outbox, mail)
+            logger.warning(f"租约已丢失，忽略状态更新: id={cmd_id}, worker={worker_id}")
+            return False
+        if status == self.STATUS_PENDING:
+            self.notify_work()
+        return True
+
+    def heartbeat(self, cmd_id: int, worker_id: str, lease_seconds: int = DEFAULT_LEASE_SECONDS) -> bool:
+        """
+        续约：延长 worker 持有命令的租约
+
+        Args:
+            cmd_id: 命令ID
+            worker_id: 持有租约的 worker 标识
+            lease_seconds: 从现在起的租约时长（秒）
+
+        Returns:
+            是否续约成功（False 表示租约已被回收或命令已结束）
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                if status == self.STATUS_COMPLETED:
-                    conn.execute(
-                        """
-                        UPDATE commands
-                        SET status = ?, result = ?, completed_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                        """,
-                        (status, result, cmd_id)
-                    )
-                elif status == self.STATUS_FAILED:
-                    conn.execute(
-                        """
-                        UPDATE commands
-                        SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                        """,
-                        (status, error, cmd_id)
-                    )
-                else:
-                    conn.execute(
-                        """
-                        UPDATE commands
-                        SET status = ?, updated_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                        """,
-                        (status, cmd_id)
-                    )
+            with self._get_conn() as conn:
+                cursor = conn.execute(
+                    """
+                    UPDATE commands
+                    SET lease_expires_at = datetime('now', '+' || ? || ' seconds')
+                    WHERE id = ? AND status = ? AND worker_id = ?
+                    """,
+                    (lease_seconds, cmd_id, self.STATUS_PROCESSING, worker_id)
+                )
                 conn.commit()
-                return True
+                return cursor.rowcount > 0
         except Exception as e:
-            logger.error(f"更新状态失败: {e}")
+            logger.error(f"续约失败: {e}")
             return False
 
+    def retry_or_fail(
+        self,
+        cmd_id: int,
+        error: str,
+        max_retries: int = 3,
+        worker_id: Optional[str] = None,
+        outbox: Optional[Dict] = None
+    ) -> Optional[Dict]:
+        """
+        记录执行失败，并在同一事务内决定延迟重试或最终失败
+
+        Args:
+            cmd_id: 命令ID
+            error: 错误信息
+            max_retries: 最大重试次数
+            worker_id: 若指定，仅当命令仍由该 worker 持有租约时才更新
+            outbox: 失败通知邮件（格式同 update_status），仅在最终失败时于同一事务内写入发件箱
+
+        Returns:
+            {'retry': bool, 'retry_count': int, 'delay': float}；
+            命令不存在或租约已丢失返回None
+
+        Raises:
+            sqlite3.Error: 数据库错误（锁冲突重试后仍失败）
+        """
+        where = "id = ?"
+        params: List[Any] = [cmd_id]
+        if worker_id is not None:
+            where += " AND status = ? AND worker_id = ?"
+            params.extend([self.STATUS_PROCESSING, worker_id])
+
+        def write(conn: sqlite3.Connection) -> Optional[Dict]:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                f"SELECT retry_count FROM commands WHERE {where}", params
+            ).fetchone()
+            if not row:
+                return None
+
+            release = "worker_id = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP"
+            retry_count = row["retry_count"]
+            if retry_count < max_retries:
+                retry_count += 1
+                delay = self.retry_delay(retry_count)
+                conn.execute(
+                    f"""
+                    UPDATE commands
+                    SET status = ?, error = ?, retry_count = ?,
+                        next_attempt_at = datetime('now', '+' || ? || ' seconds'), {release}
+                    WHERE id = ?
+                    """,
+                    (self.STATUS_PENDING, error, retry_count, delay, cmd_id)
+                )
+                return {"retry": True, "retry_count": retry_count, "delay": delay}
+
+            conn.execute(
+                f"""
+                UPDATE commands
+                SET status = ?, error = ?, next_attempt_at = NULL,
+                    completed_at = CURRENT_TIMESTAMP, {release}
+                WHERE id = ?
+                """,
+                (self.STATUS_FAILED, error, cmd_id)
+            )
+            if mail is not None:
+                self._insert_outbox(conn, cmd_id, mail)
+            return {"retry": False, "retry_count": retry_count, "delay": 0.0}
+
+        mail = self._stage_outbox(outbox)
+        try:
+            outcome = self._write(write)
+        except sqlite3.Error:
+            self._unstage_outbox(outbox, mail)
+            raise
+        if outcome is None or outcome["retry"]:
+            self._unstage_outbox(outbox, mail)
+        if outcome is None and worker_id is not None:
+            logger.warning(f"租约已丢失，忽略失败处理: id={cmd_id}, worker={worker_id}")
+        return outcome
+
+    @classmethod
+    def retry_delay(cls, retry_count: int) -> float:
+        """
+        计算第 retry_count 次重试前的等待时间（指数退避 + 抖动）
+
+        Args:
+            retry_count: 重试序号（从1开始）
+
+        Returns:
+            等待秒数
+        """
+        ceiling = min(cls.RETRY_BASE_DELAY * 2 ** (retry_count - 1), cls.RETRY_MAX_DELAY)
+        return round(ceiling * random.uniform(0.5, 1.0), 3)
+
+    def next_due_delay(self) -> Optional[float]:
+        """
+        距离下一条延迟重试命令到期的秒数
+
+        Returns:
+            秒数（已到期为0），没有延迟中的命令返回None
+        """
+        try:
+            with self._get_conn() as conn:
+                row = conn.execute(
+                    """
+                    SELECT (julianday(MIN(next_attempt_at)) - julianday('now')) * 86400
+                    FROM commands
+                    WHERE status = ? AND next_attempt_at > CURRENT_TIMESTAMP
+                    """,
+                    (self.STATUS_PENDING,)
+                ).fetchone()
+                if row[0] is None:
+                    return None
+                return max(0.0, row[0])
+        except Exception as e:
+            logger.error(f"查询重试到期时间失败: {e}")
+            return None
+
     def increment_retry(self, cmd_id: int) -> int:
         """
         增加重试计数
@@ -297,7 +1069,7 @@ class CommandQueue:
             新的重试计数
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 conn.execute(
                     """
                     UPDATE commands
@@ -332,26 +1104,77 @@ class CommandQueue:
 
         return cmd.get("retry_count", 0) < max_retries
 
-    def get_by_id(self, cmd_id: int) -> Optional[Dict]:
+    def get_by_id(self, cmd_id: int, include_result: bool = False) -> Optional[Dict]:
         """
         根据ID获取命令
 
         Args:
             cmd_id: 命令ID
+            include_result: 是否同时读取并解压执行结果（填入 'result'）
 
         Returns:
             命令字典，不存在返回None
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self._get_conn() as conn:
                 cursor = conn.execute("SELECT * FROM commands WHERE id = ?", (cmd_id,))
                 row = cursor.fetchone()
-                return dict(row) if row else None
+                if not row:
+                    return None
+                cmd = dict(row)
         except Exception as e:
             logger.error(f"获取命令失败: {e}")
             return None
 
+        if include_result:
+            cmd["result"] = self.get_result(cmd_id)
+        return cmd
+
+    def get_result(self, cmd_id: int) -> Optional[str]:
+        """
+        读取命令的执行结果
+
+        Args:
+            cmd_id: 命令ID
+
+        Returns:
+            结果文本，没有结果返回None
+        """
+        try:
+            with self._get_conn() as conn:
+                row = conn.execute(
+                    "SELECT encoding, body FROM command_results WHERE command_id = ?",
+                    (cmd_id,)
+                ).fetchone()
+        except Exception as e:
+            logger.error(f"获取命令结果失败: {e}")
+            return None
+
+        if not row:
+            return None
+        return self._decode_result(row["encoding"], row["body"])
+
+    def _encode_result(self, result: str) -> tuple:
+        """
+        编码执行结果
+
+        Returns:
+            (encoding, 原始字节数, 存储字节)
+        """
+        data = result.encode("utf-8")
+        if len(data) >= self.RESULT_COMPRESS_MIN:
+            compressed = zlib.compress(data, self.RESULT_COMPRESS_LEVEL)
+            if len(compressed) < len(data):
+                return "zlib", len(data), compressed
+        return "raw", len(data), data
+
+    @staticmethod
+    def _decode_result(encoding: str, body: bytes) -> str:
+        """解码 command_results 中存储的结果"""
+        if encoding == "zlib":
+            body = zlib.decompress(body)
+        return bytes(body).decode("utf-8", errors="replace")
+
     def get_pending_commands(self, limit: int = 10) -> List[Dict]:
         """
         获取待处理命令列表
@@ -363,8 +1186,7 @@ class CommandQueue:
             命令列表
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self._get_conn() as conn:
                 cursor = conn.execute(
                     """
                     SELECT * FROM commands
@@ -390,8 +1212,7 @@ class CommandQueue:
             命令列表
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self._get_conn() as conn:
                 cursor = conn.execute(
                     """
                     SELECT * FROM commands
@@ -406,95 +1227,629 @@ class CommandQueue:
             logger.error(f"获取失败命令失败: {e}")
             return []
 
-    def delete_old_completed(self, days: int = 7) -> int:
+    def delete_old_completed(self, days: int = 7, batch_size: int = RETENTION_BATCH_SIZE) -> int:
         """
-        删除旧的已完成命令
+        分批删除旧的已完成/失败命令及其结果
+
+        每批一个短事务，批间让出写锁，worker 的认领与状态更新不会被长时间阻塞。
 
         Args:
             days: 保留天数
+            batch_size: 每批删除的命令数
 
         Returns:
             删除的命令数量
         """
+        deleted = 0
+        try:
+            conn = self._get_conn()
+            while True:
+                with conn:
+                    ids = [
+                        (row[0],) for row in conn.execute(
+                            """
+                            SELECT id FROM commands
+                            WHERE status IN ('completed', 'failed')
+                            AND completed_at < datetime('now', '-' || ? || ' days')
+                            LIMIT ?
+                            """,
+                            (days, batch_size)
+                        )
+                    ]
+                    if not ids:
+                        break
+                    self._delete_commands(conn, ids)
+                deleted += len(ids)
+                if len(ids) < batch_size:
+                    break
+                time.sleep(self.RETENTION_BATCH_PAUSE)
+        except Exception as e:
+            logger.error(f"清理旧命令失败: {e}")
+
+        if deleted > 0:
+            logger.info(f"清理旧命令: {deleted} 条")
+        return deleted
+
+    def archive_old_completed(
+        self,
+        archive: CommandArchive,
+        days: int = 7,
+        batch_size: int = RETENTION_BATCH_SIZE
+    ) -> int:
+        """
+        分批把旧的已完成/失败命令（含结果）移入归档，热队列只保留近期命令
+
+        每批先写入归档并提交，再从队列删除；中途失败的批次会在下次维护时重新归档
+        （归档按ID去重）。
+
+        Args:
+            archive: 归档
+            days: 保留天数
+            batch_size: 每批归档的命令数
+
+        Returns:
+            归档的命令数量
+        """
+        archived = 0
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            conn = self._get_conn()
+            while True:
+                rows = conn.execute(
+                    """
+                    SELECT c.*, r.encoding AS result_encoding, r.body AS result_body
+                    FROM commands c LEFT JOIN command_results r ON r.command_id = c.id
+                    WHERE c.status IN ('completed', 'failed')
+                    AND c.completed_at < datetime('now', '-' || ? || ' days')
+                    LIMIT ?
+                    """,
+                    (days, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+
+                records = []
+                for row in rows:
+                    record = dict(row)
+                    encoding = record.pop("result_encoding")
+                    body = record.pop("result_body")
+                    if encoding is not None:
+                        record["result"] = self._decode_result(encoding, body)
+                    records.append(record)
+                if not archive.append(records):
+                    break
+
+                with conn:
+                    self._delete_commands(conn, [(record["id"],) for record in records])
+                archived += len(rows)
+                if len(rows) < batch_size:
+                    break
+                time.sleep(self.RETENTION_BATCH_PAUSE)
+        except Exception as e:
+            logger.error(f"归档旧命令失败: {e}")
+
+        if archived > 0:
+            logger.info(f"归档旧命令: {archived} 条")
+        return archived
+
+    @staticmethod
+    def _delete_commands(conn: sqlite3.Connection, ids: List[tuple]) -> None:
+        """删除命令及其结果（在调用方事务内）"""
+        conn.executemany("DELETE FROM command_results WHERE command_id = ?", ids)
+        conn.executemany("DELETE FROM commands WHERE id = ?", ids)
+
+    def delete_old_outbox(self, days: int = 7) -> int:
+        """
+        删除已结束（已发送或放弃）的旧发件箱记录
+
+        Args:
+            days: 保留天数
+
+        Returns:
+            删除的记录数量
+        """
+        try:
+            with self._get_conn() as conn:
                 cursor = conn.execute(
                     """
-                    DELETE FROM commands
-                    WHERE status IN ('completed', 'failed')
-                    AND completed_at < datetime('now', '-' || ? || ' days')
+                    DELETE FROM outbox
+                    WHERE status != ? AND created_at < datetime('now', '-' || ? || ' days')
                     """,
-                    (days,)
+                    (self.OUTBOX_PENDING, days)
                 )
                 conn.commit()
-                deleted = cursor.rowcount
-                if deleted > 0:
-                    logger.info(f"清理旧命令: {deleted} 条")
-                return deleted
+                return cursor.rowcount
         except Exception as e:
-            logger.error(f"清理旧命令失败: {e}")
+            logger.error(f"清理发件箱失败: {e}")
             return 0
 
+    def compact(self) -> int:
+        """
+        回收数据库空闲页并截断 WAL
+
+        每步只释放 VACUUM_STEP_PAGES 页，写锁持有时间有上限；不会执行全量 VACUUM
+        （旧数据库的模式转换在 _init_db 中完成）。
+
+        Returns:
+            回收的磁盘字节数（数据库文件与 WAL 之和的减少量）
+        """
+        before = self._disk_usage()
+        try:
+            conn = self._get_conn()
+            incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+            while incremental and conn.execute("PRAGMA freelist_count").fetchone()[0] > 0:
+                # execute() 对该 PRAGMA 只单步执行一次（仅释放1页），executescript 会执行到底
+                conn.executescript(f"PRAGMA incremental_vacuum({self.VACUUM_STEP_PAGES});")
+                time.sleep(self.RETENTION_BATCH_PAUSE)
+
+            busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            if busy:
+                logger.debug("WAL 检查点未能截断（存在活动读者），下次维护再试")
+        except Exception as e:
+            logger.error(f"回收数据库空间失败: {e}")
+
+        return max(0, before - self._disk_usage())
+
+    def _disk_usage(self) -> int:
+        """数据库文件与 WAL 文件的总字节数"""
+        total = 0
+        for suffix in ("", "-wal"):
+            try:
+                total += os.path.getsize(self.db_path + suffix)
+            except OSError:
+                pass
+        return total
+
+    def run_maintenance(
+        self,
+        days: int = 7,
+        batch_size: int = RETENTION_BATCH_SIZE,
+        archive: Optional[CommandArchive] = None
+    ) -> Dict[str, int]:
+        """
+        执行一次保留期维护：分批移除过期记录、回收空闲页、截断 WAL
+
+        Args:
+            days: 保留天数
+            batch_size: 每批移除的命令数
+            archive: 若指定，过期命令移入归档而不是直接删除
+
+        Returns:
+            {'commands': 移出队列的命令数, 'archived': 其中归档的数量,
+             'outbox': 删除发件箱记录数, 'reclaimed_bytes': 回收字节数}
+        """
+        started = time.monotonic()
+        if archive is not None:
+            removed = archived = self.archive_old_completed(archive, days, batch_size)
+        else:
+            removed, archived = self.delete_old_completed(days, batch_size), 0
+        report = {
+            "commands": removed,
+            "archived": archived,
+            "outbox": self.delete_old_outbox(days),
+            "reclaimed_bytes": self.compact(),
+        }
+        logger.info(
+            f"数据库维护完成: 移除命令 {report['commands']} 条（归档 {report['archived']} 条）, "
+            f"发件箱 {report['outbox']} 条, "
+            f"回收 {report['reclaimed_bytes']} 字节, 耗时 {time.monotonic() - started:.2f} 秒"
+        )
+        return report
+
     def get_stats(self) -> Dict[str, int]:
         """
         获取队列统计信息
 
+        读取触发器维护的 command_stats 计数表，开销与历史命令数量无关。
+
         Returns:
             统计字典
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                stats = {}
-
-                for status in [self.STATUS_PENDING, self.STATUS_PROCESSING,
-                             self.STATUS_COMPLETED, self.STATUS_FAILED]:
-                    cursor = conn.execute(
-                        "SELECT COUNT(*) FROM commands WHERE status = ?",
-                        (status,)
-                    )
-                    stats[status] = cursor.fetchone()[0]
-
+            with self._get_conn() as conn:
+                stats = dict.fromkeys([self.STATUS_PENDING, self.STATUS_PROCESSING,
+                                       self.STATUS_COMPLETED, self.STATUS_FAILED], 0)
+                for row in conn.execute("SELECT status, count FROM command_stats"):
+                    stats[row["status"]] = row["count"]
                 return stats
         except Exception as e:
             logger.error(f"获取统计信息失败: {e}")
             return {}
 
-    def reset_stuck_commands(self, timeout_minutes: int = 30) -> int:
+    def get_mailbox_watermark(self, mailbox: str) -> Optional[Dict]:
         """
-        重置卡住的命令（处理中但超时）
+        获取邮箱的 UID 同步水位
 
         Args:
-            timeout_minutes: 超时时间（分钟）
+            mailbox: 邮箱标识
 
         Returns:
-            重置的命令数量
+            {'uidvalidity': int, 'last_uid': int}，不存在返回None
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute(
+            with self._get_conn() as conn:
+                row = conn.execute(
+                    "SELECT uidvalidity, last_uid FROM mailbox_state WHERE mailbox = ?",
+                    (mailbox,)
+                ).fetchone()
+                return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"获取同步水位失败: {e}")
+            return None
+
+    def save_mailbox_watermark(self, mailbox: str, uidvalidity: int, last_uid: int) -> bool:
+        """
+        保存邮箱的 UID 同步水位
+
+        Args:
+            mailbox: 邮箱标识
+            uidvalidity: 邮箱 UIDVALIDITY
+            last_uid: 已处理的最大UID
+
+        Returns:
+            是否成功
+        """
+        try:
+            with self._get_conn() as conn:
+                conn.execute(
                     """
-                    UPDATE commands
-                    SET status = 'pending', updated_at = CURRENT_TIMESTAMP
-                    WHERE status = 'processing'
-                    AND updated_at < datetime('now', '-' || ? || ' minutes')
+                    INSERT INTO mailbox_state (mailbox, uidvalidity, last_uid, updated_at)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(mailbox) DO UPDATE SET
+                        uidvalidity = excluded.uidvalidity,
+                        last_uid = excluded.last_uid,
+                        updated_at = CURRENT_TIMESTAMP
                     """,
-                    (timeout_minutes,)
+                    (mailbox, uidvalidity, last_uid)
                 )
                 conn.commit()
-                reset = cursor.rowcount
-                if reset > 0:
-                    logger.warning(f"重置卡住的命令: {reset} 条")
-                return reset
+                return True
         except Exception as e:
-            logger.error(f"重置卡住的命令失败: {e}")
+            logger.error(f"保存同步水位失败: {e}")
+            return False
+
+    def reclaim_expired_leases(self, max_retries: int = 3) -> int:
+        """
+        回收租约已过期的命令（worker 崩溃或失联），重新置为待处理
+
+        每次回收计入重试次数，达到 max_retries 的命令（例如每次执行都会让 worker 崩溃）
+        直接标记为失败，不再无限循环，并在同一事务内向发件人写入失败通知。
+        没有租约信息的 processing 命令（旧版本遗留）同样会被回收。
+
+        Args:
+            max_retries: 最大重试次数
+
+        Returns:
+            回收的命令数量（含标记为失败的）
+        """
+        expired = "status = ? AND (lease_expires_at IS NULL OR lease_expires_at < CURRENT_TIMESTAMP)"
+        release = "worker_id = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP"
+        error = "租约多次过期（worker 崩溃或失联），放弃执行"
+
+        def write(conn: sqlite3.Connection) -> tuple:
+            conn.execute("BEGIN IMMEDIATE")
+            doomed = conn.execute(
+                f"""
+                SELECT id, sender, command, subject, message_id FROM commands
+                WHERE {expired} AND retry_count >= ?
+                """,
+                (self.STATUS_PROCESSING, max_retries)
+            ).fetchall()
+            failed = conn.execute(
+                f"""
+                UPDATE commands
+                SET status = ?, error = ?, next_attempt_at = NULL,
+                    completed_at = CURRENT_TIMESTAMP, {release}
+                WHERE {expired} AND retry_count >= ?
+                """,
+                (self.STATUS_FAILED, error, self.STATUS_PROCESSING, max_retries)
+            ).rowcount
+            for row in doomed:
+                self._insert_outbox(conn, row["id"], {
+                    "recipient": row["sender"],
+                    "subject": f"❌ Claude执行失败 - {(row['subject'] or '无主题')[:30]}",
+                    "body": f"{error}\n\n命令: {row['command']}",
+                    "in_reply_to": row["message_id"],
+                })
+            requeued = conn.execute(
+                f"""
+                UPDATE commands
+                SET status = ?, retry_count = retry_count + 1, {release}
+                WHERE {expired}
+                """,
+                (self.STATUS_PENDING, self.STATUS_PROCESSING)
+            ).rowcount
+            return requeued, failed
+
+        try:
+            requeued, failed = self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"回收过期租约失败: {e}")
             return 0
 
+        if failed > 0:
+            logger.error(f"租约多次过期，命令标记为失败: {failed} 条")
+        if requeued > 0:
+            logger.warning(f"回收租约过期的命令: {requeued} 条")
+            self.notify_work()
+        return requeued + failed
+
+    def _write(self, operation: Callable[[sqlite3.Connection], Any]) -> Any:
+        """
+        在当前线程连接的事务中执行写操作，数据库被锁时按指数退避重试
+
+        Args:
+            operation: operation(conn) -> 返回值，正常返回时提交，异常时回滚
+
+        Returns:
+            operation 的返回值
+
+        Raises:
+            sqlite3.Error: 重试后仍被锁，或其他数据库错误
+        """
+        conn = self._get_conn()
+        for attempt in range(self.WRITE_RETRIES + 1):
+            try:
+                with conn:
+                    return operation(conn)
+            except sqlite3.OperationalError as e:
+                message = str(e).lower()
+                if attempt >= self.WRITE_RETRIES or not ("locked" in message or "busy" in message):
+                    raise
+                delay = self.WRITE_RETRY_DELAY * 2 ** attempt
+                logger.warning(f"数据库繁忙，{delay:.1f} 秒后重试写入: {e}")
+                time.sleep(delay)
+
+    def enqueue_outbox(
+        self,
+        recipient: str,
+        subject: str,
+        body: str,
+        command_id: Optional[int] = None,
+        in_reply_to: Optional[str] = None,
+        attachment_path: Optional[str] = None
+    ) -> Optional[int]:
+        """
+        将结果邮件写入发件箱
+
+        附件会被移动到 outbox_dir 下，发送成功或最终放弃后删除。
+
+        Args:
+            recipient: 收件人
+            subject: 邮件主题
+            body: 邮件正文
+            command_id: 关联的命令ID
+            in_reply_to: 原始邮件 Message-ID（作为回复发送）
+            attachment_path: 附件文件路径
+
+        Returns:
+            发件箱记录ID，失败返回None
+        """
+        try:
+            if attachment_path:
+                attachment_path = self._adopt_attachment(attachment_path)
+
+            mail = {
+                "recipient": recipient, "subject": subject, "body": body,
+                "in_reply_to": in_reply_to, "attachment_path": attachment_path
+            }
+            with self._get_conn() as conn:
+                outbox_id = self._insert_outbox(conn, command_id, mail)
+                conn.commit()
+                return outbox_id
+        except Exception as e:
+            logger.error(f"写入发件箱失败: {e}")
+            return None
+
+    @staticmethod
+    def _insert_outbox(conn: sqlite3.Connection, command_id: Optional[int], mail: Dict) -> int:
+        """在调用方的事务内插入发件箱记录，返回记录ID"""
+        cursor = conn.execute(
+            """
+            INSERT INTO outbox
+                (command_id, recipient, subject, body, in_reply_to, attachment_path)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                command_id, mail["recipient"], mail["subject"], mail["body"],
+                mail.get("in_reply_to"), mail.get("attachment_path")
+            )
+        )
+        logger.info(f"结果邮件入发件箱: id={cursor.lastrowid}, command_id={command_id}, to={mail['recipient']}")
+        return cursor.lastrowid
+
+    def _stage_outbox(self, outbox: Optional[Dict]) -> Optional[Dict]:
+        """事务前把结果邮件的附件移入发件箱目录，返回待写入的邮件"""
+        if outbox is None:
+            return None
+        mail = dict(outbox)
+        if mail.get("attachment_path"):
+            try:
+                mail["attachment_path"] = self._adopt_attachment(mail["attachment_path"])
+            except OSError as e:
+                logger.warning(f"附件移入发件箱失败，邮件不带附件发送: {e}")
+                mail["attachment_path"] = None
+        return mail
+
+    @staticmethod
+    def _unstage_outbox(outbox: Optional[Dict], mail: Optional[Dict]) -> None:
+        """邮件未写入发件箱（事务失败或租约丢失）时把附件移回原位，由调用方继续处理"""
+        if not outbox or not mail:
+            return
+        source, staged = outbox.get("attachment_path"), mail.get("attachment_path")
+        if not source or not staged or staged == source:
+            return
+        try:
+            shutil.move(staged, source)
+        except OSError as e:
+            logger.warning(f"附件移回原位失败: {e}")
+
+    def _adopt_attachment(self, path: str) -> Optional[str]:
+        """把临时附件移动到发件箱目录，文件不存在时返回None"""
+        source = Path(path)
+        if not source.exists():
+            logger.warning(f"附件文件不存在，忽略: {path}")
+            return None
+        if source.parent == self.outbox_dir:
+            return str(source)
+
+        self.outbox_dir.mkdir(parents=True, exist_ok=True)
+        target = self.outbox_dir / source.name
+        shutil.move(str(source), str(target))
+        return str(target)
+
+    def get_due_outbox(self, limit: int = 10) -> List[Dict]:
+        """
+        获取已到发送时间的发件箱记录
+
+        Args:
+            limit: 最大返回数量
+
+        Returns:
+            发件箱记录列表（按入队顺序）
+        """
+        try:
+            with self._get_conn() as conn:
+                cursor = conn.execute(
+                    """
+                    SELECT * FROM outbox
+                    WHERE status = ? AND next_attempt_at <= CURRENT_TIMESTAMP
+                    ORDER BY id ASC
+                    LIMIT ?
+                    """,
+                    (self.OUTBOX_PENDING, limit)
+                )
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"获取发件箱失败: {e}")
+            return []
+
+    def next_outbox_delay(self) -> Optional[float]:
+        """
+        距离下一封待发邮件到期的秒数
+
+        Returns:
+            秒数（已到期为0），发件箱为空返回None
+        """
+        try:
+            with self._get_conn() as conn:
+                row = conn.execute(
+                    """
+                    SELECT (julianday(MIN(next_attempt_at)) - julianday('now')) * 86400
+                    FROM outbox WHERE status = ?
+                    """,
+                    (self.OUTBOX_PENDING,)
+                ).fetchone()
+                if row[0] is None:
+                    return None
+                return max(0.0, row[0])
+        except Exception as e:
+            logger.error(f"查询发件箱失败: {e}")
+            return None
+
+    def mark_outbox_sent(self, outbox_id: int) -> bool:
+        """
+        标记发件箱记录已发送并删除其附件
+
+        Args:
+            outbox_id: 发件箱记录ID
+
+        Returns:
+            是否成功
+        """
+        return self._finish_outbox(outbox_id, self.OUTBOX_SENT)
+
+    def mark_outbox_retry(
+        self,
+        outbox_id: int,
+        error: str,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS
+    ) -> bool:
+        """
+        记录一次发送失败，按指数退避安排下次重试
+
+        Args:
+            outbox_id: 发件箱记录ID
+            error: 错误信息
+            max_attempts: 最大尝试次数，达到后标记为 failed
+
+        Returns:
+            True 表示已安排重试，False 表示已放弃
+        """
+        try:
+            with self._get_conn() as conn:
+                row = conn.execute(
+                    "SELECT attempts FROM outbox WHERE id = ?", (outbox_id,)
+                ).fetchone()
+                if not row:
+                    return False
+
+                attempts = row["attempts"] + 1
+                if attempts >= max_attempts:
+                    conn.execute(
+                        "UPDATE outbox SET attempts = ?, last_error = ? WHERE id = ?",
+                        (attempts, error, outbox_id)
+                    )
+                    conn.commit()
+                    logger.error(f"结果邮件发送失败，已放弃: id={outbox_id}, 尝试 {attempts} 次: {error}")
+                    self._finish_outbox(outbox_id, self.OUTBOX_FAILED)
+                    return False
+
+                delay = min(self.OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), self.OUTBOX_BACKOFF_MAX)
+                conn.execute(
+                    """
+                    UPDATE outbox
+                    SET attempts = ?, last_error = ?,
+                        next_attempt_at = datetime('now', '+' || ? || ' seconds')
+                    WHERE id = ?
+                    """,
+                    (attempts, error, delay, outbox_id)
+                )
+                conn.commit()
+                logger.warning(f"结果邮件发送失败，{delay} 秒后重试 ({attempts}/{max_attempts}): id={outbox_id}")
+                return True
+        except Exception as e:
+            logger.error(f"更新发件箱失败: {e}")
+            return False
+
+    def _finish_outbox(self, outbox_id: int, status: str) -> bool:
+        """结束发件箱记录（已发送或放弃），并删除附件"""
+        try:
+            with self._get_conn() as conn:
+                row = conn.execute(
+                    "SELECT attachment_path FROM outbox WHERE id = ?", (outbox_id,)
+                ).fetchone()
+                sent_at = ", sent_at = CURRENT_TIMESTAMP" if status == self.OUTBOX_SENT else ""
+                conn.execute(
+                    f"UPDATE outbox SET status = ?, attachment_path = NULL{sent_at} WHERE id = ?",
+                    (status, outbox_id)
+                )
+                conn.commit()
+
+            if row and row["attachment_path"]:
+                try:
+                    Path(row["attachment_path"]).unlink()
+                except OSError as e:
+                    logger.debug(f"删除发件箱附件失败: {e}")
+            return True
+        except Exception as e:
+            logger.error(f"更新发件箱失败: {e}")
+            return False
+
     def close(self) -> None:
         """
         关闭队列管理器，释放所有资源
 
-        应在应用退出时调用以确保文件锁和数据库连接正确释放
+        应在应用退出时调用以确保数据库资源正确释放
         """
         logger.info("关闭队列管理器，释放资源...")
-        self._release_lock()
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+            # 丢弃所有线程的连接引用，之后的调用会重新建立连接
+            self._local = threading.local()
+
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.debug(f"关闭数据库连接时出错: {e}")
         logger.info("队列管理器已关闭")
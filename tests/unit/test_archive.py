@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+CommandArchive 单元测试
+测试命令历史归档的写入与查询
+"""
+
+import pytest
+from queue.archive import CommandArchive
+
+
+def _record(cmd_id, sender="user@example.com", completed_at="2024-01-01 00:00:00"):
+    return {
+        "id": cmd_id,
+        "sender": sender,
+        "command": f"cmd{cmd_id}",
+        "status": "completed",
+        "created_at": completed_at,
+        "completed_at": completed_at,
+        "result": "输出" * 100,
+    }
+
+
+class TestCommandArchive:
+    """归档写入与查询测试"""
+
+    @pytest.fixture
+    def archive(self, tmp_path):
+        archive = CommandArchive(str(tmp_path / "archive.db"))
+        yield archive
+        archive.close()
+
+    def test_append_and_get(self, archive):
+        """测试归档记录完整保存（含结果）"""
+        assert archive.append([_record(1)])
+
+        assert archive.get(1) == _record(1)
+        assert archive.get(2) is None
+
+    def test_append_is_idempotent(self, archive):
+        """测试重复归档同一命令不会产生重复记录"""
+        archive.append([_record(1), _record(2)])
+        archive.append([_record(2), _record(3)])
+
+        assert archive.count() == 3
+
+    def test_search_by_sender_and_date(self, archive):
+        """测试按发件人与完成时间查询，新的在前"""
+        archive.append([
+            _record(1, "a@example.com", "2024-01-01 10:00:00"),
+            _record(2, "b@example.com", "2024-01-02 10:00:00"),
+            _record(3, "a@example.com", "2024-01-03 10:00:00"),
+            _record(4, "a@example.com", "2024-01-05 10:00:00"),
+        ])
+
+        found = archive.search(sender="a@example.com", since="2024-01-02", until="2024-01-05")
+        assert [cmd["id"] for cmd in found] == [3]
+
+        assert [cmd["id"] for cmd in archive.search(sender="a@example.com")] == [4, 3, 1]
+        assert [cmd["id"] for cmd in archive.search(limit=2)] == [4, 3]
+
+    def test_path_for(self):
+        """测试默认归档路径与队列数据库同目录"""
+        assert CommandArchive.path_for("/data/commands.db") == "/data/commands_archive.db"
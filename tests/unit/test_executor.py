@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+ClaudeExecutor 单元测试
+测试 PTY 交互模式与输出处理
+"""
+
+import os
+import re
+import sys
+import threading
+import time
+import pytest
+from core.executor import ClaudeExecutor, StreamCapture, strip_ansi
+
+
+FAKE_CLAUDE = """#!{python}
+import sys, time
+time.sleep({startup_delay})
+sys.stdout.write("\\x1b[1mWelcome\\x1b[0m\\n? for shortcuts\\n> ")
+sys.stdout.flush()
+line = sys.stdin.readline()
+sys.stdout.write("结果: " + line.strip() + "\\nTotal cost: $0.01\\n")
+sys.stdout.flush()
+sys.stdin.read()
+"""
+
+
+@pytest.fixture
+def fake_claude(tmp_path, monkeypatch):
+    """在 PATH 中放置一个模拟交互界面的 claude 脚本"""
+    def install(startup_delay: float = 0.0):
+        script = tmp_path / "bin" / "claude"
+        script.parent.mkdir(exist_ok=True)
+        script.write_text(
+            FAKE_CLAUDE.format(python=sys.executable, startup_delay=startup_delay),
+            encoding="utf-8"
+        )
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{script.parent}{os.pathsep}{os.environ['PATH']}")
+    return install
+
+
+FAKE_PRINT_CLAUDE = """#!{python}
+import os, sys
+args = sys.argv[1:]
+if args == ["--help"]:
+    print({help_text!r})
+    sys.exit(0)
+with open(os.environ["FAKE_CLAUDE_LOG"], "a") as f:
+    f.write(" ".join(args) + "\\n")
+mode = os.environ.get("FAKE_CLAUDE_MODE", "ok")
+if mode == "usage":
+    sys.stderr.write("error: unknown option '-p'\\n")
+    sys.exit(2)
+if mode == "fail":
+    sys.exit(1)
+if mode == "hang":
+    import time
+    time.sleep(60)
+if mode == "fork":
+    import subprocess, time
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    with open(os.environ["FAKE_CLAUDE_LOG"] + ".child", "w") as f:
+        f.write(str(child.pid))
+    time.sleep(60)
+if mode == "huge":
+    for i in range(20000):
+        sys.stdout.write("\\x1b[32mline %06d\\x1b[0m 输出\\n" % i)
+print("done: " + args[-1])
+"""
+
+
+@pytest.fixture
+def fake_print_claude(tmp_path, monkeypatch):
+    """在 PATH 中放置一个支持 --help / -p 的 claude 脚本，返回调用日志路径"""
+    log = tmp_path / "calls.log"
+    log.touch()
+    monkeypatch.setenv("FAKE_CLAUDE_LOG", str(log))
+
+    def install(mode: str = "ok", help_text: str = "-p, --print  Print response\n--no-session-persistence"):
+        script = tmp_path / "bin" / "claude"
+        script.parent.mkdir(exist_ok=True)
+        script.write_text(
+            FAKE_PRINT_CLAUDE.format(python=sys.executable, help_text=help_text),
+            encoding="utf-8"
+        )
+        script.chmod(0o755)
+        monkeypatch.setenv("FAKE_CLAUDE_MODE", mode)
+        monkeypatch.setenv("PATH", f"{script.parent}{os.pathsep}{os.environ['PATH']}")
+        return log
+    return install
+
+
+@pytest.fixture
+def executor(tmp_path):
+    executor = ClaudeExecutor(output_file=tmp_path / "out.txt", timeout=30, pty_idle_timeout=0.5)
+    executor.set_project_dir(str(tmp_path))
+    return executor
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="PTY 仅在 Unix 可用")
+class TestUnixPtyMode:
+    """PTY 交互模式测试"""
+
+    def test_runs_command_and_extracts_summary(self, fake_claude, executor):
+        """测试发送命令并提取总结（含多字节字符）"""
+        fake_claude()
+
+        result = executor._run_unix_pty_mode("hello 世界")
+
+        assert result["success"] == True
+        assert "结果: hello 世界" in result["output"]
+        assert result["summary"] == "Total cost: $0.01"
+
+    def test_waits_for_prompt_instead_of_fixed_sleep(self, fake_claude, executor):
+        """测试启动较慢时等待提示符出现后再发送命令"""
+        fake_claude(startup_delay=1.5)
+
+        result = executor._run_unix_pty_mode("slow start")
+
+        assert "结果: slow start" in result["output"]
+
+    def test_idle_policy_bounds_wall_time(self, fake_claude, executor):
+        """测试空闲判定按配置时间结束，而非固定迭代次数"""
+        fake_claude()
+
+        start = time.monotonic()
+        executor._run_unix_pty_mode("quick")
+
+        assert time.monotonic() - start < 3
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="模拟脚本依赖 shebang")
+class TestExecuteFallback:
+    """能力探测与回退策略测试"""
+
+    @pytest.fixture
+    def pty_calls(self, executor, monkeypatch):
+        calls = []
+
+        def fake_pty(command):
+            calls.append(command)
+            return {"success": True, "output": "pty", "summary": "pty", "error": None}
+
+        monkeypatch.setattr(executor, "_run_with_pty_mode", fake_pty)
+        return calls
+
+    def test_probe_detects_flags_and_is_cached(self, fake_print_claude, executor):
+        """测试能力探测解析参数并缓存结果"""
+        fake_print_claude(help_text="-p, --print  Print response")
+
+        caps = executor.probe_capabilities()
+
+        assert caps == {"available": True, "print_mode": True, "no_session_persistence": False}
+        assert executor.probe_capabilities() is caps
+
+    def test_print_mode_success(self, fake_print_claude, executor, pty_calls):
+        """测试 print 模式成功时不使用 PTY"""
+        log = fake_print_claude()
+
+        result = executor.execute("hello")
+
+        assert result["success"] == True
+        assert "done: hello" in result["output"]
+        assert log.read_text().splitlines() == ["-p --no-session-persistence hello"]
+        assert pty_calls == []
+
+    def test_started_failure_does_not_rerun(self, fake_print_claude, executor, pty_calls):
+        """测试 print 模式已执行后失败不会回退重跑"""
+        log = fake_print_claude(mode="fail")
+
+        result = executor.execute("expensive job")
+
+        assert result["success"] == False
+        assert len(log.read_text().splitlines()) == 1
+        assert pty_calls == []
+
+    def test_usage_error_falls_back(self, fake_print_claude, executor, pty_calls):
+        """测试参数不被接受（命令未执行）时回退到 PTY"""
+        fake_print_claude(mode="usage")
+
+        result = executor.execute("hello")
+
+        assert result["output"] == "pty"
+        assert pty_calls == ["hello"]
+
+    def test_no_print_support_uses_pty_directly(self, fake_print_claude, executor, pty_calls):
+        """测试不支持 print 模式时直接使用 PTY"""
+        log = fake_print_claude(help_text="Usage: claude [prompt]")
+
+        executor.execute("hello")
+
+        assert log.read_text() == ""
+        assert pty_calls == ["hello"]
+
+
+class TestStreamCapture:
+    """流式输出捕获测试"""
+
+    @pytest.fixture
+    def strip(self, tmp_path):
+        return ClaudeExecutor(output_file=tmp_path / "out.txt")._strip_ansi
+
+    def test_escape_and_utf8_split_across_chunks(self, strip):
+        """测试跨块的转义序列和多字节字符被正确处理"""
+        capture = StreamCapture(strip)
+        data = "\x1b[31m红色\x1b[0m 文本".encode("utf-8")
+
+        for i in range(len(data)):
+            capture.feed(data[i:i + 1])
+        capture.close()
+
+        assert capture.text() == "红色 文本"
+
+    def test_spills_and_bounds_memory(self, strip):
+        """测试超过阈值后落盘，内存只保留尾部"""
+        capture = StreamCapture(strip, spill_threshold=1000, tail_size=100)
+        for i in range(500):
+            capture.feed(f"line {i:04d}\n".encode("utf-8"))
+        capture.close()
+
+        try:
+            assert capture.spilled
+            assert len(capture.tail) == 100
+            assert capture.tail.endswith("line 0499\n")
+            full = capture.spill_path.read_text(encoding="utf-8")
+            assert full.startswith("line 0000\n")
+            assert len(full) == capture.size
+        finally:
+            capture.discard()
+
+        assert capture.spill_path is None
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="模拟脚本依赖 shebang")
+class TestPrintModeStreaming:
+    """print 模式流式捕获测试"""
+
+    def test_huge_output_spills_to_file(self, fake_print_claude, executor, monkeypatch):
+        """测试大输出写入临时文件，结果中只保留尾部"""
+        fake_print_claude(mode="huge")
+        monkeypatch.setattr(executor, "OUTPUT_SPILL_THRESHOLD", 10000)
+        monkeypatch.setattr(executor, "OUTPUT_TAIL_SIZE", 2000)
+
+        result = executor.execute("big")
+
+        try:
+            assert result["success"] == True
+            assert result["output_file"] is not None
+            assert len(result["output"]) < 2100
+            assert result["output"].rstrip().endswith("done: big")
+            with open(result["output_file"], encoding="utf-8") as f:
+                full = f.read()
+            assert full.startswith("line 000000 输出\n")
+            assert "\x1b" not in full
+        finally:
+            os.unlink(result["output_file"])
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="进程组仅在 Unix 可用")
+class TestTerminate:
+    """停机终止测试"""
+
+    def test_terminate_all_kills_running_command(self, fake_print_claude, executor):
+        """测试 terminate_all 终止运行中的 claude，结果标记为被中止"""
+        log = fake_print_claude(mode="hang")
+        results = []
+        worker = threading.Thread(target=lambda: results.append(executor.execute("slow")))
+        worker.start()
+
+        deadline = time.monotonic() + 10
+        while not log.read_text().strip() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        started = time.monotonic()
+        assert executor.terminate_all(timeout=2) == 1
+        worker.join(timeout=10)
+
+        assert not worker.is_alive()
+        assert time.monotonic() - started < 10
+        assert results[0]["success"] == False
+        assert results[0]["terminated"] == True
+
+    def test_timeout_kills_forked_children(self, fake_print_claude, executor):
+        """测试超时结束整个进程组，claude 派生的子进程不会继续占用输出管道"""
+        log = fake_print_claude(mode="fork")
+        executor.timeout = 1
+
+        started = time.monotonic()
+        result = executor.execute("slow")
+
+        assert result["success"] == False
+        assert "超时" in result["error"]
+        assert time.monotonic() - started < 5
+        child_pid = int((log.parent / (log.name + ".child")).read_text())
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            try:
+                os.kill(child_pid, 0)
+            except ProcessLookupError:
+                break
+            time.sleep(0.05)
+        else:
+            pytest.fail("claude 派生的子进程在超时后仍在运行")
+
+    def test_execute_after_terminate_does_not_spawn(self, fake_print_claude, executor):
+        """测试停机后不再启动新进程"""
+        log = fake_print_claude()
+        executor.terminate_all(timeout=0)
+
+        result = executor.execute("late")
+
+        assert result["terminated"] == True
+        assert log.read_text() == ""
+
+    def test_concurrent_summary_writes_stay_whole(self, executor):
+        """测试多个 worker 同时写摘要时文件内容不会交错"""
+        summaries = [f"summary {i}\n" + "x" * 20000 for i in range(8)]
+        threads = [
+            threading.Thread(target=executor._save_summary, args=(text, f"cmd {i}"))
+            for i, text in enumerate(summaries)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        content = executor.output_file.read_text(encoding="utf-8")
+        assert any(text in content for text in summaries)
+        assert content.count("summary ") == 1
+
+
+def _legacy_strip_ansi(text: str) -> str:
+    """旧实现（逐字符过滤），作为正确性基准（性能对比见 benchmarks/bench_strip_ansi.py）"""
+    text = re.sub(r'\x1b\[[0-?]*[ -/]*[@-~]', '', text)
+    text = re.sub(r'\x1b\][^\x07\x1b]*[\x07\x1b\\]', '', text)
+    cleaned = []
+    for char in text:
+        code = ord(char)
+        if code >= 32 or code in (9, 10):
+            cleaned.append(char)
+    return ''.join(cleaned)
+
+
+class TestStripAnsiEquivalence:
+    """ANSI 清理与旧实现一致性测试"""
+
+    PTY_LINE = "\x1b[2K\x1b[1G\x1b[38;5;246m│\x1b[39m 处理文件 src/module_{:05d}.py … \x1b]0;claude\x07ok\r\n"
+    PLAIN_LINE = "plain log line {:05d} 普通输出\r\n"
+
+    @pytest.fixture(params=["pty", "plain", "ascii"])
+    def capture_text(self, request):
+        if request.param == "pty":
+            return "".join(self.PTY_LINE.format(i) for i in range(2000))
+        if request.param == "plain":
+            return "".join(self.PLAIN_LINE.format(i) for i in range(2000))
+        return "".join(f"\x1b[32mok\x1b[0m line {i:05d}\r\n" for i in range(2000))
+
+    def test_matches_legacy_output(self, capture_text):
+        """测试与旧实现输出一致"""
+        assert strip_ansi(capture_text) == _legacy_strip_ansi(capture_text)
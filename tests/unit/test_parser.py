@@ -198,3 +198,30 @@ class TestEmailParserComplete:
         assert "<h1>" not in result
         assert "Title" in result
         assert "This is a paragraph" in result
+
+    def test_parse_headers_only(self):
+        """测试仅凭邮件头完成白名单判定"""
+        parser = EmailParser(["allowed@example.com"])
+        raw_headers = (
+            b"From: Someone <other@example.com>\r\n"
+            b"Subject: hello\r\n"
+            b"Message-ID: <abc@example.com>\r\n\r\n"
+        )
+
+        headers = parser.parse_headers(raw_headers)
+
+        assert headers["sender"] == "other@example.com"
+        assert headers["subject"] == "hello"
+        assert headers["message_id"] == "<abc@example.com>"
+        assert headers["is_whitelisted"] == False
+
+    def test_extract_priority_from_subject(self):
+        """测试从主题标记提取优先级"""
+        parser = EmailParser()
+
+        assert parser.extract_priority("[urgent] fix prod") == 2
+        assert parser.extract_priority("build [LOW]") == -1
+        assert parser.extract_priority("[P3] deploy") == 3
+        assert parser.extract_priority("[priority:-2] cleanup") == -2
+        assert parser.extract_priority("[P99] abuse") == EmailParser.MAX_PRIORITY
+        assert parser.extract_priority("plain subject") == 0
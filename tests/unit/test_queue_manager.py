@@ -6,6 +6,7 @@ CommandQueue 单元测试
 
 import pytest
 import time
+from pathlib import Path
 from queue.manager import CommandQueue
 
 
@@ -61,6 +62,43 @@ class TestCommandQueueEnqueueDequeue:
         # 验证状态
         assert cmd['status'] == "processing"
 
+    def test_dequeue_records_lease(self, queue):
+        """测试出队记录 worker_id 与租约到期时间"""
+        queue.enqueue("user@example.com", "test cmd")
+
+        cmd = queue.dequeue(worker_id="worker-a", lease_seconds=120)
+
+        assert cmd['worker_id'] == "worker-a"
+        assert cmd['lease_expires_at'] is not None
+        assert queue.get_by_id(cmd['id'])['worker_id'] == "worker-a"
+
+    def test_dequeue_immediate_fallback(self, queue, monkeypatch):
+        """测试旧版SQLite的 BEGIN IMMEDIATE 认领路径"""
+        monkeypatch.setattr(CommandQueue, "_SUPPORTS_RETURNING", False)
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+
+        cmd = queue.dequeue(worker_id="worker-b")
+
+        assert cmd['id'] == cmd_id
+        assert cmd['status'] == "processing"
+        stored = queue.get_by_id(cmd_id)
+        assert stored['worker_id'] == "worker-b"
+        assert stored['lease_expires_at'] == cmd['lease_expires_at']
+        assert "new_lease_expires_at" not in cmd
+        assert queue.reclaim_expired_leases() == 0
+        assert queue.dequeue() is None
+
+    def test_complete_clears_lease(self, queue):
+        """测试完成后清除租约归属"""
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue(worker_id="worker-a")
+
+        queue.update_status(cmd_id, "completed", result="ok")
+
+        cmd = queue.get_by_id(cmd_id)
+        assert cmd['worker_id'] is None
+        assert cmd['lease_expires_at'] is None
+
     def test_fifo_order(self, queue):
         """测试先入先出顺序"""
         queue.enqueue("user1@example.com", "cmd1")
@@ -115,7 +153,7 @@ class TestCommandQueueStatus:
 
         queue.update_status(cmd_id, "completed", result="Command output here")
 
-        cmd = queue.get_by_id(cmd_id)
+        cmd = queue.get_by_id(cmd_id, include_result=True)
         assert cmd['result'] == "Command output here"
 
     def test_update_status_with_error(self, queue):
@@ -231,13 +269,1021 @@ class TestCommandQueueMaintenance:
     def queue(self, temp_db):
         return CommandQueue(db_path=temp_db, use_lock=False)
 
-    def test_close_releases_lock(self, temp_db):
-        """测试关闭释放文件锁"""
-        # 使用带锁的队列
-        locked_queue = CommandQueue(db_path=temp_db, use_lock=True)
+    def test_close_then_reopen(self, temp_db):
+        """测试关闭后可由新实例继续出队"""
+        first = CommandQueue(db_path=temp_db, use_lock=True)
+        first.enqueue("user@example.com", "test cmd")
+        first.close()
+
+        second = CommandQueue(db_path=temp_db, use_lock=True)
+        assert second.dequeue() is not None
+
+    def _age_finished(self, queue, days):
+        """把已结束命令的完成时间改到 days 天前"""
+        conn = queue._get_conn()
+        conn.execute(
+            "UPDATE commands SET completed_at = datetime('now', ?) WHERE completed_at IS NOT NULL",
+            (f"-{days} days",)
+        )
+        conn.commit()
+
+    def test_delete_old_completed_in_batches(self, queue):
+        """测试分批删除过期命令及其结果，未过期与未结束的命令保留"""
+        for i in range(7):
+            cmd_id = queue.enqueue("user@example.com", f"cmd{i}")
+            queue.update_status(cmd_id, CommandQueue.STATUS_COMPLETED, result="ok")
+        self._age_finished(queue, 10)
+        recent = queue.enqueue("user@example.com", "recent")
+        queue.update_status(recent, CommandQueue.STATUS_COMPLETED)
+        queue.enqueue("user@example.com", "pending")
+
+        assert queue.delete_old_completed(days=7, batch_size=3) == 7
+        assert queue.get_stats() == {"pending": 1, "processing": 0, "completed": 1, "failed": 0}
+        orphans = queue._get_conn().execute("SELECT COUNT(*) FROM command_results").fetchone()[0]
+        assert orphans == 0
+
+    def test_failed_commands_expire(self, queue):
+        """测试失败命令记录完成时间，也会被保留期清理删除"""
+        cmd_id = queue.enqueue("user@example.com", "bad")
+        queue.update_status(cmd_id, CommandQueue.STATUS_FAILED, error="boom")
+        assert queue.get_by_id(cmd_id)["completed_at"] is not None
+
+        self._age_finished(queue, 10)
+
+        assert queue.delete_old_completed(days=7) == 1
+
+    def test_legacy_failed_rows_backfilled(self, temp_db):
+        """测试旧数据库中缺少 completed_at 的失败命令在启动时补齐"""
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+        cmd_id = queue.enqueue("user@example.com", "bad")
+        conn = queue._get_conn()
+        conn.execute("UPDATE commands SET status = 'failed', completed_at = NULL WHERE id = ?", (cmd_id,))
+        conn.commit()
+        queue.close()
+
+        reopened = CommandQueue(db_path=temp_db, use_lock=False)
+
+        assert reopened.get_by_id(cmd_id)["completed_at"] is not None
+
+    def test_run_maintenance_reclaims_space(self, queue):
+        """测试维护删除过期记录后回收磁盘空间"""
+        queue.enqueue_many([
+            {"sender": "user@example.com", "command": "x" * 4000 + str(i)} for i in range(200)
+        ])
+        conn = queue._get_conn()
+        conn.execute("UPDATE commands SET status = 'completed', completed_at = datetime('now', '-10 days')")
+        conn.commit()
+        queue.compact()
+
+        report = queue.run_maintenance(days=7)
+
+        assert report["commands"] == 200
+        assert report["reclaimed_bytes"] > 0
+        assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+
+    def test_legacy_database_converted_at_startup(self, temp_db):
+        """测试旧数据库在初始化时（而不是后台维护时）切换到增量回收模式"""
+        import sqlite3
+
+        legacy = sqlite3.connect(temp_db)
+        legacy.execute("CREATE TABLE legacy (x)")
+        legacy.commit()
+        legacy.close()
+
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+
+        assert queue._get_conn().execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    def test_compact_never_runs_full_vacuum(self, queue):
+        """测试维护时即使不是增量回收模式也不会执行全量 VACUUM"""
+        conn = queue._get_conn()
+        conn.execute("PRAGMA auto_vacuum = NONE")
+        conn.execute("VACUUM")
+        statements = []
+        conn.set_trace_callback(statements.append)
+
+        queue.compact()
+
+        conn.set_trace_callback(None)
+        assert not any(sql.strip().upper().startswith("VACUUM") for sql in statements)
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+
+    def test_archive_old_completed(self, queue, tmp_path):
+        """测试过期命令连同结果移入归档，并从队列删除"""
+        from queue.archive import CommandArchive
+
+        archive = CommandArchive(str(tmp_path / "archive.db"))
+        for i in range(5):
+            cmd_id = queue.enqueue("user@example.com", f"cmd{i}")
+            queue.update_status(cmd_id, CommandQueue.STATUS_COMPLETED, result=f"out{i}" * 200)
+        self._age_finished(queue, 10)
+        queue.enqueue("user@example.com", "pending")
+
+        report = queue.run_maintenance(days=7, batch_size=2, archive=archive)
+
+        assert report["commands"] == report["archived"] == 5
+        assert queue.get_stats()["completed"] == 0
+        assert queue.get_result(1) is None
+        assert archive.get(1)["result"] == "out0" * 200
+        assert len(archive.search(sender="user@example.com")) == 5
+        archive.close()
+
+    def test_delete_old_outbox(self, queue):
+        """测试只删除已结束的旧发件箱记录"""
+        sent = queue.enqueue_outbox("user@example.com", "done", "body")
+        queue.enqueue_outbox("user@example.com", "waiting", "body")
+        queue.mark_outbox_sent(sent)
+        conn = queue._get_conn()
+        conn.execute("UPDATE outbox SET created_at = datetime('now', '-10 days')")
+        conn.commit()
+
+        assert queue.delete_old_outbox(days=7) == 1
+        assert len(queue.get_due_outbox(10)) == 1
+
+
+class TestCommandQueueConcurrency:
+    """多 worker 并发出队测试"""
+
+    def test_concurrent_dequeue_no_duplicates(self, temp_db):
+        """测试多个线程并发出队不会重复领取同一命令"""
+        import threading
+
+        queue = CommandQueue(db_path=temp_db, use_lock=True)
+        for i in range(50):
+            queue.enqueue(f"user{i}@example.com", f"cmd{i}")
+
+        claimed = []
+        claimed_lock = threading.Lock()
+
+        def worker():
+            while True:
+                cmd = queue.dequeue()
+                if cmd is None:
+                    if not queue.get_pending_commands(limit=1):
+                        return
+                    continue
+                with claimed_lock:
+                    claimed.append(cmd['id'])
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=30)
+
+        queue.close()
+
+        assert len(claimed) == 50
+        assert len(set(claimed)) == 50
+
+    def test_migrates_old_schema(self, temp_db):
+        """测试旧版数据库自动补充租约列"""
+        import sqlite3
+
+        with sqlite3.connect(temp_db) as conn:
+            conn.execute("""
+                CREATE TABLE commands (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sender TEXT NOT NULL,
+                    command TEXT NOT NULL,
+                    message_id TEXT,
+                    subject TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    result TEXT,
+                    error TEXT,
+                    retry_count INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    completed_at TIMESTAMP
+                )
+            """)
+            conn.execute("INSERT INTO commands (sender, command) VALUES ('old@example.com', 'old cmd')")
+
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+        cmd = queue.dequeue(worker_id="worker-a")
+
+        assert cmd['command'] == "old cmd"
+        assert cmd['worker_id'] == "worker-a"
+
+
+class TestCommandQueueConnections:
+    """连接池与 WAL 测试"""
+
+    @pytest.fixture
+    def queue(self, temp_db):
+        return CommandQueue(db_path=temp_db, use_lock=False)
+
+    def test_wal_journal_mode(self, queue):
+        """测试数据库使用 WAL 日志模式"""
+        mode = queue._get_conn().execute("PRAGMA journal_mode").fetchone()[0]
+        assert mode.lower() == "wal"
+
+    def test_connection_reused_per_thread(self, queue):
+        """测试同一线程复用连接，不同线程使用独立连接"""
+        import threading
+
+        main_conn = queue._get_conn()
+        assert queue._get_conn() is main_conn
+
+        other = []
+        t = threading.Thread(target=lambda: other.append(queue._get_conn()))
+        t.start()
+        t.join()
+
+        assert other[0] is not main_conn
+
+    def test_usable_after_close(self, queue):
+        """测试关闭后再次调用会重新建立连接"""
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.close()
+
+        assert queue.get_by_id(cmd_id) is not None
+
+
+class TestCommandQueueLease:
+    """租约续约与回收测试"""
+
+    @pytest.fixture
+    def queue(self, temp_db):
+        return CommandQueue(db_path=temp_db, use_lock=False)
+
+    def test_heartbeat_extends_owned_lease(self, queue):
+        """测试持有者续约成功，非持有者续约失败"""
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue(worker_id="worker-a", lease_seconds=1)
+
+        assert queue.heartbeat(cmd_id, "worker-a", lease_seconds=600) == True
+        assert queue.heartbeat(cmd_id, "worker-b", lease_seconds=600) == False
+
+    def test_reclaim_only_expired(self, queue):
+        """测试只回收租约已过期的命令"""
+        expired_id = queue.enqueue("user1@example.com", "cmd1")
+        live_id = queue.enqueue("user2@example.com", "cmd2")
+        queue.dequeue(worker_id="worker-a", lease_seconds=-10)
+        queue.dequeue(worker_id="worker-b", lease_seconds=600)
+
+        assert queue.reclaim_expired_leases() == 1
+        assert queue.get_by_id(expired_id)['status'] == "pending"
+        assert queue.get_by_id(live_id)['status'] == "processing"
+
+    def test_update_status_rejects_lost_lease(self, queue):
+        """测试租约被回收后原 worker 无法完成命令"""
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue(worker_id="worker-a", lease_seconds=-10)
+        queue.reclaim_expired_leases()
+        queue.dequeue(worker_id="worker-b", lease_seconds=600)
+
+        assert queue.update_status(cmd_id, "completed", result="a", worker_id="worker-a") == False
+        assert queue.update_status(cmd_id, "completed", result="b", worker_id="worker-b") == True
+        assert queue.get_result(cmd_id) == "b"
+
+    def test_reclaim_counts_against_max_retries(self, queue):
+        """测试反复让 worker 失联的命令在达到重试上限后标记为失败"""
+        cmd_id = queue.enqueue("user@example.com", "crashes worker")
+
+        for attempt in range(3):
+            assert queue.dequeue(worker_id=f"worker-{attempt}", lease_seconds=-10)["id"] == cmd_id
+            assert queue.reclaim_expired_leases(max_retries=2) == 1
+
+        cmd = queue.get_by_id(cmd_id)
+        assert cmd["status"] == "failed"
+        assert cmd["retry_count"] == 2
+        assert cmd["completed_at"] is not None
+        assert queue.dequeue(worker_id="worker-x") is None
+
+    def test_reclaim_failure_queues_reply(self, queue):
+        """测试因租约多次过期而放弃的命令在发件箱中留下失败通知"""
+        cmd_id = queue.enqueue("user@example.com", "crashes worker",
+                               message_id="<m1@example.com>", subject="build")
+        requeued_id = queue.enqueue("other@example.com", "slow")
+
+        queue.dequeue(worker_id="worker-a", lease_seconds=-10)
+        queue.reclaim_expired_leases(max_retries=1)
+        assert queue.get_due_outbox() == []
+
+        queue.dequeue(worker_id="worker-b", lease_seconds=-10)
+        queue.dequeue(worker_id="worker-c", lease_seconds=-10)
+        assert queue.reclaim_expired_leases(max_retries=1) == 2
+
+        due = queue.get_due_outbox()
+        assert [item["command_id"] for item in due] == [cmd_id]
+        assert due[0]["recipient"] == "user@example.com"
+        assert due[0]["in_reply_to"] == "<m1@example.com>"
+        assert "build" in due[0]["subject"]
+        assert queue.get_by_id(requeued_id)["status"] == "pending"
+
+    def _hold_write_lock(self, temp_db, seconds):
+        """用另一个连接持有写锁 seconds 秒"""
+        import sqlite3
+        import threading
+
+        holder = sqlite3.connect(temp_db, check_same_thread=False, isolation_level=None)
+        holder.execute("BEGIN IMMEDIATE")
+
+        def release():
+            holder.execute("COMMIT")
+            holder.close()
+
+        timer = threading.Timer(seconds, release)
+        timer.start()
+        return timer
+
+    def test_write_retries_while_locked(self, queue, temp_db, monkeypatch):
+        """测试数据库短暂被锁时状态更新退避重试后成功"""
+        monkeypatch.setattr(CommandQueue, "WRITE_RETRY_DELAY", 0.05)
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue(worker_id="worker-a")
+        queue._get_conn().execute("PRAGMA busy_timeout = 0")
+
+        self._hold_write_lock(temp_db, 0.1)
+
+        assert queue.update_status(cmd_id, "completed", result="ok", worker_id="worker-a") == True
+        assert queue.get_result(cmd_id) == "ok"
+
+    def test_persistent_db_error_raises(self, queue, temp_db, monkeypatch):
+        """测试数据库持续被锁时抛出异常，而不是伪装成租约丢失"""
+        import sqlite3
+
+        monkeypatch.setattr(CommandQueue, "WRITE_RETRY_DELAY", 0.01)
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue(worker_id="worker-a")
+        queue._get_conn().execute("PRAGMA busy_timeout = 0")
+
+        timer = self._hold_write_lock(temp_db, 1.0)
+        with pytest.raises(sqlite3.OperationalError):
+            queue.update_status(cmd_id, "completed", result="ok", worker_id="worker-a")
+        with pytest.raises(sqlite3.OperationalError):
+            queue.retry_or_fail(cmd_id, "boom", worker_id="worker-a")
+        timer.join()
+
+        assert queue.get_by_id(cmd_id)["status"] == "processing"
+
+
+class TestMailboxWatermark:
+    """IMAP 同步水位持久化测试"""
+
+    def test_watermark_roundtrip(self, temp_db):
+        """测试水位保存后可由新实例读取，并可覆盖更新"""
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+        assert queue.get_mailbox_watermark("bot@imap/INBOX") is None
+
+        queue.save_mailbox_watermark("bot@imap/INBOX", 42, 100)
+        queue.save_mailbox_watermark("bot@imap/INBOX", 42, 120)
+        queue.close()
+
+        reopened = CommandQueue(db_path=temp_db, use_lock=False)
+        assert reopened.get_mailbox_watermark("bot@imap/INBOX") == {"uidvalidity": 42, "last_uid": 120}
+
+
+class TestCommandQueueWakeup:
+    """进程内唤醒测试"""
+
+    @pytest.fixture
+    def queue(self, temp_db):
+        return CommandQueue(db_path=temp_db, use_lock=False)
+
+    def test_enqueue_wakes_waiting_worker(self, queue):
+        """测试入队立即唤醒等待中的 worker"""
+        import threading
+
+        seq = queue.work_seq
+        woke = []
+        waiter = threading.Thread(target=lambda: woke.append(queue.wait_for_work(seq, 10)))
+        waiter.start()
+
+        started = time.monotonic()
+        queue.enqueue("user@example.com", "echo hi")
+        waiter.join(timeout=5)
+
+        assert woke == [True]
+        assert time.monotonic() - started < 1
+
+    def test_notification_before_wait_is_not_lost(self, queue):
+        """测试认领与等待之间发生的入队不会丢失"""
+        seq = queue.work_seq
+        assert queue.dequeue() is None
+
+        queue.enqueue("user@example.com", "echo hi")
+
+        assert queue.wait_for_work(seq, 0) == True
+
+    def test_wait_times_out_without_work(self, queue):
+        """测试无新命令时等待超时返回False"""
+        assert queue.wait_for_work(queue.work_seq, 0.05) == False
+
+    def test_requeue_notifies(self, queue):
+        """测试重试回到 pending 时通知 worker"""
+        cmd_id = queue.enqueue("user@example.com", "echo hi")
+        queue.dequeue()
+        seq = queue.work_seq
+
+        queue.update_status(cmd_id, CommandQueue.STATUS_PENDING)
+
+        assert queue.work_seq != seq
+
+
+class TestCommandQueueOutbox:
+    """持久化发件箱测试"""
+
+    @pytest.fixture
+    def queue(self, temp_db):
+        return CommandQueue(db_path=temp_db, use_lock=False)
+
+    def test_outbox_survives_reopen(self, temp_db):
+        """测试未发送的邮件在重启后仍可取出"""
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+        outbox_id = queue.enqueue_outbox("user@example.com", "done", "output",
+                                         command_id=1, in_reply_to="<m1@example.com>")
+        queue.close()
+
+        reopened = CommandQueue(db_path=temp_db, use_lock=False)
+        due = reopened.get_due_outbox()
+
+        assert [item["id"] for item in due] == [outbox_id]
+        assert due[0]["in_reply_to"] == "<m1@example.com>"
+        assert reopened.next_outbox_delay() == 0
+
+    def test_sent_item_leaves_due_list(self, queue):
+        """测试发送成功后不再出现在待发列表"""
+        outbox_id = queue.enqueue_outbox("user@example.com", "done", "output")
+
+        assert queue.mark_outbox_sent(outbox_id) == True
+        assert queue.get_due_outbox() == []
+        assert queue.next_outbox_delay() is None
+
+    def test_retry_backs_off(self, queue):
+        """测试失败后按退避时间推迟，到期前不会被取出"""
+        outbox_id = queue.enqueue_outbox("user@example.com", "done", "output")
+
+        assert queue.mark_outbox_retry(outbox_id, "timeout") == True
+
+        assert queue.get_due_outbox() == []
+        delay = queue.next_outbox_delay()
+        assert 0 < delay <= CommandQueue.OUTBOX_BACKOFF_BASE
+
+    def test_retry_gives_up_after_max_attempts(self, queue):
+        """测试达到最大尝试次数后标记为失败"""
+        outbox_id = queue.enqueue_outbox("user@example.com", "done", "output")
+
+        assert queue.mark_outbox_retry(outbox_id, "e1", max_attempts=2) == True
+        assert queue.mark_outbox_retry(outbox_id, "e2", max_attempts=2) == False
+        assert queue.next_outbox_delay() is None
+
+    def test_attachment_moved_and_removed(self, queue, tmp_path):
+        """测试附件移入发件箱目录，发送后删除"""
+        output = tmp_path / "claude_output.txt"
+        output.write_text("full output")
+
+        outbox_id = queue.enqueue_outbox("user@example.com", "done", "output",
+                                         attachment_path=str(output))
+        stored = queue.get_due_outbox()[0]["attachment_path"]
+
+        assert not output.exists()
+        assert Path(stored).parent == queue.outbox_dir
+        assert Path(stored).read_text() == "full output"
+
+        queue.mark_outbox_sent(outbox_id)
+        assert not Path(stored).exists()
+
+    @staticmethod
+    def _mail(attachment_path=None):
+        return {"recipient": "user@example.com", "subject": "done", "body": "output",
+                "in_reply_to": "<m1@example.com>", "attachment_path": attachment_path}
+
+    def test_completion_writes_outbox_atomically(self, queue, tmp_path):
+        """测试完成状态与结果邮件在同一次写入中落库"""
+        output = tmp_path / "claude_output.txt"
+        output.write_text("full output")
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue(worker_id="worker-a")
+
+        assert queue.update_status(cmd_id, "completed", result="ok", worker_id="worker-a",
+                                   outbox=self._mail(str(output))) == True
+
+        due = queue.get_due_outbox()
+        assert [item["command_id"] for item in due] == [cmd_id]
+        assert Path(due[0]["attachment_path"]).read_text() == "full output"
+        assert not output.exists()
+
+    def test_lost_lease_writes_no_outbox(self, queue, tmp_path):
+        """测试租约已丢失时不写入结果邮件，附件留在原位"""
+        output = tmp_path / "claude_output.txt"
+        output.write_text("full output")
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue(worker_id="worker-a")
+
+        assert queue.update_status(cmd_id, "completed", result="ok", worker_id="worker-b",
+                                   outbox=self._mail(str(output))) == False
+
+        assert queue.get_due_outbox() == []
+        assert output.read_text() == "full output"
+
+    def test_outbox_failure_rolls_back_status(self, queue, tmp_path, monkeypatch):
+        """测试发件箱写入失败时状态变更一并回滚，命令仍由 worker 持有"""
+        import sqlite3
+
+        def fail(conn, command_id, mail):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        output = tmp_path / "claude_output.txt"
+        output.write_text("full output")
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue(worker_id="worker-a")
+        monkeypatch.setattr(queue, "_insert_outbox", fail)
+
+        with pytest.raises(sqlite3.OperationalError):
+            queue.update_status(cmd_id, "completed", result="ok", worker_id="worker-a",
+                                outbox=self._mail(str(output)))
+
+        cmd = queue.get_by_id(cmd_id, include_result=True)
+        assert cmd["status"] == "processing"
+        assert cmd["result"] is None
+        assert output.read_text() == "full output"
+
+    def test_failure_mail_only_on_final_failure(self, queue):
+        """测试失败通知只在最终失败时写入发件箱"""
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue(worker_id="worker-a")
+
+        outcome = queue.retry_or_fail(cmd_id, "boom", max_retries=1, worker_id="worker-a",
+                                      outbox=self._mail())
+        assert outcome["retry"] == True
+        assert queue.get_due_outbox() == []
+
+        queue._get_conn().execute("UPDATE commands SET next_attempt_at = NULL")
+        queue._get_conn().commit()
+        queue.dequeue(worker_id="worker-a")
+        outcome = queue.retry_or_fail(cmd_id, "boom", max_retries=1, worker_id="worker-a",
+                                      outbox=self._mail())
+
+        assert outcome["retry"] == False
+        assert [item["command_id"] for item in queue.get_due_outbox()] == [cmd_id]
+
+
+class TestCommandQueueResults:
+    """命令结果存储测试"""
+
+    @pytest.fixture
+    def queue(self, temp_db):
+        return CommandQueue(db_path=temp_db, use_lock=False)
+
+    def test_large_result_compressed_out_of_row(self, queue):
+        """测试大结果压缩存放在独立表，命令行本身不含结果"""
+        import sqlite3
+
+        output = "claude output line\n" * 50000
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue()
+        queue.update_status(cmd_id, "completed", result=output)
+
+        assert queue.get_by_id(cmd_id)["result"] is None
+        assert queue.get_result(cmd_id) == output
+
+        with sqlite3.connect(queue.db_path) as conn:
+            encoding, size, stored = conn.execute(
+                "SELECT encoding, size, length(body) FROM command_results WHERE command_id = ?",
+                (cmd_id,)
+            ).fetchone()
+        assert encoding == "zlib"
+        assert size == len(output)
+        assert stored * 10 < size
+
+    def test_lost_lease_does_not_store_result(self, queue):
+        """测试租约丢失时不写入结果"""
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue(worker_id="worker-a")
+
+        assert queue.update_status(cmd_id, "completed", result="late",
+                                   worker_id="worker-b") == False
+        assert queue.get_result(cmd_id) is None
+
+    def test_legacy_result_column_migrated(self, temp_db):
+        """测试旧版 commands.result 中的结果迁移到独立表"""
+        import sqlite3
+
+        conn = sqlite3.connect(temp_db)
+        conn.execute("""
+            CREATE TABLE commands (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender TEXT NOT NULL, command TEXT NOT NULL,
+                message_id TEXT, subject TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                result TEXT, error TEXT, retry_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                completed_at TIMESTAMP
+            )
+        """)
+        conn.execute(
+            "INSERT INTO commands (sender, command, status, result) VALUES (?, ?, ?, ?)",
+            ("user@example.com", "ls", "completed", "旧结果")
+        )
+        conn.commit()
+        conn.close()
+
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+
+        assert queue.get_by_id(1)["result"] is None
+        assert queue.get_result(1) == "旧结果"
+
+    def test_cleanup_removes_results(self, queue):
+        """测试清理旧命令时同时删除结果"""
+        import sqlite3
+
+        cmd_id = queue.enqueue("user@example.com", "test cmd")
+        queue.dequeue()
+        queue.update_status(cmd_id, "completed", result="output")
+        with sqlite3.connect(queue.db_path) as conn:
+            conn.execute(
+                "UPDATE commands SET completed_at = datetime('now', '-30 days') WHERE id = ?",
+                (cmd_id,)
+            )
+
+        assert queue.delete_old_completed(days=7) == 1
+        assert queue.get_result(cmd_id) is None
+
+
+class TestCommandQueueStats:
+    """计数表统计测试"""
+
+    @pytest.fixture
+    def queue(self, temp_db):
+        return CommandQueue(db_path=temp_db, use_lock=False)
+
+    @staticmethod
+    def _counted(queue):
+        import sqlite3
+
+        with sqlite3.connect(queue.db_path) as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM commands GROUP BY status"))
+        return {status: counts.get(status, 0)
+                for status in ("pending", "processing", "completed", "failed")}
+
+    def test_counters_follow_transitions(self, queue):
+        """测试入队、认领、完成、失败、重试与清理后计数与实际一致"""
+        import sqlite3
+
+        ids = [queue.enqueue("user@example.com", f"cmd{i}") for i in range(5)]
+        queue.dequeue()
+        queue.dequeue()
+        queue.update_status(ids[0], "completed", result="ok")
+        queue.update_status(ids[1], "failed", error="boom")
+        queue.update_status(ids[1], "pending")
+        queue.update_status(ids[2], "pending")  # 状态未变化
+        with sqlite3.connect(queue.db_path) as conn:
+            conn.execute("UPDATE commands SET completed_at = datetime('now', '-30 days')")
+        queue.delete_old_completed(days=7)
+
+        assert queue.get_stats() == self._counted(queue)
+        assert queue.get_stats()["pending"] == 4
+
+    def test_counters_rebuilt_on_open(self, temp_db):
+        """测试重新打开数据库时计数被校准"""
+        import sqlite3
+
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+        queue.enqueue("user@example.com", "cmd")
+        queue.close()
+        with sqlite3.connect(temp_db) as conn:
+            conn.execute("UPDATE command_stats SET count = 99")
+
+        reopened = CommandQueue(db_path=temp_db, use_lock=False)
+
+        assert reopened.get_stats()["pending"] == 1
+
+
+class TestCommandQueueScheduling:
+    """优先级与发件人公平调度测试"""
+
+    @pytest.fixture
+    def queue(self, temp_db):
+        return CommandQueue(db_path=temp_db, use_lock=False)
+
+    @staticmethod
+    def _drain(queue):
+        order = []
+        while True:
+            cmd = queue.dequeue()
+            if not cmd:
+                return order
+            order.append(cmd["sender"])
+
+    def test_flooding_sender_does_not_starve_others(self, queue):
+        """测试大量发信的用户与其他用户轮流执行"""
+        for i in range(10):
+            queue.enqueue("flood@example.com", f"cmd{i}")
+        queue.enqueue("light@example.com", "ls")
+
+        order = self._drain(queue)
+
+        assert order.index("light@example.com") <= 1
+
+    def test_fifo_within_sender(self, queue):
+        """测试同一发件人的命令保持先后顺序"""
+        for i in range(3):
+            queue.enqueue("user@example.com", f"cmd{i}")
+
+        assert [queue.dequeue()["command"] for _ in range(3)] == ["cmd0", "cmd1", "cmd2"]
+
+    def test_priority_runs_first(self, queue):
+        """测试高优先级命令先于先到的普通命令执行"""
+        queue.enqueue("a@example.com", "normal")
+        queue.enqueue("a@example.com", "low", priority=-1)
+        queue.enqueue("b@example.com", "urgent", priority=2)
+
+        assert [queue.dequeue()["command"] for _ in range(3)] == ["urgent", "normal", "low"]
+
+    def test_weighted_share(self, queue):
+        """测试权重2的发件人获得两倍执行机会"""
+        queue.set_sender_weight("heavy@example.com", 2)
+        for i in range(6):
+            queue.enqueue("heavy@example.com", f"h{i}")
+            queue.enqueue("normal@example.com", f"n{i}")
+
+        first_six = self._drain(queue)[:6]
+
+        assert first_six.count("heavy@example.com") == 4
+
+    def test_idle_sender_does_not_accumulate_credit(self, queue):
+        """测试长时间空闲的发件人回来后不会插队到所有人之前"""
+        queue.enqueue("idle@example.com", "early")
+        queue.dequeue()
+        for i in range(6):
+            queue.enqueue("busy@example.com", f"b{i}")
+        for _ in range(4):
+            queue.dequeue()
+
+        queue.enqueue("idle@example.com", "late")
+        queue.enqueue("idle@example.com", "later")
+
+        # 回来后从当前虚拟时钟开始排队，与 busy 交替而不是连续插队
+        assert self._drain(queue) == [
+            "busy@example.com", "idle@example.com", "busy@example.com", "idle@example.com"
+        ]
+
+
+class TestCommandQueueRetryBackoff:
+    """延迟重试测试"""
+
+    @pytest.fixture
+    def queue(self, temp_db):
+        return CommandQueue(db_path=temp_db, use_lock=False)
+
+    def test_retry_is_delayed(self, queue):
+        """测试失败后的命令在退避时间内不会被再次认领"""
+        cmd_id = queue.enqueue("user@example.com", "flaky")
+        queue.dequeue(worker_id="worker-a")
+
+        outcome = queue.retry_or_fail(cmd_id, "timeout", max_retries=3, worker_id="worker-a")
 
-        # 关闭
-        locked_queue.close()
+        assert outcome["retry"] == True
+        assert outcome["retry_count"] == 1
+        assert CommandQueue.RETRY_BASE_DELAY / 2 <= outcome["delay"] <= CommandQueue.RETRY_BASE_DELAY
+        cmd = queue.get_by_id(cmd_id)
+        assert cmd["status"] == "pending"
+        assert cmd["error"] == "timeout"
+        assert queue.dequeue() is None
+        assert 0 < queue.next_due_delay() <= CommandQueue.RETRY_BASE_DELAY
+
+    def test_due_retry_is_claimed(self, queue):
+        """测试到期后的重试命令可被认领"""
+        import sqlite3
+
+        cmd_id = queue.enqueue("user@example.com", "flaky")
+        queue.dequeue()
+        queue.retry_or_fail(cmd_id, "timeout")
+        with sqlite3.connect(queue.db_path) as conn:
+            conn.execute("UPDATE commands SET next_attempt_at = datetime('now', '-1 seconds')")
+
+        assert queue.next_due_delay() is None
+        assert queue.dequeue()["id"] == cmd_id
+
+    def test_delayed_retry_does_not_block_others(self, queue):
+        """测试等待重试的命令不阻塞其他命令"""
+        first = queue.enqueue("user@example.com", "flaky")
+        queue.dequeue()
+        queue.retry_or_fail(first, "timeout")
+        second = queue.enqueue("user@example.com", "next")
 
-        # 锁应该被释放
-        assert locked_queue.lock_fd is None
+        assert queue.dequeue()["id"] == second
+
+    def test_final_failure(self, queue):
+        """测试达到最大重试次数后标记失败并记录完成时间"""
+        cmd_id = queue.enqueue("user@example.com", "broken")
+        queue.dequeue()
+
+        outcome = queue.retry_or_fail(cmd_id, "fatal", max_retries=0)
+
+        assert outcome["retry"] == False
+        cmd = queue.get_by_id(cmd_id)
+        assert cmd["status"] == "failed"
+        assert cmd["completed_at"] is not None
+
+    def test_lost_lease_ignored(self, queue):
+        """测试租约丢失时不修改命令"""
+        cmd_id = queue.enqueue("user@example.com", "cmd")
+        queue.dequeue(worker_id="worker-a")
+
+        assert queue.retry_or_fail(cmd_id, "late", worker_id="worker-b") is None
+        assert queue.get_by_id(cmd_id)["status"] == "processing"
+
+    def test_retry_delay_is_capped(self):
+        """测试退避时间指数增长且不超过上限"""
+        assert CommandQueue.retry_delay(3) <= CommandQueue.RETRY_BASE_DELAY * 4
+        assert CommandQueue.retry_delay(3) >= CommandQueue.RETRY_BASE_DELAY * 2
+        assert CommandQueue.retry_delay(50) <= CommandQueue.RETRY_MAX_DELAY
+
+
+class TestCommandQueueDedup:
+    """Message-ID 与内容去重测试"""
+
+    def test_duplicate_message_id_rejected(self, temp_db):
+        """测试相同 Message-ID 的邮件只入队一次"""
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+
+        first = queue.enqueue("user@example.com", "ls", message_id="<m1@example.com>")
+        again = queue.enqueue("user@example.com", "pwd", message_id="<m1@example.com>")
+
+        assert first is not None
+        assert again is None
+        assert queue.get_stats()["pending"] == 1
+
+    def test_same_content_within_window_skipped(self, temp_db):
+        """测试窗口期内同一发件人的相同命令（空白与大小写差异）被去重"""
+        queue = CommandQueue(db_path=temp_db, use_lock=False, dedup_window=300)
+
+        assert queue.enqueue("User@Example.com", "git  pull\n") is not None
+        assert queue.enqueue("user@example.com", "git pull") is None
+        assert queue.enqueue("other@example.com", "git pull") is not None
+        assert queue.enqueue("user@example.com", "git push") is not None
+
+    def test_dedup_disabled_by_default(self, temp_db):
+        """测试默认不按内容去重"""
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+
+        assert queue.enqueue("user@example.com", "ls") is not None
+        assert queue.enqueue("user@example.com", "ls") is not None
+
+    def test_window_survives_restart(self, temp_db):
+        """测试重启后窗口期内的命令仍被识别为重复"""
+        queue = CommandQueue(db_path=temp_db, use_lock=False, dedup_window=300)
+        queue.enqueue("user@example.com", "ls")
+        queue.close()
+
+        reopened = CommandQueue(db_path=temp_db, use_lock=False, dedup_window=300)
+
+        assert reopened.enqueue("user@example.com", "ls") is None
+
+    def test_expired_window_allows_repeat(self, temp_db):
+        """测试超出窗口期后可以再次执行相同命令"""
+        import sqlite3
+
+        queue = CommandQueue(db_path=temp_db, use_lock=False, dedup_window=300)
+        queue.enqueue("user@example.com", "ls")
+        queue.close()
+        with sqlite3.connect(temp_db) as conn:
+            conn.execute("UPDATE commands SET created_at = datetime('now', '-1 hours')")
+
+        reopened = CommandQueue(db_path=temp_db, use_lock=False, dedup_window=300)
+
+        assert reopened.enqueue("user@example.com", "ls") is not None
+
+    def test_non_duplicate_decided_in_memory(self, temp_db):
+        """测试缓存完整时新命令直接由内存判定为不重复（不查询数据库）"""
+        queue = CommandQueue(db_path=temp_db, use_lock=False, dedup_window=300)
+        queue.enqueue("user@example.com", "ls")
+
+        now = time.time()
+        assert queue._recent.lookup(CommandQueue.content_hash("user@example.com", "pwd"), now) == False
+        assert queue._recent.lookup(CommandQueue.content_hash("user@example.com", "ls"), now) == True
+
+    def test_duplicate_from_other_writer_detected(self, temp_db):
+        """测试同库的另一个队列实例（另一个进程）入队的命令也被识别为重复"""
+        first = CommandQueue(db_path=temp_db, use_lock=False, dedup_window=300)
+        second = CommandQueue(db_path=temp_db, use_lock=False, dedup_window=300)
+
+        assert first.enqueue("user@example.com", "ls") is not None
+        assert second.enqueue("user@example.com", "ls") is None
+        assert second.enqueue("user@example.com", "pwd") is not None
+        assert first.enqueue("user@example.com", "pwd") is None
+
+    def test_cached_hit_expires_with_window(self):
+        """测试缓存中过期的条目即使未被清理也不再判定为重复"""
+        from queue.manager import _RecentKeys
+
+        recent = _RecentKeys(window=300, capacity=10)
+        recent.add("new", 1000.0)
+        recent.add("old", 500.0)
+
+        assert recent.lookup("new", 1200.0) == True
+        assert recent.lookup("old", 1200.0) == False
+
+    def test_cache_overflow_falls_back_to_database(self, temp_db, monkeypatch):
+        """测试缓存溢出后仍能通过数据库识别重复"""
+        monkeypatch.setattr(CommandQueue, "DEDUP_CACHE_SIZE", 2)
+        queue = CommandQueue(db_path=temp_db, use_lock=False, dedup_window=300)
+        for command in ("a", "b", "c"):
+            queue.enqueue("user@example.com", command)
+
+        assert queue.enqueue("user@example.com", "a") is None
+
+    def test_legacy_duplicate_message_ids_migrated(self, temp_db):
+        """测试旧库中重复的 message_id 被清除后建立唯一索引"""
+        import sqlite3
+
+        conn = sqlite3.connect(temp_db)
+        conn.execute("""
+            CREATE TABLE commands (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender TEXT NOT NULL, command TEXT NOT NULL,
+                message_id TEXT, subject TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                result TEXT, error TEXT, retry_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                completed_at TIMESTAMP
+            )
+        """)
+        conn.execute("CREATE INDEX idx_message_id ON commands(message_id)")
+        conn.executemany(
+            "INSERT INTO commands (sender, command, message_id) VALUES (?, ?, ?)",
+            [("u@example.com", "ls", "<dup>"), ("u@example.com", "ls", "<dup>")]
+        )
+        conn.commit()
+        conn.close()
+
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+
+        assert queue.get_by_id(1)["message_id"] == "<dup>"
+        assert queue.get_by_id(2)["message_id"] is None
+        assert queue.enqueue("u@example.com", "ls", message_id="<dup>") is None
+
+
+class TestCommandQueueBatchEnqueue:
+    """批量入队测试"""
+
+    def test_returns_ids_in_order(self, temp_db):
+        """测试批量入队返回与记录一一对应的ID"""
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+
+        cmd_ids = queue.enqueue_many([
+            {"sender": "a@example.com", "command": "ls", "message_id": "<m1@x>"},
+            {"sender": "b@example.com", "command": "pwd", "message_id": "<m2@x>", "priority": 1},
+        ])
+
+        assert len(cmd_ids) == 2
+        assert queue.get_by_id(cmd_ids[0])["command"] == "ls"
+        assert queue.get_by_id(cmd_ids[1])["priority"] == 1
+        assert queue.enqueue_many([]) == []
+
+    def test_duplicates_skipped(self, temp_db):
+        """测试批内与已入队的重复 Message-ID 被跳过，其余照常入队"""
+        queue = CommandQueue(db_path=temp_db, use_lock=False)
+        queue.enqueue("a@example.com", "ls", message_id="<m1@x>")
+
+        cmd_ids = queue.enqueue_many([
+            {"sender": "a@example.com", "command": "ls", "message_id": "<m1@x>"},
+            {"sender": "a@example.com", "command": "pwd", "message_id": "<m2@x>"},
+            {"sender": "a@example.com", "command": "pwd", "message_id": "<m2@x>"},
+            {"sender": "a@example.com", "command": "date", "message_id": "<m3@x>"},
+        ])
+
+        assert cmd_ids[0] is None
+        assert cmd_ids[2] is None
+        assert queue.get_by_id(cmd_ids[1])["command"] == "pwd"
+        assert queue.get_by_id(cmd_ids[3])["command"] == "date"
+        assert queue.get_stats()["pending"] == 3
+
+    def test_content_dedup_within_batch(self, temp_db):
+        """测试去重窗口同样作用于同一批次内的记录"""
+        queue = CommandQueue(db_path=temp_db, use_lock=False, dedup_window=300)
+
+        cmd_ids = queue.enqueue_many([
+            {"sender": "a@example.com", "command": "git pull"},
+            {"sender": "a@example.com", "command": "git  pull"},
+        ])
+
+        assert cmd_ids[0] is not None
+        assert cmd_ids[1] is None
+
+    def test_fair_tags_match_single_enqueue(self, temp_db, tmp_path):
+        """测试批量入队与逐条入队得到相同的调度顺序"""
+        records = [
+            {"sender": "busy@example.com", "command": f"job{i}"} for i in range(3)
+        ] + [{"sender": "idle@example.com", "command": "job"}]
+
+        single = CommandQueue(db_path=str(tmp_path / "single.db"), use_lock=False)
+        for record in records:
+            single.enqueue(**record)
+        batch = CommandQueue(db_path=temp_db, use_lock=False)
+        batch.enqueue_many(records)
+
+        def order(queue):
+            claimed = []
+            while True:
+                cmd = queue.dequeue()
+                if cmd is None:
+                    return claimed
+                claimed.append((cmd["sender"], cmd["command"]))
+
+        assert order(batch) == order(single)
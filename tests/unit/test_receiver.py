@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+EmailReceiver 单元测试
+使用模拟 IMAP 客户端测试基于 UID 的收信逻辑
+"""
+
+import imaplib
+import socket
+import threading
+import time
+
+import pytest
+from mail.parser import EmailParser
+from mail.receiver import EmailReceiver, build_uid_set, parse_fetch_response
+
+
+class FakeIMAP:
+    """模拟 imaplib 客户端：记录 UID 命令并返回预设结果"""
+
+    def __init__(self, uids=(), uidvalidity=b"42", messages=None):
+        self.uids = list(uids)
+        self.uidvalidity = uidvalidity
+        # {uid: (头部字节, 正文字节, 大小)}，用于两阶段获取测试
+        self.messages = messages or {}
+        self.calls = []
+
+    def select(self, mailbox):
+        self.calls.append(("SELECT", mailbox))
+        return "OK", [str(len(self.uids)).encode()]
+
+    def response(self, code):
+        return code, [self.uidvalidity]
+
+    def uid(self, command, *args):
+        self.calls.append((command,) + args)
+        if command == "SEARCH":
+            return "OK", [b" ".join(str(u).encode() for u in self.uids)]
+        if command == "FETCH" and "HEADER.FIELDS" in args[1]:
+            data = []
+            for i, uid in enumerate(self._expand(args[0]), start=1):
+                header, _, size = self.messages[uid]
+                # 部分服务器把 RFC822.SIZE 放在字面量之后
+                data.append((f"{i} (UID {uid} BODY[HEADER.FIELDS] {{{len(header)}}}".encode(), header))
+                data.append(f" RFC822.SIZE {size})".encode())
+            return "OK", data
+        if command == "FETCH" and "BODY.PEEK[TEXT]" in args[1]:
+            data = []
+            for i, uid in enumerate(self._expand(args[0]), start=1):
+                body = self.messages[uid][1]
+                data.append((f"{i} (UID {uid} BODY[TEXT]<0> {{{len(body)}}}".encode(), body))
+                data.append(b")")
+            return "OK", data
+        if command == "FETCH":
+            data = []
+            for i, uid in enumerate(self._expand(args[0]), start=1):
+                data.append((f"{i} (UID {uid} RFC822 {{5}}".encode(), f"msg{uid}".encode()))
+                data.append(b")")
+            return "OK", data
+        return "OK", [None]
+
+    @staticmethod
+    def _expand(uid_set):
+        """展开序列集（测试只使用 a:b 与逗号）"""
+        if isinstance(uid_set, bytes):
+            uid_set = uid_set.decode()
+        uids = []
+        for part in uid_set.split(","):
+            if ":" in part:
+                start, end = part.split(":")
+                uids.extend(range(int(start), int(end) + 1))
+            else:
+                uids.append(int(part))
+        return uids
+
+
+@pytest.fixture
+def receiver():
+    receiver = EmailReceiver("imap.example.com", 993, "bot@example.com", "secret")
+    receiver._connected = True
+    return receiver
+
+
+class TestEmailReceiverUid:
+    """UID 收信测试"""
+
+    def test_select_records_uidvalidity(self, receiver):
+        """测试选择收件箱时记录 UIDVALIDITY"""
+        receiver.client = FakeIMAP(uidvalidity=b"12345")
+
+        assert receiver.select_inbox() == True
+        assert receiver.uidvalidity == 12345
+
+    def test_search_without_watermark_scans_unseen(self, receiver):
+        """测试无水位时全量搜索未读邮件"""
+        receiver.client = FakeIMAP(uids=[7, 3, 5])
+
+        uids = receiver.search_unread()
+
+        assert uids == [b"3", b"5", b"7"]
+        assert receiver.client.calls[-1] == ("SEARCH", None, "UNSEEN")
+
+    def test_search_since_watermark(self, receiver):
+        """测试有水位时只搜索更大的UID，并过滤 n:* 返回的旧UID"""
+        receiver.client = FakeIMAP(uids=[10])
+
+        assert receiver.search_unread(since_uid=10) == []
+        assert receiver.client.calls[-1] == ("SEARCH", None, "UID 11:*", "UNSEEN")
+
+    def test_fetch_and_mark_use_uid_commands(self, receiver):
+        """测试获取与标记已读使用 UID 命令"""
+        receiver.client = FakeIMAP()
+
+        assert receiver.fetch_email(b"9") == b"msg9"
+        assert receiver.mark_as_read(b"9") == True
+        assert [call[0] for call in receiver.client.calls] == ["FETCH", "STORE"]
+
+
+class TestEmailReceiverBatch:
+    """批量 FETCH / STORE 测试"""
+
+    def test_build_uid_set_compresses_ranges(self):
+        """测试UID列表压缩为序列集"""
+        assert build_uid_set([b"5", b"3", b"4", b"9", b"11", b"12"]) == "3:5,9,11:12"
+        assert build_uid_set([b"7"]) == "7"
+
+    def test_fetch_many_single_round_trip(self, receiver):
+        """测试一条命令获取多封邮件"""
+        receiver.client = FakeIMAP()
+
+        messages = receiver.fetch_many([b"3", b"4", b"9"])
+
+        assert messages == {b"3": b"msg3", b"4": b"msg4", b"9": b"msg9"}
+        assert receiver.client.calls == [("FETCH", "3:4,9", "(RFC822)")]
+
+    def test_fetch_many_splits_large_batches(self, receiver, monkeypatch):
+        """测试超过批量上限时拆分为多条命令"""
+        monkeypatch.setattr(EmailReceiver, "BATCH_SIZE", 100)
+        receiver.client = FakeIMAP()
+
+        messages = receiver.fetch_many([str(i).encode() for i in range(1, 201)])
+
+        assert len(messages) == 200
+        assert len(receiver.client.calls) == 2
+
+    def test_mark_many_as_read_single_store(self, receiver):
+        """测试一条命令标记多封邮件已读"""
+        receiver.client = FakeIMAP()
+
+        assert receiver.mark_many_as_read([b"1", b"2", b"3"]) == True
+        assert receiver.client.calls == [("STORE", "1:3", "+FLAGS.SILENT", "(\\Seen)")]
+
+
+class TestEmailReceiverTwoPhase:
+    """头部优先的两阶段获取测试"""
+
+    HEADER = (
+        b"From: Alice <alice@example.com>\r\n"
+        b"Subject: run\r\n"
+        b"Message-ID: <m1@example.com>\r\n"
+        b"Content-Type: text/plain; charset=utf-8\r\n\r\n"
+    )
+
+    def test_parse_fetch_response_reads_trailing_items(self):
+        """测试 UID 与 RFC822.SIZE 位于字面量前后都能解析"""
+        data = [
+            (b"1 (RFC822.SIZE 120 BODY[HEADER.FIELDS (FROM)] {4}", b"From"),
+            b" UID 7)",
+        ]
+
+        assert parse_fetch_response(data) == [{"uid": b"7", "size": 120, "literal": b"From"}]
+
+    def test_fetch_headers_does_not_download_bodies(self, receiver):
+        """测试第一阶段只请求头部字段与大小"""
+        receiver.client = FakeIMAP(messages={3: (self.HEADER, b"ls\r\n", 2048)})
+
+        headers = receiver.fetch_headers_many([b"3"])
+
+        assert headers == {b"3": {"size": 2048, "header": self.HEADER}}
+        command, uid_set, query = receiver.client.calls[0]
+        assert "BODY.PEEK[HEADER.FIELDS (FROM MESSAGE-ID SUBJECT" in query
+        assert "RFC822.SIZE" in query
+        assert "RFC822)" not in query
+
+    def test_fetch_bodies_is_bounded_peek(self, receiver):
+        """测试第二阶段使用 PEEK 并限制正文长度"""
+        receiver.client = FakeIMAP(messages={3: (self.HEADER, b"ls\r\n", 2048)})
+
+        bodies = receiver.fetch_bodies_many([b"3"])
+
+        assert bodies == {b"3": b"ls\r\n"}
+        assert receiver.client.calls == [
+            ("FETCH", "3", f"(BODY.PEEK[TEXT]<0.{EmailReceiver.BODY_FETCH_LIMIT}>)")
+        ]
+
+    def test_header_and_body_reassemble_for_parser(self, receiver):
+        """测试头部与正文拼接后可被解析为命令"""
+        receiver.client = FakeIMAP(messages={3: (self.HEADER, b"ls -la\r\n", 2048)})
+        parser = EmailParser(["alice@example.com"])
+
+        header = receiver.fetch_headers_many([b"3"])[b"3"]["header"]
+        assert parser.parse_headers(header)["is_whitelisted"] == True
+
+        parsed = parser.parse_email(header + receiver.fetch_bodies_many([b"3"])[b"3"])
+
+        assert parsed["command"] == "ls -la"
+        assert parsed["message_id"] == "<m1@example.com>"
+
+
+class SocketPairIMAP(imaplib.IMAP4):
+    """连接到 socketpair 的真实 imaplib 客户端，服务器端由 ScriptedIMAPServer 模拟"""
+
+    def __init__(self, sock):
+        self._pair_sock = sock
+        super().__init__()
+
+    def open(self, host="", port=imaplib.IMAP4_PORT, timeout=None):
+        self.host = host
+        self.port = port
+        self.sock = self._pair_sock
+        self.file = self.sock.makefile("rb")
+
+
+class ScriptedIMAPServer:
+    """
+    按脚本应答的最小 IMAP 服务器
+
+    Args:
+        fetch_push: UID FETCH 应答中附带的 untagged 响应（在标记响应之前）
+        after_fetch: 紧跟在 UID FETCH 标记响应之后发送的数据（同一次写入）
+        idle_pushes: IDLE 期间的 [(延迟秒, 响应行)]
+        accept_idle: 是否接受 IDLE
+    """
+
+    def __init__(self, fetch_push=b"", after_fetch=b"", idle_pushes=(), accept_idle=True):
+        self.client_sock, self.sock = socket.socketpair()
+        self.fetch_push = fetch_push
+        self.after_fetch = after_fetch
+        self.idle_pushes = idle_pushes
+        self.accept_idle = accept_idle
+        self.commands = []
+        self.sock.sendall(b"* OK ready\r\n")
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        stream = self.sock.makefile("rb")
+        try:
+            for raw in stream:
+                tag, _, command = raw.rstrip(b"\r\n").partition(b" ")
+                self.commands.append(command)
+                name = command.split(b" ")[0].upper()
+                if name == b"CAPABILITY":
+                    self.sock.sendall(b"* CAPABILITY IMAP4rev1 IDLE\r\n" + tag + b" OK done\r\n")
+                elif name == b"UID" and b"FETCH" in command.upper():
+                    self.sock.sendall(
+                        b"* 1 FETCH (UID 5 BODY[TEXT]<0> {3}\r\nabc)\r\n"
+                        + self.fetch_push + tag + b" OK FETCH done\r\n" + self.after_fetch
+                    )
+                elif name == b"IDLE":
+                    if not self.accept_idle:
+                        self.sock.sendall(tag + b" BAD unknown command\r\n")
+                        continue
+                    self.sock.sendall(b"+ idling\r\n")
+                    for delay, line in self.idle_pushes:
+                        time.sleep(delay)
+                        self.sock.sendall(line)
+                    stream.readline()
+                    self.sock.sendall(tag + b" OK IDLE terminated\r\n")
+                else:
+                    self.sock.sendall(tag + b" OK done\r\n")
+        except OSError:
+            pass
+
+    def close(self):
+        self.client_sock.close()
+        self.sock.close()
+
+
+class TestEmailReceiverIdle:
+    """长时间 IDLE 测试"""
+
+    @pytest.fixture
+    def connect(self, receiver):
+        """以给定脚本启动模拟服务器，并让 receiver 使用真实 imaplib 客户端连接"""
+        servers = []
+
+        def make(**script):
+            server = ScriptedIMAPServer(**script)
+            servers.append(server)
+            receiver.client = SocketPairIMAP(server.client_sock)
+            # 跳过 LOGIN/SELECT，直接进入已选中邮箱状态
+            receiver.client.state = "SELECTED"
+            assert receiver.supports_idle() == True
+            return server
+
+        yield make
+        for server in servers:
+            server.close()
+
+    def test_wakes_on_exists(self, receiver, connect):
+        """测试收到 EXISTS 推送后立即返回，而不是等到超时"""
+        connect(idle_pushes=[
+            (0.1, b"* 3 FETCH (FLAGS (\\Seen))\r\n"),
+            (0.1, b"* 4 EXISTS\r\n"),
+        ])
+
+        started = time.monotonic()
+        assert receiver.idle_wait(timeout=60) == True
+        assert time.monotonic() - started < 5
+
+    def test_exists_during_fetch_skips_idle(self, receiver, connect):
+        """测试收信期间服务器报告的 EXISTS 不会被 IDLE 丢失"""
+        server = connect(fetch_push=b"* 6 EXISTS\r\n")
+        assert receiver.fetch_bodies_many([b"5"]) == {b"5": b"abc"}
+
+        started = time.monotonic()
+        assert receiver.idle_wait(timeout=60) == True
+        assert time.monotonic() - started < 1
+        assert not any(command.startswith(b"IDLE") for command in server.commands)
+
+        # 通知只消费一次，下一次 IDLE 正常进入等待
+        receiver.client.untagged_responses.clear()
+        assert receiver._take_new_mail(receiver.client) == False
+
+    def test_buffered_exists_before_continuation(self, receiver, connect):
+        """测试已读入 imaplib 缓冲、尚未解析的 EXISTS 不会丢失"""
+        server = connect(after_fetch=b"* 7 EXISTS\r\n")
+        receiver.fetch_bodies_many([b"5"])
+        receiver.client.untagged_responses.clear()
+
+        started = time.monotonic()
+        assert receiver.idle_wait(timeout=60) == True
+        assert time.monotonic() - started < 5
+        assert any(command.startswith(b"IDLE") for command in server.commands)
+
+    def test_shutdown_interrupts_long_idle(self, receiver, connect):
+        """测试停止信号可在无推送时中断长时间 IDLE"""
+        connect()
+        receiver.client.untagged_responses.clear()
+        stop_at = time.monotonic() + 0.3
+
+        started = time.monotonic()
+        assert receiver.idle_wait(
+            timeout=60, shutdown_check=lambda: time.monotonic() > stop_at
+        ) == False
+        assert time.monotonic() - started < 5
+        assert receiver._connected == True
+
+    def test_timeout_is_capped(self, receiver, connect, monkeypatch):
+        """测试单次 IDLE 不超过上限时长"""
+        monkeypatch.setattr(EmailReceiver, "IDLE_MAX_DURATION", 0.3)
+        connect()
+        receiver.client.untagged_responses.clear()
+
+        started = time.monotonic()
+        assert receiver.idle_wait(timeout=3600) == True
+        assert time.monotonic() - started < 5
+
+    def test_rejected_idle_falls_back_to_polling(self, receiver, connect):
+        """测试服务器拒绝 IDLE 时降级为轮询"""
+        connect(accept_idle=False)
+        receiver.client.untagged_responses.clear()
+
+        assert receiver.idle_wait(timeout=60) == False
+        assert receiver._idle_supported == False
+
+    def test_closed_connection_marks_disconnected(self, receiver, connect):
+        """测试 IDLE 期间服务器断开时标记连接断开"""
+        server = connect(idle_pushes=[(0.1, b"")])
+        receiver.client.untagged_responses.clear()
+        threading.Timer(0.2, lambda: server.sock.shutdown(socket.SHUT_RDWR)).start()
+
+        assert receiver.idle_wait(timeout=60) == False
+        assert receiver._connected == False
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+EmailSender 单元测试
+使用模拟 SMTP_SSL 测试会话池、健康检查与断线重试
+"""
+
+import smtplib
+
+import pytest
+from mail.sender import EmailSender
+
+
+class FakeSMTP:
+    """模拟 smtplib.SMTP_SSL：记录实例与发送的邮件"""
+
+    instances = []
+
+    def __init__(self, server, port, timeout=None):
+        self.sent = []
+        self.closed = False
+        self.alive = True
+        self.fail_next_send = False
+        FakeSMTP.instances.append(self)
+
+    def login(self, username, password):
+        return 235, b"OK"
+
+    def noop(self):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected("connection closed")
+        return 250, b"OK"
+
+    def send_message(self, msg):
+        if self.fail_next_send or not self.alive:
+            self.fail_next_send = False
+            raise smtplib.SMTPServerDisconnected("connection closed")
+        self.sent.append(msg)
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def sender(monkeypatch):
+    FakeSMTP.instances = []
+    monkeypatch.setattr("mail.sender.smtplib.SMTP_SSL", FakeSMTP)
+    sender = EmailSender("smtp.example.com", 465, "bot@example.com", "secret")
+    assert sender.connect() == True
+    assert sender.login() == True
+    return sender
+
+
+class TestEmailSenderPool:
+    """SMTP 会话池测试"""
+
+    def test_session_reused_across_sends(self, sender):
+        """测试连续发送复用登录时建立的会话"""
+        assert sender.send_email("a@example.com", "s1", "body") == True
+        assert sender.send_email("a@example.com", "s2", "body") == True
+
+        assert len(FakeSMTP.instances) == 1
+        assert len(FakeSMTP.instances[0].sent) == 2
+
+    def test_dead_session_detected_by_noop(self, sender, monkeypatch):
+        """测试空闲会话 NOOP 失败时换新会话"""
+        monkeypatch.setattr(EmailSender, "NOOP_INTERVAL", -1)
+        FakeSMTP.instances[0].alive = False
+
+        assert sender.send_email("a@example.com", "s", "body") == True
+
+        assert len(FakeSMTP.instances) == 2
+        assert FakeSMTP.instances[0].closed == True
+        assert len(FakeSMTP.instances[1].sent) == 1
+
+    def test_idle_session_expires(self, sender, monkeypatch):
+        """测试超过空闲期限的会话直接关闭，不做 NOOP"""
+        monkeypatch.setattr(EmailSender, "SESSION_IDLE_TIMEOUT", -1)
+
+        assert sender.send_email("a@example.com", "s", "body") == True
+
+        assert FakeSMTP.instances[0].closed == True
+        assert len(FakeSMTP.instances) == 2
+
+    def test_disconnect_during_send_retries_once(self, sender):
+        """测试发送中连接断开时重连并重试一次"""
+        FakeSMTP.instances[0].fail_next_send = True
+
+        assert sender.send_email("a@example.com", "s", "body") == True
+        assert len(FakeSMTP.instances) == 2
+        assert len(FakeSMTP.instances[1].sent) == 1
+
+    def test_gives_up_after_retry(self, sender, monkeypatch):
+        """测试重试后仍断开则返回失败"""
+        FakeSMTP.instances[0].alive = False
+
+        class DeadSMTP(FakeSMTP):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.alive = False
+
+        monkeypatch.setattr("mail.sender.smtplib.SMTP_SSL", DeadSMTP)
+
+        assert sender.send_email("a@example.com", "s", "body") == False
+
+    def test_disconnect_closes_pooled_sessions(self, sender):
+        """测试断开时关闭池中所有会话"""
+        sender.disconnect()
+
+        assert FakeSMTP.instances[0].closed == True
+        assert sender._connected == False
+
+
+class TestEmailSenderAttachment:
+    """结果附件压缩测试"""
+
+    @staticmethod
+    def _attachment(sender_msg):
+        parts = [part for part in sender_msg.walk() if part.get_filename()]
+        assert len(parts) == 1
+        return parts[0]
+
+    def _send(self, sender, tmp_path, content):
+        output = tmp_path / "claude_output.txt"
+        output.write_bytes(content)
+        assert sender.send_email("a@example.com", "s", "summary", attachment_path=str(output)) == True
+        return self._attachment(FakeSMTP.instances[0].sent[-1])
+
+    def test_large_attachment_gzipped(self, sender, tmp_path):
+        """测试超过阈值的附件以 gzip 发送且可还原"""
+        import gzip
+
+        content = b"line of verbose claude output\n" * 20000
+        part = self._send(sender, tmp_path, content)
+
+        assert part.get_filename().endswith(".txt.gz")
+        payload = part.get_payload(decode=True)
+        assert len(payload) * 5 < len(content)
+        assert gzip.decompress(payload) == content
+
+    def test_zip_compression(self, sender, tmp_path):
+        """测试 zip 格式附件"""
+        import io
+        import zipfile
+
+        sender.compression = "zip"
+        content = b"x" * (EmailSender.DEFAULT_COMPRESS_THRESHOLD + 1)
+        part = self._send(sender, tmp_path, content)
+
+        assert part.get_filename().endswith(".zip")
+        with zipfile.ZipFile(io.BytesIO(part.get_payload(decode=True))) as archive:
+            assert archive.read(archive.namelist()[0]) == content
+
+    def test_small_attachment_not_compressed(self, sender, tmp_path):
+        """测试小于阈值的附件保持原样"""
+        part = self._send(sender, tmp_path, b"short output")
+
+        assert part.get_filename().endswith(".txt")
+        assert part.get_payload(decode=True) == b"short output"
+
+    def test_compression_disabled(self, sender, tmp_path):
+        """测试关闭压缩"""
+        sender.compression = "none"
+        content = b"y" * (EmailSender.DEFAULT_COMPRESS_THRESHOLD * 2)
+
+        part = self._send(sender, tmp_path, content)
+
+        assert part.get_payload(decode=True) == content
+
+    def test_spilled_attachment_survives_serialization(self, sender, tmp_path, monkeypatch):
+        """测试压缩结果落盘后按块编码的附件在序列化、解析后内容不变"""
+        import email
+        import gzip
+        import os
+
+        monkeypatch.setattr(EmailSender, "SPOOL_MAX_SIZE", 1024)
+        content = os.urandom(300000)
+        part = self._send(sender, tmp_path, content)
+
+        parsed = email.message_from_bytes(FakeSMTP.instances[0].sent[-1].as_bytes())
+        [attachment] = [p for p in parsed.walk() if p.get_filename()]
+        assert attachment["Content-Transfer-Encoding"] == "base64"
+        assert all(len(line) <= 76 for line in attachment.get_payload().splitlines())
+        assert gzip.decompress(attachment.get_payload(decode=True)) == content
+        assert part.get_payload(decode=True) == attachment.get_payload(decode=True)
+
+    def test_truncated_body_compressed(self, sender):
+        """测试正文被截断时附加的完整正文同样压缩"""
+        import gzip
+
+        body = "z" * (EmailSender.MAX_BODY_LENGTH + 100000)
+        assert sender.send_email("a@example.com", "s", body) == True
+
+        part = self._attachment(FakeSMTP.instances[0].sent[-1])
+        assert gzip.decompress(part.get_payload(decode=True)) == body.encode()
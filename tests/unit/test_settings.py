@@ -124,3 +124,61 @@ class TestSettings:
 
         # 测试不存在的环境变量返回默认值
         assert settings.get("NON_EXISTENT", "default") == "default"
+
+    def test_get_worker_count_default(self, monkeypatch):
+        """测试默认worker数量"""
+        monkeypatch.delenv("WORKER_COUNT", raising=False)
+
+        settings = Settings()
+
+        assert settings.get_worker_count() == Settings.DEFAULT_WORKER_COUNT
+
+    def test_get_worker_count_at_least_one(self, monkeypatch):
+        """测试worker数量至少为1"""
+        monkeypatch.setenv("WORKER_COUNT", "0")
+
+        settings = Settings()
+
+        assert settings.get_worker_count() == 1
+
+    def test_get_attachment_compression(self, monkeypatch):
+        """测试附件压缩格式配置，无效值回退到默认"""
+        monkeypatch.setenv("ATTACHMENT_COMPRESSION", "ZIP")
+        assert Settings().get_attachment_compression() == "zip"
+
+        monkeypatch.setenv("ATTACHMENT_COMPRESSION", "bz2")
+        assert Settings().get_attachment_compression() == Settings.DEFAULT_ATTACHMENT_COMPRESSION
+
+    def test_get_retention_settings(self, monkeypatch):
+        """测试保留天数与维护间隔配置及下限"""
+        monkeypatch.setenv("RETENTION_DAYS", "30")
+        monkeypatch.setenv("MAINTENANCE_INTERVAL", "5")
+
+        settings = Settings()
+
+        assert settings.get_retention_days() == 30
+        assert settings.get_maintenance_interval() == 60
+
+    def test_get_shutdown_timeout(self, monkeypatch):
+        """测试停机等待时间配置，负数按0处理"""
+        monkeypatch.delenv("SHUTDOWN_TIMEOUT", raising=False)
+        assert Settings().get_shutdown_timeout() == Settings.DEFAULT_SHUTDOWN_TIMEOUT
+
+        monkeypatch.setenv("SHUTDOWN_TIMEOUT", "-5")
+        assert Settings().get_shutdown_timeout() == 0
+
+    def test_get_archive_enabled(self, monkeypatch):
+        """测试归档开关，默认关闭"""
+        monkeypatch.delenv("ARCHIVE_ENABLED", raising=False)
+        assert Settings().get_archive_enabled() is False
+
+        monkeypatch.setenv("ARCHIVE_ENABLED", "True")
+        assert Settings().get_archive_enabled() is True
+
+    def test_get_sender_weights(self, monkeypatch):
+        """测试发件人权重解析，忽略无效条目"""
+        monkeypatch.setenv("SENDER_WEIGHTS", "boss@example.com=2, bot@example.com=0.5,bad=x,zero@example.com=0")
+
+        settings = Settings()
+
+        assert settings.get_sender_weights() == {"boss@example.com": 2.0, "bot@example.com": 0.5}